@@ -1,5 +1,6 @@
 __all__ = ["cassilda", "builder", "image", "runner",
-                "networks", "debian_squeeze_builder"]
+                "networks", "debian_squeeze_builder", "backends", "daemon",
+                "telemetry"]
 from .cassilda import Cassilda
 from .image import Image
 from .builder import Builder
@@ -0,0 +1,253 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Guest agent channel
+
+Host side of the framed protocol spoken by guest_agent.py, which the
+builders install in the images and the Runner attaches to the second
+UML console (con1), on a pty of the host. Requests are pipelined: any
+number of threads may have requests in flight, a reader thread hands
+every response to the request with the same id.
+
+It can be tried without any guest against a local stand-in agent::
+
+    client = AgentClient.spawn_local()
+    client.execute('uname -a')
+"""
+import os
+import subprocess
+import sys
+import threading
+
+from . import guest_agent
+from .guest_agent import read_frame, write_frame, encode, decode
+from .transport import Transport, CHUNK_SIZE
+
+# Where the builders install the agent inside the images
+GUEST_PATH = '/usr/local/sbin/cassilda-agent'
+# Device of the second UML console inside the guest
+GUEST_TTY = '/dev/tty1'
+# Line printed by UML when con1=pts is used
+PTS_PATTERN = "Virtual console 1 assigned device '(/dev/pts/[0-9]+)'"
+
+class AgentError(Exception):
+    pass
+
+class AgentClosed(AgentError):
+    """ The channel is gone and the request was not sent, so it can be
+    made again through another transport """
+    pass
+
+class AgentClient:
+    r""" Sends requests to a guest agent and waits for their responses
+
+    >>> import os, tempfile
+    >>> client = AgentClient.spawn_local()
+    >>> client.execute('echo hello', timeout=10) == (0, b'hello\n')
+    True
+    >>> path = os.path.join(tempfile.mkdtemp(), 'motd')
+    >>> client.write(path, b'welcome', mode=0o600, timeout=10)
+    True
+    >>> client.read(path, timeout=10) == b'welcome'
+    True
+    >>> oct(os.stat(path).st_mode & 0o777)[-3:]
+    '600'
+    >>> handle = client.spawn('tr a-z A-Z', timeout=10)
+    >>> client.feed(handle, b'piped', timeout=10)
+    >>> client.wait(handle, timeout=10) == (0, b'PIPED')
+    True
+    >>> client.execute('exit 3', timeout=10)[0]
+    3
+    >>> try:
+    ...     client.read(path + '.missing', timeout=10)
+    ... except AgentError as e:
+    ...     print(str(e).split(':')[0])
+    read
+    >>> client.close()
+    """
+    def __init__(self, rfd, wfd, process=None):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.process = process
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+    @staticmethod
+    def open_tty(path):
+        ''' Connect to an agent through a (pty) device, in raw mode '''
+        import tty
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(fd)
+        return AgentClient(fd, fd)
+
+    @staticmethod
+    def spawn_local():
+        ''' Start a local stand-in agent process and connect to it '''
+        p = subprocess.Popen([sys.executable, guest_agent.__file__.replace(
+                                '.pyc', '.py')],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return AgentClient(p.stdout.fileno(), p.stdin.fileno(), p)
+
+    def read_responses(self):
+        while True:
+            try:
+                response = read_frame(self.rfd)
+            except (OSError, ValueError):
+                response = None
+            self.lock.acquire()
+            try:
+                if response == None:
+                    # Channel gone: wake everybody up
+                    self.closed = True
+                    for event, slot in self.pending.values():
+                        event.set()
+                    return
+                if response.get('id') in self.pending:
+                    event, slot = self.pending.pop(response['id'])
+                    slot.append(response)
+                    event.set()
+            finally:
+                self.lock.release()
+
+    def request(self, op, timeout=None, **arguments):
+        ''' Send a request and wait for its response '''
+        event = threading.Event()
+        slot = []
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise AgentClosed(op + ': agent channel is closed')
+            self.next_id += 1
+            arguments['id'] = self.next_id
+            arguments['op'] = op
+            try:
+                write_frame(self.wfd, arguments)
+            except OSError as e:
+                # A partial frame leaves the channel out of step
+                self.closed = True
+                raise AgentClosed(op + ': ' + str(e))
+            self.pending[self.next_id] = (event, slot)
+        finally:
+            self.lock.release()
+        event.wait(timeout)
+        if slot == []:
+            self.lock.acquire()
+            try:
+                self.pending.pop(arguments['id'], None)
+            finally:
+                self.lock.release()
+            raise AgentError(op + ': no response from agent')
+        response = slot[0]
+        if 'error' in response:
+            raise AgentError(op + ': ' + response['error'])
+        return response
+
+    def execute(self, command, timeout=None):
+        ''' Run a shell command, return (exit status, output) '''
+        r = self.request('exec', timeout, command=command)
+        return r['status'], decode(r['output'])
+
+    def read(self, path, timeout=None):
+        ''' Return the contents of a file of the guest '''
+        return decode(self.request('read', timeout, path=path)['data'])
+
+    def write(self, path, data, append=False, mode=None, timeout=None):
+        ''' Write data into a file of the guest '''
+        arguments = { 'path': path, 'data': encode(data), 'append': append }
+        if mode != None:
+            arguments['mode'] = mode
+        self.request('write', timeout, **arguments)
+        return True
+
+    def spawn(self, command, timeout=None):
+        ''' Start a command, return its handle for feed(), output() and
+        wait() '''
+        return self.request('spawn', timeout, command=command)['handle']
+
+    def feed(self, handle, data, timeout=None):
+        ''' Write data into the stdin of a spawned command '''
+        self.request('feed', timeout, handle=handle, data=encode(data))
+
+    def output(self, handle, size, timeout=None):
+        ''' Read up to size bytes of the output of a spawned command,
+        b'' at the end '''
+        return decode(self.request('output', timeout, handle=handle,
+                                                    size=size)['data'])
+
+    def wait(self, handle, timeout=None):
+        ''' Close the stdin of a spawned command and wait for it, return
+        (exit status, rest of its output) '''
+        r = self.request('wait', timeout, handle=handle)
+        return r['status'], decode(r['output'])
+
+    def status(self, timeout=None):
+        ''' Return a dictionary with the status of the guest '''
+        r = self.request('status', timeout)
+        del r['id']
+        return r
+
+    def close(self):
+        if self.process != None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+        else:
+            os.close(self.rfd)
+
+class AgentTransport(Transport):
+    """ Transport over the guest agent channel """
+    def __init__(self, client):
+        self.client = client
+
+    def execute(self, command, timeout=-1):
+        if timeout == -1:
+            timeout = None
+        return self.client.execute(command, timeout)
+
+    def parallelism(self):
+        return 32
+
+    def open_stream(self, command, mode='w'):
+        return AgentStream(self.client, self.client.spawn(command), mode)
+
+    def put(self, source, destination):
+        f = open(source, 'rb')
+        try:
+            return self.client.write(destination, f.read(),
+                                        mode=os.stat(source).st_mode & 0o777)
+        finally:
+            f.close()
+
+    def get(self, source, destination):
+        data = self.client.read(source)
+        f = open(destination, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return True
+
+class AgentStream:
+    """ Stream to or from a command spawned by the agent """
+    def __init__(self, client, handle, mode):
+        self.client = client
+        self.handle = handle
+        self.mode = mode
+
+    def write(self, data):
+        self.client.feed(self.handle, data)
+
+    def read(self, size=CHUNK_SIZE):
+        return self.client.output(self.handle, size)
+
+    def close(self):
+        return self.client.wait(self.handle)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,414 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Runner backends
+
+A backend knows how to start a guest with a given hypervisor: it builds
+the command line out of the disk, network interfaces and consoles of a
+Runner, spawns it and stops it. UMLBackend runs the User Mode Linux
+kernel of the profile; QEMUBackend runs qemu-system-i386 (TCG, so no
+KVM is needed) with virtio disk and network, writing into a throwaway
+snapshot or into a qcow2 overlay, never into the image itself.
+
+Both give the guest its root login on the first console (stdio, driven
+by pexpect) and the guest agent on a second one, attached to a pty of
+the host whose path is printed by the hypervisor (agent_pattern). A
+third console, a spare login on another pty (console_pattern), outlives
+the controller so a new one can attach to the guest (see journal.py).
+
+ReplayBackend runs no guest at all: it plays back a console session
+recorded by a Runner, so the code driving the console can be tried in
+milliseconds without a kernel or an image.
+"""
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+import pexpect
+from pexpect import fdpexpect
+
+from .agent import PTS_PATTERN
+from .resources import process_alive
+from .console import read_recording, RECORDING_SUFFIX
+
+UML = 1
+QEMU = 2
+REPLAY = 3
+
+QEMU_BINARY = 'qemu-system-i386'
+QEMU_IMG = 'qemu-img'
+# Serial line of the guest agent inside QEMU guests
+QEMU_AGENT_TTY = '/dev/ttyS1'
+
+def kill_process(pid, timeout=5):
+    ''' Terminate a process that is not a child of ours, killing it if
+    it does not end in timeout seconds '''
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            return
+        deadline = time.time() + timeout
+        while process_alive(pid) and time.time() < deadline:
+            time.sleep(0.1)
+        if not process_alive(pid):
+            return
+
+class Backend:
+    """ Starts and stops the guest of a Runner. Inheritors implement
+    binary(), options(), disk(), nic() and consoles() """
+    # Printed by the hypervisor with the pty of the agent console and
+    # the pty of the spare login console
+    agent_pattern = None
+    console_pattern = None
+    # True if the guest memory can be kept in a hugetlbfs mount
+    hugepages = False
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def binary(self):
+        raise NotImplementedError()
+
+    def options(self):
+        ''' Memory, kernel and other arguments '''
+        raise NotImplementedError()
+
+    def disk(self):
+        ''' Arguments attaching the image of the runner '''
+        raise NotImplementedError()
+
+    def nic(self, n, host):
+        ''' Arguments attaching the tap device of a networks.Host '''
+        raise NotImplementedError()
+
+    def consoles(self):
+        ''' Arguments for the login console (stdio) and the agent one '''
+        raise NotImplementedError()
+
+    def command(self):
+        ''' The whole command line, as a list '''
+        arguments = [self.binary()] + self.options() + self.disk()
+        for n in range(len(self.runner.hosts)):
+            arguments += self.nic(n, self.runner.hosts[n])
+        return arguments + self.consoles()
+
+    def spawn(self, **kwargs):
+        ''' Start the guest, return its pexpect.spawn '''
+        arguments = self.command()
+        if self.runner.isolation != None:
+            arguments = self.runner.isolation.wrap(arguments)
+        print("About to spawn this: %s" % " ".join(arguments))
+        return pexpect.spawn(arguments[0], arguments[1:], env=self.env(),
+                                                                **kwargs)
+
+    def env(self):
+        ''' Environment of the hypervisor '''
+        return dict(os.environ)
+
+    def kill(self):
+        ''' Stop the guest right now '''
+        sp = self.runner.sp
+        if self.runner.adopted:
+            # Not a child of ours, sp is just its spare console
+            kill_process(self.runner.pid)
+        elif sp != None and sp.isalive():
+            sp.terminate(force=True)
+
+    def shutdown(self, timeout=60):
+        ''' Halt the guest from inside, killing it if it does not end
+        in timeout seconds '''
+        sp = self.runner.sp
+        if sp == None or not self.runner.running():
+            return True
+        try:
+            self.runner.lock.acquire()
+            try:
+                self.runner.login(timeout)
+                sp.sendline('halt')
+                sp.expect(pexpect.EOF, timeout=timeout)
+            finally:
+                self.runner.lock.release()
+        except (pexpect.TIMEOUT, pexpect.EOF, OSError):
+            pass
+        self.kill()
+        return True
+
+class UMLBackend(Backend):
+    """ User Mode Linux, the kernel itself is the hypervisor
+
+    >>> import os, tempfile
+    >>> from .networks import Networks
+    >>> from .runner import Runner
+    >>> image = os.path.join(tempfile.mkdtemp(), 'web.img')
+    >>> open(image, 'w').close()
+    >>> nets = Networks()
+    >>> nets.register_network('lan').register_host('web', 'eth0')
+    ('192.168.0.1', 'de:ad:be:00:00:01')
+    >>> runner = Runner(image, UML, nets, 'web', kernelpath='linux',
+    ...                 cow='web.cow', kernel_args=['quiet'])
+    >>> command = ' '.join(runner.backend.command()).replace(image, 'web.img')
+    >>> print(command) # doctest: +NORMALIZE_WHITESPACE
+    ./linux mem=128M quiet ubd0=web.cow,web.img
+    eth0=tuntap,tap0,de:ad:be:00:00:01,192.168.0.2
+    con0=fd:0,fd:1 con1=pts con2=pts
+    """
+    agent_pattern = PTS_PATTERN
+    console_pattern = "Virtual console 2 assigned device '(/dev/pts/[0-9]+)'"
+
+    def binary(self):
+        return os.path.join('.', self.runner.kernelpath)
+
+    def env(self):
+        # UML keeps the memory of the guest in a file in TMPDIR
+        env = Backend.env(self)
+        if self.runner.memory_dir != None:
+            env['TMPDIR'] = self.runner.memory_dir
+        return env
+
+    def options(self):
+        r = ['mem=' + self.runner.memory]
+        if self.runner.hostfs != None:
+            r.append('hostfs=' + self.runner.hostfs.directory)
+        return r + self.runner.kernel_args
+
+    def disk(self):
+        if self.runner.cow != None:
+            # Created by UML on top of the image if it does not exist
+            return ['ubd0=' + self.runner.cow + ',' + self.runner.imagepath]
+        return ['ubd0=' + self.runner.imagepath]
+
+    def nic(self, n, host):
+        # ethN=tuntap,tap device,guest mac,host address
+        return [host.internaldevice + '=tuntap,' + host.tapdevice + ',' +
+                host.macaddress + ',' + str(host.tapaddress)]
+
+    def consoles(self):
+        # con1 for the guest agent (see agent.py), con2 (tty2) for the
+        # spare login
+        return ['con0=fd:0,fd:1', 'con1=pts', 'con2=pts']
+
+class QEMUBackend(Backend):
+    r""" QEMU in TCG mode with virtio devices. Disk writes go to a
+    snapshot discarded at exit (disk_mode 'snapshot') or to a qcow2
+    overlay on top of the image, kept between runs ('overlay', always
+    used when the runner has a copy on write file)
+
+    Its command line, and a stub binary standing in for QEMU that prints
+    the pty of the agent console and gives a login:
+
+    >>> import os, tempfile
+    >>> from .networks import Networks
+    >>> from .runner import Runner
+    >>> d = tempfile.mkdtemp()
+    >>> image = os.path.join(d, 'web.img')
+    >>> open(image, 'w').close()
+    >>> nets = Networks()
+    >>> nets.register_network('lan').register_host('web', 'eth0')
+    ('192.168.0.1', 'de:ad:be:00:00:01')
+    >>> runner = Runner(image, QEMU, nets, 'web', kernelpath='vmlinuz')
+    >>> command = ' '.join(runner.backend.command()).replace(image, 'web.img')
+    >>> print(command) # doctest: +NORMALIZE_WHITESPACE
+    qemu-system-i386 -machine accel=tcg -m 128M -nographic -no-reboot
+    -kernel vmlinuz -append root=/dev/vda rw console=ttyS0
+    cassilda.agent=/dev/ttyS1
+    -drive file=web.img,if=virtio,format=raw,snapshot=on
+    -netdev tap,id=net0,ifname=tap0,script=no,downscript=no
+    -device virtio-net-pci,netdev=net0,mac=de:ad:be:00:00:01
+    -serial mon:stdio -serial pty -serial pty
+    >>> stub = os.path.join(d, 'qemu')
+    >>> f = open(stub, 'w')
+    >>> _ = f.write('\n'.join(['#!/bin/sh',
+    ...     'echo "char device redirected to /dev/pts/7 (label serial1)"',
+    ...     'read line', "printf 'login: '", 'read user',
+    ...     "printf 'Password: '", 'read password', "printf 'web:~# '",
+    ...     'read command', '']))
+    >>> f.close()
+    >>> os.chmod(stub, 0o755)
+    >>> runner = Runner(image, QEMU, nets, 'web', kernelpath='vmlinuz',
+    ...         log_callback=lambda line: None,
+    ...         console_log=os.path.join(d, 'web.console.log'),
+    ...         backend_options={ 'binary': stub })
+    >>> runner.run(0) # doctest: +ELLIPSIS
+    About to spawn this: .../qemu -machine accel=tcg ... -serial pty
+    >>> runner.login(timeout=5)
+    True
+    >>> runner.grep(runner.backend.agent_pattern)
+    ['char device redirected to /dev/pts/7 (label serial1)']
+    >>> runner.shutdown()
+    True
+    """
+    agent_pattern = r'char device redirected to (/dev/pts/[0-9]+) ' + \
+                        r'\(label serial1\)'
+    console_pattern = r'char device redirected to (/dev/pts/[0-9]+) ' + \
+                        r'\(label serial2\)'
+    # -mem-path maps the memory file
+    hugepages = True
+
+    def __init__(self, runner, binary=QEMU_BINARY, disk_mode='snapshot',
+                    accel='tcg'):
+        Backend.__init__(self, runner)
+        if runner.hostfs != None:
+            raise ValueError("hostfs shares are only available with UML")
+        if disk_mode not in ('snapshot', 'overlay'):
+            raise ValueError("Unknown disk mode " + disk_mode)
+        self.qemu = binary
+        self.disk_mode = disk_mode
+        self.accel = accel
+
+    def binary(self):
+        return self.qemu
+
+    def options(self):
+        r = []
+        if self.runner.memory_dir != None:
+            r = ['-mem-path', self.runner.memory_dir]
+        return r + ['-machine', 'accel=' + self.accel,
+                '-m', self.runner.memory, '-nographic', '-no-reboot',
+                '-kernel', self.runner.kernelpath,
+                '-append', ' '.join(['root=/dev/vda', 'rw', 'console=ttyS0',
+                    'cassilda.agent=' + QEMU_AGENT_TTY] +
+                    self.runner.kernel_args)]
+
+    def overlay(self):
+        ''' Path of the qcow2 overlay (the copy on write file of the
+        runner if any), created the first time '''
+        path = self.runner.cow
+        if path == None:
+            path = self.runner.imagepath + '.qcow2'
+        if not os.path.exists(path):
+            subprocess.check_call([QEMU_IMG, 'create', '-q', '-f', 'qcow2',
+                '-b', os.path.abspath(self.runner.imagepath), '-F', 'raw',
+                path])
+        return path
+
+    def disk(self):
+        if self.disk_mode == 'overlay' or self.runner.cow != None:
+            return ['-drive', 'file=' + self.overlay() +
+                                            ',if=virtio,format=qcow2']
+        return ['-drive', 'file=' + self.runner.imagepath +
+                                    ',if=virtio,format=raw,snapshot=on']
+
+    def nic(self, n, host):
+        netdev = 'net' + str(n)
+        return ['-netdev', 'tap,id=' + netdev + ',ifname=' + host.tapdevice +
+                                            ',script=no,downscript=no',
+                '-device', 'virtio-net-pci,netdev=' + netdev + ',mac=' +
+                                                        host.macaddress]
+
+    def consoles(self):
+        # ttyS0 (with the monitor, ^A c) is the login console, ttyS1
+        # the guest agent one and ttyS2 the spare login
+        return ['-serial', 'mon:stdio', '-serial', 'pty', '-serial', 'pty']
+
+    def kill(self):
+        sp = self.runner.sp
+        if not self.runner.adopted and sp != None and sp.isalive():
+            # ^A x: quit through the multiplexed monitor
+            sp.send('\x01x')
+            try:
+                sp.expect(pexpect.EOF, timeout=5)
+            except pexpect.TIMEOUT:
+                pass
+        Backend.kill(self)
+
+class ReplayBackend(Backend):
+    r""" Plays back the recording of a console session (by default the
+    one of the hostname of the runner) through a socket driven by a
+    pexpect fdspawn. Output recorded after some input is only given
+    once the runner sent as many bytes (the same ones, if strict), and
+    the pauses of the session are kept divided by speed (0 for none)
+
+    A Runner logging in and running a command, with no guest behind:
+
+    >>> import os, tempfile
+    >>> from .console import ConsoleRecorder
+    >>> from .networks import Networks
+    >>> from .runner import Runner
+    >>> d = tempfile.mkdtemp()
+    >>> recorder = ConsoleRecorder(os.path.join(d, 'web' + RECORDING_SUFFIX))
+    >>> for direction, data in [('i', '\n'), ('o', 'web login: '),
+    ...         ('i', 'root\n'), ('o', 'Password: '),
+    ...         ('i', 'root\n'), ('o', 'web:~# '),
+    ...         ('i', "sh <<'CASSILDA-END-1'\nuname\nCASSILDA-END-1\n"
+    ...               "echo CASSILDA-END-1=$?\n"),
+    ...         ('o', 'Linux\r\nCASSILDA-END-1=0\r\nweb:~# ')]:
+    ...     recorder.record(direction, data)
+    >>> recorder.close()
+    >>> runner = Runner('web.img', REPLAY, Networks(), 'web',
+    ...         log_callback=lambda line: None,
+    ...         console_log=os.path.join(d, 'web.console.log'),
+    ...         backend_options={ 'recording': recorder.path,
+    ...                           'strict': True })
+    >>> runner.run(0)
+    >>> runner.login(timeout=5)
+    True
+    >>> runner.execute('uname', timeout=5) == (0, b'Linux\r\n')
+    True
+    >>> runner.shutdown()
+    True
+    """
+    def __init__(self, runner, recording=None, speed=0, strict=False):
+        Backend.__init__(self, runner)
+        if recording == None:
+            recording = runner.hostname + RECORDING_SUFFIX
+        self.recording = recording
+        self.events = read_recording(recording)
+        self.speed = speed
+        self.strict = strict
+        self.socket = None
+
+    def command(self):
+        return ['replay', self.recording]
+
+    def spawn(self, **kwargs):
+        ours, theirs = socket.socketpair()
+        self.socket = ours
+        player = threading.Thread(target=self.play, args=(theirs,))
+        player.daemon = True
+        player.start()
+        return fdpexpect.fdspawn(ours.fileno(), **kwargs)
+
+    def play(self, sock):
+        try:
+            sent = b''
+            received = b''
+            last = None
+            for t, direction, data in self.events:
+                if direction == 'i':
+                    sent += data
+                    continue
+                while len(received) < len(sent):
+                    chunk = sock.recv(8192)
+                    if not chunk:
+                        return
+                    received += chunk
+                if self.strict and received[:len(sent)] != sent:
+                    self.runner.log("Replay of " + self.recording +
+                        " stopped, the input differs from the recording")
+                    return
+                if self.speed and last != None and t > last:
+                    time.sleep((t - last) / float(self.speed))
+                last = t
+                sock.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def kill(self):
+        if self.socket != None:
+            self.socket.close()
+            self.socket = None
+
+    def shutdown(self, timeout=60):
+        self.kill()
+        return True
+
+BACKENDS = { UML: UMLBackend, QEMU: QEMUBackend, REPLAY: ReplayBackend }
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -2,6 +2,13 @@ __version__ = "cassilda 0.0.1"
 
 """
 Builder class module
+
+Images are built on a loop mount of the image file, or, with
+staging_dir set, in a directory tree under it (a tmpfs like /dev/shm
+for RAM speed): stage() points mountdir at the tree, the install and
+configuration steps run there without a loop device, and populate()
+writes the finished image in one sequential pass with mke2fs -d
+(e2fsprogs 1.43 or later), compact and unfragmented.
 """
 import subprocess
 import os
@@ -9,6 +16,10 @@ import tempfile
 import shutil
 import time
 
+from . import sparse
+from .checkpoint import Checkpoints
+from .store import temp_prefix, MOUNT_PREFIX, STAGE_PREFIX
+
 def print_line(line):
     '''Default Builder callback to print a line'''
     print(line)
@@ -24,9 +35,18 @@ class Builder:
         '''
         self.distribution = None
         self.mountdir = None
+        # Called with (mount point, image) when the image is mounted
+        # and (mount point, None) once unmounted (see journal.py)
+        self.mount_callback = None
+        # Directory the images are staged in (see stage()), and the
+        # image staged in mountdir
+        self.staging_dir = None
+        self.staged = None
         self.install_string = b''
         if log_callback == None:
             self.log_callback = print_line
+        else:
+            self.log_callback = log_callback
 
     def log(self, line):
         self.log_callback(line)
@@ -42,16 +62,48 @@ class Builder:
                                             stderr=subprocess.STDOUT)
         output, unused_err = process.communicate()
         retcode = process.poll()
+        self.install_string += output
         if retcode:
             cmd = arguments[0]
             raise subprocess.CalledProcessError(retcode, cmd)
 
-        self.install_string += output
-
     def install_image(self, packages):
         ''' To be implemented only by inheritors '''
         raise NotImplementedError()
 
+    def phases(self, packages, imagename, repository):
+        ''' Return the (name, key, function) install phases, the first
+        one bootstrapping the bare distribution. To be implemented
+        only by inheritors '''
+        raise NotImplementedError()
+
+    def run_phases(self, imagename, phases):
+        ''' Run the (name, key, function) phases of an install, saving a
+        checkpoint of the image after each one. Phases already covered
+        by the checkpoints of a previous (failed) attempt are skipped.
+        Mounts are always cleaned up after a phase, even if it fails '''
+        checkpoints = Checkpoints(imagename, self)
+        start = checkpoints.restore(phases)
+        for name, key, function in phases[start:]:
+            self.log("Running install phase " + name)
+            try:
+                r = function()
+            finally:
+                self.cleanup_mounts()
+            if r == False:
+                return False
+            checkpoints.save(name, key)
+        return True
+
+    def resumable(self, imagename, phases):
+        ''' True if a previous install of imagename left checkpoints
+        that can be resumed '''
+        return Checkpoints(imagename, self).resumable(phases) > 0
+
+    def discard_checkpoints(self, imagename):
+        ''' Remove the checkpoints of an image once it is fully built '''
+        Checkpoints(imagename, self).clear()
+
     def install(self, packages, basename, imagename, repository):
         ''' Install wrapper that search in the cache before calling (or not)
         the install_image of the builder '''
@@ -60,9 +112,27 @@ class Builder:
         else:
             self.log("Copying " + basename + " to " + imagename +
                                             " (not first install)") 
-            self.call(["cp", "--sparse=always", basename, imagename])
+            self.copy_image(basename, imagename)
             return True
 
+    def copy_image(self, source, destination):
+        ''' Copy an image keeping it sparse (reflinking it if the
+        filesystem allows), logging progress and throughput '''
+        self.install_string += ('\n Builder.copy_image(): ' + source +
+                                    ' ' + destination + '\n').encode()
+        last = [time.time()]
+        def progress(copied, total):
+            now = time.time()
+            if now - last[0] >= 1 or copied == total:
+                last[0] = now
+                self.log("Copied %d of %d MB" % (copied >> 20, total >> 20))
+        method, copied, elapsed = sparse.copy_file(source, destination,
+                                                            progress)
+        rate = (copied >> 20) / max(elapsed, 0.001)
+        self.log("Copied %s to %s via %s in %.3fs (%d MB, %.1f MB/s)" %
+            (source, destination, method, elapsed, copied >> 20, rate))
+        return method
+
     def create_image(self, imagepath, imagesize):
         try:
             f = open(imagepath, 'wb')
@@ -87,8 +157,15 @@ class Builder:
             self.log("Unknown error making filesystem")
             return False
 
+    def mounted(self, imagepath):
+        if self.mount_callback != None:
+            self.mount_callback(self.mountdir, imagepath)
+
     def mount_filesystem(self, imagepath):
-        self.mountdir = tempfile.mkdtemp()
+        if self.staged == imagepath:
+            return True
+        self.mountdir = tempfile.mkdtemp(prefix=temp_prefix(MOUNT_PREFIX))
+        self.mounted(imagepath)
         try:
             self.call(["mount", "-o", "loop", imagepath, self.mountdir])
         except:
@@ -98,6 +175,8 @@ class Builder:
         return True
 
     def umount_filesystem(self):
+        if self.staged != None:
+            return True
         try:
             self.call(["umount", self.mountdir])
         except subprocess.CalledProcessError:
@@ -114,9 +193,53 @@ class Builder:
         if os.path.ismount(self.mountdir):
             return False
         os.rmdir(self.mountdir)
+        self.mounted(None)
         self.mountdir = None
         return True
 
+    def stage(self, imagepath):
+        ''' Build imagepath in a new directory under staging_dir until
+        populate() writes it: mounting it only points mountdir there '''
+        self.mountdir = tempfile.mkdtemp(prefix=temp_prefix(STAGE_PREFIX),
+                                            dir=self.staging_dir)
+        self.staged = imagepath
+        self.log("Staging " + imagepath + " in " + self.mountdir)
+
+    def populate(self, size):
+        ''' Write the staged tree to a new filesystem image of size
+        bytes, in one pass, and throw the tree away. The image is only
+        replaced once it is complete '''
+        imagepath = self.staged
+        temporary = imagepath + '.populate'
+        self.umount_sys_and_dev()
+        try:
+            self.create_image(temporary, size)
+            self.log("Making filesystem... in " + imagepath + " from " +
+                                                            self.mountdir)
+            self.call(["mke2fs", "-q", "-F", "-d", self.mountdir, temporary])
+            os.rename(temporary, imagepath)
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self.unstage()
+        return True
+
+    def unstage(self):
+        ''' Throw the staged tree away, if any '''
+        if self.staged == None:
+            return True
+        self.umount_sys_and_dev()
+        for d in ["/sys/", "/proc/"]:
+            # Never remove files through a bind mount of the host
+            if os.path.ismount(self.mountdir + d):
+                raise Exception("Can not remove " + self.mountdir +
+                                    ", " + d + " is still mounted")
+        shutil.rmtree(self.mountdir)
+        self.mountdir = None
+        self.staged = None
+        return True
+
     def create_dir(self, path):
         os.makedirs(self.mountdir + path)
         return True
@@ -167,12 +290,28 @@ class Builder:
     def umount_sys_and_dev(self):
         try:
             self.log("Umounting sys and proc")
-            self.call(["umount", self.mountdir + "/sys/"])
-            self.call(["umount", self.mountdir + "/proc/"])
+            for d in ["/sys/", "/proc/"]:
+                if os.path.ismount(self.mountdir + d):
+                    self.call(["umount", self.mountdir + d])
         except:
             return False
         return True
 
+    def cleanup_mounts(self):
+        ''' Unmount whatever is still mounted from the image (after a
+        failure in the middle of an install, for example) '''
+        if self.mountdir == None:
+            return True
+        self.umount_sys_and_dev()
+        if self.staged != None:
+            return True
+        if os.path.ismount(self.mountdir):
+            return self.umount_filesystem()
+        os.rmdir(self.mountdir)
+        self.mounted(None)
+        self.mountdir = None
+        return True
+
     def chmod(self, path, mode):
         ''' chmod a file into the image (mount first) '''
         os.chmod(self.mountdir + path, mode)
@@ -12,19 +12,46 @@ import tempfile
 import urllib
 import bz2
 import inspect
+import subprocess
+import threading
 
 from .image import Image
+from .manifest import Manifest
+from .plan import Planner
+from .orchestrator import Orchestrator, BOOT_TIMEOUT
+from .replicas import ReplicaGroup, replica_name, kernel_args
+from .scheduler import RunScheduler, MAX_BOOTING
+from .isolation import CpuAllocator, Isolation
+from .hostfs import HostfsExport
+from .journal import Journal
+from .testcache import TestCache, test_key, TEST_COW_SUFFIX
+from .store import ArtefactStore
+from .telemetry import Sampler, INTERVAL as TELEMETRY_INTERVAL
+from .console import RECORDING_SUFFIX
+from .resources import parse_size
+from . import sparse
+from .backends import kill_process
+from . import transfer
 from .builder import Builder
 from .debian_squeeze_builder import debian_squeeze_Builder
-from .networks import Networks
+from .networks import Networks, DEFAULT_PREFIXLEN
+from . import sidecar
 from .firewall import Firewall
 from .runner import *
 
+# Build steps run after the install, in order, each one recorded
+# in the manifest of the image
+CONFIGURATION_STEPS = ['hostname', 'network', 'mac', 'repository', 'hostfs']
+
+# Seconds an installer script may take (apt-get...) in the console
+INSTALL_TIMEOUT = 1800
+
 # Convenient classes to handle YAML document types
 class ImageLoader(yaml.YAMLObject):
     yaml_tag = u'!image'
     def __init__(self, name, size, memory, networks, builder, packages,
-            installer, test):
+            installer, test, depends, hostfs, replicas, cpus, cgroup,
+            memory_dir):
         args, _, _, values = inspect.getargvalues(inspect.currentframe())
         for i in args:
             self.__dict__[i] = values[i]
@@ -74,7 +101,8 @@ class IncludeLoader(yaml.YAMLObject):
 # class Installer(name, description, install, uninstall, run, stop)
 class InstallerLoader(yaml.YAMLObject):
     yaml_tag = u'!installer'
-    def __init__(self, name, description, install, uninstall, run, stop):
+    def __init__(self, name, description, install, uninstall, run, stop,
+            depends):
         args, _, _, values = inspect.getargvalues(inspect.currentframe())
         for i in args:
             self.__dict__[i] = values[i]
@@ -85,36 +113,44 @@ class NetworksLoader(yaml.YAMLObject):
         self.networks = networks
 
 class Installer():
-    def __init__(self, image, name, description, install, uninstall, run, stop):
+    def __init__(self, image, name, description, install, uninstall, run, stop,
+            depends = None):
         args, _, _, values = inspect.getargvalues(inspect.currentframe())
         for i in args:
             self.__dict__[i] = values[i]
+        if self.depends == None:
+            self.depends = []
         print ('Installer.name ' + name)
         print ('Installer.description ' + description)
         print ('Installer.install ' + str(install))
         print ('Installer.uninstall ' + str(uninstall))
         print ('Installer.run ' + str(run))
         print ('Installer.stop ' + str(stop))
+        print ('Installer.depends ' + str(self.depends))
 
     def login(self):
-        if self.logged:
-            return True
-        self.image.sp.sendline('')
-        self.image.sp.expect('login: ')
-        self.image.sp.sendline('root')
-        self.image.sp.expect('Password: ')
-        self.image.sp.sendline('root')
-        self.image.sp.expect('# ')
-        self.logged = True
+        return self.image.runner.login()
 
     def logout(self):
-        if not self.logged:
-            return True
-        self.image.sp.sendline('')
-        self.image.sp.expect('# ')
-        self.image.sp.sendline('logout')
-        self.image.sp.expect('login: ')
-        self.logged = False
+        return self.image.runner.logout()
+
+    def execute(self, code, timeout=INSTALL_TIMEOUT):
+        """ Run one of the processed scripts (install, run...) of the
+        installer in the console of the running image """
+        runner = self.image.runner
+        for t in code:
+            pattern, t_timeout = t['expect-before']
+            if pattern != None:
+                runner.expect(pattern, t_timeout)
+            if t['call']:
+                status, output = runner.call(t['call'], timeout)
+                if status != 0:
+                    raise Exception('Installer ' + self.name + ' failed in ' +
+                        self.image.name + ' with status ' + str(status))
+            pattern, t_timeout = t['expect-after']
+            if pattern != None:
+                runner.expect(pattern, t_timeout)
+        return True
 
     def halt(self):
         self.login()
@@ -128,25 +164,134 @@ class Cassilda:
         """ Cassilda constructor. Path must point to a valid 
         cassilda configuration file in YAML format"""
         self.d = None;
-        self.networks = Networks()
         self.images = []
         self.installers = []
         self.installer = []
+        # How the images are run (see backends.py) unless run() is told
+        # otherwise, and the kernel booted by QEMU
+        self.backend = UML
+        self.backend_options = {}
+        # Record the console sessions of the guests, to be played back
+        # by the REPLAY backend
+        self.record = False
+        self.kernelurl = None
+        self.qemukernelurl = None
+        # Default directory for the memory of the guests (see
+        # Runner.memory_dir)
+        self.memory_dir = None
+        # Directory the images are staged in while they are built, to
+        # be written at once by mke2fs -d (see builder.py), None to build
+        # them on a loop mount
+        self.staging_dir = None
+        # Address pools of the networks and their prefix length (see
+        # networks.py), and the networks of each image, registered once
+        # every document is parsed
+        self.pools = None
+        self.disk_budget = None
+        # Seconds between the samples of start_telemetry()
+        self.telemetry_interval = TELEMETRY_INTERVAL
+        self.prefixlen = DEFAULT_PREFIXLEN
+        self.image_networks = []
         f = open(path, 'r')
         s = f.read()
         f.close()
         includepaths.append(os.path.dirname(path) + '/')
         for data in yaml.load_all(s):
             self.parse_yaml_doc(data, includepaths)
+        # What runs outside of this process (see journal.py)
+        self.journal = Journal(os.path.splitext(os.path.basename(path))[0] +
+                                                                '.session')
+        # Addresses given in previous sessions are kept
+        self.networks_state = os.path.splitext(os.path.basename(path))[0] + \
+                                                                '.networks'
+        self.load_networks()
+        # Results of the tests of the images (see testcache.py)
+        self.test_cache = TestCache(
+                os.path.splitext(os.path.basename(path))[0] + '.tests')
+        kernels = [self.__get_kernel_file_name(url)[1] for url in
+                        (self.kernelurl, self.qemukernelurl) if url != None]
+        planner = Planner(self)
+        layers = []
+        for i in self.images:
+            layers.extend([i.basename, planner.base_image(i)])
+        self.store = ArtefactStore('.', kernels,
+                                [i.imagename for i in self.images], layers)
         self.parse_installers()
-        self.firewall = Firewall(self.networks)
+        self.orchestrator = None
+        # ReplicaGroup of the images running replicated, by image name
+        self.replicas = {}
+        self.cpus = CpuAllocator()
+        self.firewall = Firewall(self.networks, self.firewall_pairs)
+        # Sampler started by start_telemetry()
+        self.telemetry = None
         return None
 
+    def load_networks(self):
+        """ Networks of the session saved last time (if their pools did
+            not change), brought in line with the profile: the hosts of
+            the images are registered, eth0, eth1... in the order of the
+            networks of the image, and the hosts and networks it no
+            longer declares are dropped. The hosts of live guests (see
+            journal.py) are kept as they are until the guests stop """
+        self.networks = Networks(self.pools, self.prefixlen)
+        self.networks_lock = threading.Lock()
+        live = [name for name, entry in self.journal.guests().items()
+                    if self.journal.guest_alive(entry)]
+        declared = dict(self.image_networks)
+        def reconcile(networks):
+            for net in list(networks.networks):
+                for host in net.get_hosts():
+                    if host.name in live:
+                        continue
+                    nets = declared.get(host.name, [])
+                    if net.name not in nets or host.internaldevice != \
+                                        "eth" + str(nets.index(net.name)):
+                        net.unregister_host(host.name)
+                if net.get_hosts() == [] and \
+                        [n for n in declared.values() if net.name in n] == []:
+                    networks.release_network(net.name)
+            for name, nets in self.image_networks:
+                devn = 0
+                for n in nets:
+                    net = networks[n]
+                    if net == None:
+                        net = networks.register_network(n)
+                    if net.get_host_by_name(name) == None:
+                        net.register_host(name, "eth" + str(devn))
+                    devn += 1
+        self.update_networks(reconcile)
+
+    def update_networks(self, function):
+        """ Call function(networks) on the networks as saved now (by this
+            or any other controller of the profile) and save them,
+            holding the lock of the sidecar. Return what function
+            returned. The networks saved with other pools are replaced
+            by the ones of this controller """
+        self.networks_lock.acquire()
+        try:
+            fd = sidecar.lock(self.networks_state)
+            try:
+                state = sidecar.load(self.networks_state)
+                if state != None and state['prefixlen'] == self.prefixlen \
+                        and state['pools'] == self.networks.to_dict()['pools']:
+                    self.networks.restore(state)
+                r = function(self.networks)
+                sidecar.save(self.networks_state, self.networks.to_dict())
+                return r
+            finally:
+                sidecar.unlock(fd)
+        finally:
+            self.networks_lock.release()
+
+    def release_replica(self, name):
+        """ Give back the addresses and tap devices of a replica """
+        self.update_networks(lambda networks: networks.unregister_host(name))
+
     def parse_installers(self):
         for i in self.images:
             if i.install == None:
                 print('Note that image ' + i.name + 'dont have installers')
-                return
+                continue
             for n in i.install:
                 # print('image ' + i.name + ' installer ' + n)
                 il = self.__get_installer_loader_from_name(n)
@@ -161,7 +306,8 @@ class Cassilda:
     def process_installer(self, image, il):
         installer = Installer(image, il.name, il.description, 
             self.process_code(il.install), self.process_code(il.uninstall),
-            self.process_code(il.run), self.process_code(il.stop))
+            self.process_code(il.run), self.process_code(il.stop),
+            getattr(il, 'depends', None))
         return installer
 
     # Return an array containing pexpect 'expect() and call()'
@@ -181,25 +327,33 @@ class Cassilda:
                 dir(data)
                 im = Image(data.name, data.size, data.memory,
                                 data.builder, data.packages,
-                                data.install)
-                # Set networks
-                devn = 0
-                try:
-                    for n in data.networks:
-                        net = self.networks[n]
-                        if net == None:
-                            net = self.networks.register_network(n)
-                        net.register_host(im.name, "eth" + str(devn))
-                        devn += 1
-                except KeyError:
+                                data.install, getattr(data, 'depends', None),
+                                getattr(data, 'hostfs', None),
+                                getattr(data, 'replicas', None),
+                                getattr(data, 'cpus', None),
+                                getattr(data, 'cgroup', None),
+                                getattr(data, 'memory_dir', None),
+                                getattr(data, 'test', None))
+                # Networks are set once the pools are known
+                networks = getattr(data, 'networks', None)
+                if networks == None:
                     # No networks configured for this image
                     print("No networks found in image ", im.name)
-                except:
-                    raise
+                    networks = []
+                self.image_networks.append((im.name, networks))
                 self.images.append(im)
             elif data.__class__ == GeneralLoader:
                 # print("GeneralLoader.repository: %s" % data.repository)
                 self.kernelurl = data.kernel 
+                self.qemukernelurl = getattr(data, 'qemu_kernel', None)
+                self.memory_dir = getattr(data, 'memory_dir', None)
+                self.staging_dir = getattr(data, 'staging_dir', None)
+                self.pools = getattr(data, 'address_pools', None)
+                self.disk_budget = getattr(data, 'disk_budget', None)
+                self.telemetry_interval = getattr(data, 'telemetry_interval',
+                                                        TELEMETRY_INTERVAL)
+                self.prefixlen = getattr(data, 'prefixlen',
+                                                    DEFAULT_PREFIXLEN)
                 self.repository = data.repository
             elif data.__class__ == DocumentationLoader:
                 self.documentation = data.markup
@@ -215,52 +369,166 @@ class Cassilda:
                 self.networks.append(data)
             """
 
-    def build_all(self):
-        """ Install all images in the .cassilda """
+    def build_all(self, parallel=False, limits=None):
+        """ Install all images in the .cassilda. If parallel is True,
+            the build plan is run with at most limits[resource]
+            operations using each resource class at once """
+        if parallel:
+            if not os.geteuid() == 0:
+                raise Exception("Only root can run this (yet)")
+            return self.plan().execute(limits)
         for i in self.images:
             self.build(i.name)
 
-    def build(self, name):
+    def plan(self, names=None, force=False):
+        """ Return the build plan (see plan.Plan) of the named images,
+            all of them if names is None """
+        return Planner(self).plan(names, force)
+
+    def build(self, name, force=False):
         """ Build and configure networks/etc for the image referenced
-            by name from the cassilda configuration file"""
+            by name from the cassilda configuration file.
+            If the image was already built, only the steps whose inputs
+            changed since (according to its manifest) are run again,
+            unless force is True"""
         if not os.geteuid() == 0:
             raise Exception("Only root can run this (yet)")
         i = self[name]
         if i == None:
             raise Exception('Image ' + name + ' is not in the profile')
-        print("install_and_configure: Building image ", i.name)
+        manifest = Manifest(i.imagename)
+        steps = self.build_steps(i)
         # builder = Builder.build(i, self.repository)
         builder = debian_squeeze_Builder() 
         if builder == None:
             return False
-        b = builder.build(i, self.repository, i.size)
-        if b == None:
-            return False
-        for n in self.networks.get_networks_by_host(name):
-            h = n.get_host_by_name(name)
+        builder.mount_callback = self.journal_mount
+        builder.staging_dir = self.staging_dir
+        try:
+            if (force or not i.already_installed() or
+                    manifest.changed('install', steps['install'])):
+                print("install_and_configure: Building image ", i.name)
+                manifest.clear()
+                if force:
+                    builder.discard_checkpoints(i.imagename)
+                # Installed and configured in the staging directory,
+                # unless it is copied from the base image
+                if self.staging_dir != None and \
+                        not os.path.exists(i.basename):
+                    builder.stage(i.imagename)
+                b = builder.build(i, self.repository, i.size)
+                if b == None:
+                    return False
+                manifest.record('install', steps['install'])
+                manifest.record('hostname', steps['hostname'])
+            else:
+                print("install_and_configure: Reconfiguring image ", i.name)
+            for step in CONFIGURATION_STEPS:
+                if manifest.changed(step, steps[step]):
+                    self.configure(builder, i, manifest, step, steps[step])
+            if builder.staged != None:
+                builder.populate(i.size)
+        except:
+            if builder.staged != None:
+                # The image was not written, the steps recorded are not
+                # in it
+                manifest.clear()
+            raise
+        finally:
+            builder.unstage()
+        builder.discard_checkpoints(i.imagename)
+        self.store.touch(i.imagename, 'image')
+        return True
+
+    def configure(self, builder, image, manifest, step, inputs):
+        """ Run one of the CONFIGURATION_STEPS on the image and record
+            its inputs in the manifest """
+        if step == 'hostname':
+            builder.set_hostname(image.name, image.imagename)
+        elif step == 'network':
+            for device, address, netmask, network, broadcast, gateway in \
+                    inputs:
+                print("Setting up host ", image.name, " with address "
+                    , address," into network ", network)
+                builder.set_network(image.imagename, address, netmask,
+                        network, broadcast, gateway, device)
+        elif step == 'mac':
+            overwrite = True
+            for device, macaddress in inputs:
+                print("Setting up mac address of host device ",
+                        device, "with mac address ", macaddress)
+                builder.set_mac_address(image.imagename, device, macaddress,
+                        overwrite)
+                overwrite = False
+        elif step == 'repository':
+            previous = manifest.get('repository')
+            if previous == None or previous == []:
+                previous = ["127.0.0.1"]
+            if inputs != []:
+                builder.set_repository(image.imagename, inputs[0],
+                        previous[0])
+        elif step == 'hostfs':
+            builder.set_hostfs(image.imagename, inputs)
+        else:
+            raise ValueError("Unknown configuration step " + step)
+        manifest.record(step, inputs)
+
+    def build_steps(self, image):
+        """ Return a dictionary with the inputs of every build step of
+            an image, as stored in its manifest """
+        steps = {}
+        steps['install'] = [image.distribution, image.size,
+                image.packages, self.repository]
+        steps['hostname'] = [image.name]
+        steps['network'] = []
+        steps['mac'] = []
+        for n in self.networks.get_networks_by_host(image.name):
+            h = n.get_host_by_name(image.name)
             a = n.get_addresses()
-            print("Setting up host ", name, " with address "
-                , h.address," into network ", a)
-            builder.set_network(i.imagename, str(h.address),
+            steps['network'].append([h.internaldevice, str(h.address),
                     a['netmask'], a['network'], a['broadcast'],
-                    str(h.tapaddress), h.internaldevice)
-            print("Setting up mac address of host device ",
-                    h.internaldevice, "with mac address ",
-                    h.macaddress)
-            builder.set_mac_address(i.imagename, h.internaldevice,
-                    h.macaddress)
+                    str(h.tapaddress)])
+            steps['mac'].append([h.internaldevice, str(h.macaddress)])
         # Set sources.list with the ip of the first network
         # found for the image
-        h = self.networks.get_networks_by_host(name)[0].get_host_by_name(name)
-        builder.set_repository(i.imagename, str(h.tapaddress))
+        steps['repository'] = []
+        hosts = self.networks.get_hosts_by_name(image.name)
+        if hosts != []:
+            steps['repository'].append(str(hosts[0].tapaddress))
+        steps['hostfs'] = image.hostfs_mounts()
+        return steps
 
     def install(self, name):
+        """ Run the image (and the images it depends on) and its
+            installers, see install_all() """
         i = self[name]
         if i == None:
             raise Exception('Image ' + name + ' is not in the profile')
-        self.run(name)
-        for ins in i.installers:
-            print('install: Installing ' + ins.name + ' into ' + i.name)
+        return self.install_all([name])
+
+    def install_all(self, names=None):
+        """ Run the named images (all if None) and their installers,
+            independent ones in parallel, each one as soon as the
+            installers and images it depends on are ready """
+        if self.orchestrator == None:
+            self.orchestrator = Orchestrator(self)
+        return self.orchestrator.install(names)
+
+    def teardown(self):
+        """ Run the stop scripts of the installed installers, in the
+            reverse order they were made ready """
+        if self.orchestrator != None:
+            self.orchestrator.teardown()
+
+    def get_installer_by_name(self, installer_name):
+        """ Return the (image, installer) pairs for every image
+            using the named installer """
+        r = []
+        for i in self.images:
+            for ins in i.installers:
+                if ins.name == installer_name:
+                    r.append((i, ins))
+        return r
 
     def __get_installer_loader_from_name(self, installer_name):
         for i in self.installers:
@@ -289,7 +557,7 @@ class Cassilda:
         return compressed, path
 
     def __download_kernel(self, kernel_url):
-        """ Download and uncompress the UML kernel configured in the
+        """ Download and uncompress a kernel configured in the
             .cassilda profile """
         # get the kernel file name from the url
         compressed, path = self.__get_kernel_file_name(kernel_url)
@@ -315,55 +583,482 @@ class Cassilda:
         t.write(bin)
         t.close
 
-    def run(self, imagename, termnum=0):
-        """ Setup firewall rules and call runner object to run the image """
+    def __kernel_path(self, backend):
+        """ Path of the kernel run by backend, downloaded if needed """
+        kernelurl = self.kernelurl
+        if backend == QEMU:
+            kernelurl = self.qemukernelurl
+            if kernelurl == None:
+                raise ValueError("No qemu_kernel in the profile")
+        c, kernelpath = self.__get_kernel_file_name(kernelurl)
+
+        if not os.path.exists(kernelpath):
+            self.__download_kernel(kernelurl)
+        os.chmod(kernelpath, 0o755)
+        self.store.touch(kernelpath, 'kernel')
+        return kernelpath
+
+    def __runner(self, image, hostname, backend, backend_options,
+                            cow = None, kernel_args = None, cpus = None):
+        """ The runner of the guest hostname of image, its cpus taken
+            from the image settings unless given """
+        if backend == None:
+            backend = self.backend
+        if backend_options == None:
+            backend_options = self.backend_options
+        if cpus == None:
+            cpus = image.cpus
+        memory_dir = image.memory_dir
+        if memory_dir == None:
+            memory_dir = self.memory_dir
+        isolation = Isolation(hostname,
+                self.cpus.allocate(hostname, cpus), image.cgroup)
+        self.store.touch(image.imagename, 'image')
+        record = None
+        if self.record:
+            record = hostname + RECORDING_SUFFIX
+        kernelpath = None
+        if backend != REPLAY:
+            kernelpath = self.__kernel_path(backend)
+        return Runner(image.imagename, backend, self.networks,
+            hostname, kernelpath, memory = image.memory,
+            hostfs = image.hostfs_export(hostname),
+            backend_options = backend_options,
+            cow = cow, kernel_args = kernel_args, isolation = isolation,
+            memory_dir = memory_dir, journal_callback =
+                lambda runner: self.journal_guest(image, hostname, runner),
+            record = record)
+
+    def __start(self, image, hostname, termnum, backend, backend_options,
+                                            cow = None, kernel_args = None):
+        """ Setup the firewall rules of hostname and start a runner """
+        runner = self.__runner(image, hostname, backend, backend_options,
+                                                        cow, kernel_args)
+        for net in self.networks.get_networks_by_host(hostname):
+            self.firewall.set_iface(net.name, hostname)
+        try:
+            runner.run(termnum)
+            # time.sleep(20)
+        except:
+            if runner.hostfs != None:
+                runner.hostfs.cleanup()
+            for net in self.networks.get_networks_by_host(hostname):
+                self.firewall.unset_iface(net.name, hostname)
+            self.cpus.release(hostname)
+            self.journal.forget_guest(hostname)
+            raise
+        return runner
+
+    def run(self, imagename, termnum=0, backend=None, backend_options=None,
+                                                    count=None, cow=None):
+        """ Setup firewall rules and call runner object to run the image,
+            with the given backend (UML, QEMU) or the default one,
+            writing into the copy on write file cow if given. With
+            count (or the replicas of the image) above 1 start as many
+            replicas and return their ReplicaGroup """
         if not os.geteuid() == 0:
             raise Exception("Only root can run this (yet)")
         image = self[imagename]
         if image == None:
             raise ValueError("No image with name " + imagename + " found")
+        if count == None:
+            count = image.replicas
+        if count > 1:
+            return self.run_replicas(imagename, count, backend,
+                                                        backend_options)
+        image.runner = self.__start(image, imagename, termnum, backend,
+                                                    backend_options, cow)
 
-        c, kernelpath = self.__get_kernel_file_name(self.kernelurl)
-
-        if not os.path.exists(kernelpath):
-            self.__download_kernel(self.kernelurl)
-        os.chmod(kernelpath, 0o755)
-        runner = Runner(image.imagename, UML, self.networks,
-            imagename, kernelpath, memory = image.memory)
-        for net in self.networks.get_networks_by_host(image.name):
-            self.firewall.set_iface(net.name, image.name)
+    def run_replicas(self, imagename, count, backend=None,
+                                                backend_options=None):
+        """ Start count replicas of an image, each one writing into its
+            own copy on write disk, with its own hosts in the networks of
+            the image and hostname. Return their ReplicaGroup """
+        image = self[imagename]
+        if image == None:
+            raise ValueError("No image with name " + imagename + " found")
+        if imagename in self.replicas:
+            raise Exception("Replicas of " + imagename + " already running")
+        group = ReplicaGroup(self, image)
         try:
-            runner.run(termnum)
-            # time.sleep(20)
+            for n in range(1, count + 1):
+                name = replica_name(imagename, n)
+                hosts = self.update_networks(lambda networks:
+                                networks.register_replica(imagename, name))
+                # Stale copy on write files do not match the image
+                cow = name + ".cow"
+                if os.path.exists(cow):
+                    os.remove(cow)
+                try:
+                    runner = self.__start(image, name, n, backend,
+                        backend_options, cow, kernel_args(name, hosts))
+                except:
+                    self.release_replica(name)
+                    raise
+                group.add(name, runner)
         except:
-            for net in self.networks.get_networks_by_host(image.name):
-                self.firewall.unset_iface(net.name, image.name)
+            group.teardown()
             raise
-        image.runner = runner
+        self.replicas[imagename] = group
+        return group
 
     def interact(self, imagename):
         if not self.running(imagename):
-            print 'Image is not running, nowhere to attach to'
+            print('Image is not running, nowhere to attach to')
         else:
             image = self[imagename]
             image.runner.interact()
  
     def running(self, imagename):
         image = self[imagename]
+        if image.runner == None:
+            return False
         return image.runner.running()
 
-    def run_all(self):
-        t = 0
-        """ Run all images in the .cas """
-        for i in self.images:
-            self.run(i.name, termnum=t)
-            t += 1
+    def __get_running_runner(self, imagename):
+        image = self[imagename]
+        if image == None:
+            raise ValueError("No image with name " + imagename + " found")
+        if not self.running(imagename):
+            raise Exception('Image ' + imagename + ' is not running')
+        return image.runner
+
+    def push(self, imagename, source, destination):
+        """ Stream the local file or directory source into the
+            directory destination of a running image """
+        return self.push_all([imagename], source, destination)
+
+    def push_all(self, imagenames, source, destination):
+        """ Stream source into destination in all the named running
+            images at once (all the running ones if imagenames is None),
+            producing the archive only once """
+        if imagenames == None:
+            imagenames = [i.name for i in self.images
+                            if self.running(i.name)]
+        transports = [self.__get_running_runner(n).transport()
+                        for n in imagenames]
+        return transfer.push(transports, source, destination)
+
+    def pull(self, imagename, source, destination):
+        """ Stream the file or directory source of a running image
+            into the local directory destination """
+        runner = self.__get_running_runner(imagename)
+        return transfer.pull(runner.transport(), source, destination)
+
+    def run_all(self, wave_callback=None, memory_budget=None,
+                    cpu_budget=None, max_booting=MAX_BOOTING):
+        """ Run all images in the .cas, staggering the boots within the
+            memory and cpu budgets of the host, in waves if they do not
+            fit at once (see scheduler.py) """
+        scheduler = RunScheduler(self, memory_budget, cpu_budget,
+                                                        max_booting)
+        return scheduler.run(None, wave_callback)
+
+    def test_keys(self, image, backend=None):
+        """ Cache keys of the tests of a built image, by test name """
+        if backend == None:
+            backend = self.backend
+        digest = image.digest()
+        if digest == None:
+            raise Exception('Image ' + image.name + ' is not built')
+        kernel = sparse.digest(self.__kernel_path(backend))
+        installers = [[i.name, i.install, i.run] for i in image.installers]
+        depends = []
+        for name in image.depends:
+            other = self[name]
+            if other == None:
+                raise Exception('Image ' + image.name + ' depends on ' +
+                    name + ', that is not in the profile')
+            depends.append([name, other.digest()])
+        r = {}
+        for test, script in image.tests:
+            r[test] = test_key(digest, script, kernel, installers, depends)
+        return r
+
+    def test(self, imagename, force=False):
+        """ Run the tests of an image, with its installers (and the
+            images it depends on) installed. Tests that passed before
+            with the same image, script, kernel, installers and
+            dependencies are not run again unless force is True.
+            Return (test, exit status, output, cached) for each one. The
+            image is only started if some test has to run, and stopped
+            afterwards if it was not running. The images started boot on
+            a throwaway copy on write file, so the installers and the
+            tests leave them (and the cache keys) unchanged """
+        image = self[imagename]
+        if image == None:
+            raise ValueError("No image with name " + imagename + " found")
+        keys = self.test_keys(image)
+        results = {}
+        if not force:
+            for test, script in image.tests:
+                cached = self.test_cache.get(image.name, test, keys[test])
+                if cached != None:
+                    results[test] = cached + (True,)
+        pending = [(t, s) for t, s in image.tests if t not in results]
+        if pending != []:
+            running = [i.name for i in self.images if self.running(i.name)]
+            started = [image] + [op.image for op in
+                    Orchestrator(self).plan([imagename]).operations]
+            cows = []
+            try:
+                for i in started:
+                    if self.running(i.name):
+                        continue
+                    cow = i.name + TEST_COW_SUFFIX
+                    if os.path.exists(cow):
+                        os.remove(cow)
+                    cows.append(cow)
+                    self.run(i.name, count=1, cow=cow)
+                self.install(imagename)
+                image.runner.login(BOOT_TIMEOUT)
+                for test, script in pending:
+                    print('test: Running ' + test + ' in ' + imagename)
+                    start = time.time()
+                    status, output = image.runner.execute(script,
+                                                        INSTALL_TIMEOUT)
+                    if isinstance(output, bytes):
+                        output = output.decode('utf-8', 'replace')
+                    self.test_cache.record(image.name, test, keys[test],
+                                status, output, time.time() - start)
+                    results[test] = (status, output, False)
+            finally:
+                for i in self.images:
+                    if i.name not in running and self.running(i.name):
+                        self.stop(i.name)
+                for cow in cows:
+                    if os.path.exists(cow):
+                        os.remove(cow)
+            if running == [] and self.test_keys(image) != keys:
+                print('test: ' + imagename + ' changed while testing, ' +
+                        'the results will not be replayed')
+        return [(t,) + results[t] for t, s in image.tests]
+
+    def stop(self, imagename, timeout=60):
+        """ Halt the running image (or all its replicas) and unset its
+            firewall rules """
+        group = self.replicas.get(imagename)
+        if group != None:
+            group.teardown(timeout)
+            return
+        image = self[imagename]
+        if image == None:
+            raise ValueError("No image with name " + imagename + " found")
+        if image.runner != None:
+            image.runner.shutdown(timeout)
+            image.runner = None
+        self.finish(imagename)
 
     def finish(self, imagename):
         """ unset firewall rules after image ends (to be done automatically
             when known how) """
         for net in self.networks.get_networks_by_host(imagename):
             self.firewall.unset_iface(net.name, imagename)
+        self.cpus.release(imagename)
+        self.journal.forget_guest(imagename)
+
+    def journal_guest(self, image, hostname, runner):
+        """ Record in the session journal the guest hostname of image
+            and what its runner holds """
+        isolation = runner.isolation
+        cgroup = None
+        if isolation != None and isolation.cgroup != {}:
+            cgroup = isolation.path()
+        endpoints = runner.endpoints()
+        self.journal.record_guest(hostname, { 'image': image.name,
+            'pid': runner.pid, 'backend': runner.kind,
+            'backend_options': runner.backend_options, 'cow': runner.cow,
+            'kernel_args': runner.kernel_args,
+            'console': endpoints['console'], 'agent': endpoints['agent'],
+            'taps': [h.tapdevice for h in runner.hosts],
+            'firewall': [[n.name, hostname] for n in
+                            self.networks.get_networks_by_host(hostname)],
+            'cpus': isolation.cpus if isolation != None else None,
+            'cgroup': cgroup })
+
+    def firewall_pairs(self):
+        """ (network, host) pairs set up in the firewall for the live
+            guests of the session journal, by any controller """
+        r = []
+        for name, entry in self.journal.guests().items():
+            if self.journal.guest_alive(entry):
+                r.extend([tuple(p) for p in entry['firewall']])
+        return r
+
+    def journal_mount(self, mountdir, imagepath):
+        """ mount_callback of the builders """
+        self.journal.record_mount(mountdir, imagepath, os.getpid())
+
+    def recover(self):
+        """ Attach to the guests of the session journal still running
+            (left by a controller that went away) and release what the
+            dead ones and the builders that died left behind: tap
+            devices, firewall rules and routes, cgroups, cpus, copy on
+            write files and image mounts. Return the names of the guests
+            attached to and of the ones cleaned up """
+        if not os.geteuid() == 0:
+            raise Exception("Only root can run this (yet)")
+        attached = []
+        cleaned = []
+        for name, entry in sorted(self.journal.guests().items()):
+            image = self[entry['image']]
+            alive = self.journal.guest_alive(entry)
+            if image != None and alive:
+                if self.__managed(image, name):
+                    continue
+                self.__adopt(image, name, entry)
+                attached.append(name)
+                continue
+            if alive:
+                # Its image is not in the profile anymore
+                kill_process(entry['pid'])
+            self.__release(name, entry)
+            cleaned.append(name)
+        for mountdir, entry in sorted(self.journal.mounts().items()):
+            if self.journal.mount_alive(entry):
+                continue
+            if os.path.ismount(mountdir):
+                # Lazily, with the /proc and /sys mounts below it
+                subprocess.call(["umount", "-l", mountdir])
+            if os.path.isdir(mountdir):
+                os.rmdir(mountdir)
+            self.journal.record_mount(mountdir, None, None)
+        self.firewall.reconcile(sweep=True)
+        return attached, cleaned
+
+    def __managed(self, image, name):
+        """ True if this controller already runs the guest name """
+        if name == image.name:
+            return image.runner != None
+        group = self.replicas.get(image.name)
+        return group != None and group[name] != None
+
+    def __adopt(self, image, name, entry):
+        """ Attach a runner to the live guest of a journal entry """
+        runner = self.__runner(image, name, entry['backend'],
+            entry['backend_options'], entry['cow'], entry['kernel_args'],
+            entry['cpus'])
+        runner.attach(entry['pid'], entry['console'], entry['agent'])
+        for network, host in entry['firewall']:
+            self.firewall.set_iface(network, host)
+        if name == image.name:
+            image.runner = runner
+            return
+        if image.name not in self.replicas:
+            self.replicas[image.name] = ReplicaGroup(self, image)
+        self.replicas[image.name].add(name, runner)
+
+    def __release(self, name, entry):
+        """ Release what the dead guest of a journal entry held """
+        for network, host in entry['firewall']:
+            n = self.networks[network]
+            if n != None and n.get_host_by_name(host) != None:
+                self.firewall.unset_iface(network, host)
+        for tap in entry['taps']:
+            self.firewall.delete_tap(tap)
+        if entry['cgroup'] != None and os.path.isdir(entry['cgroup']):
+            try:
+                os.rmdir(entry['cgroup'])
+            except OSError:
+                pass
+        HostfsExport(name).cleanup()
+        # Copy on write files and addresses of replicas are thrown away
+        # with them
+        if name != entry['image']:
+            if entry['cow'] != None and os.path.exists(entry['cow']):
+                os.remove(entry['cow'])
+            self.release_replica(name)
+        self.cpus.release(name)
+        self.journal.forget_guest(name)
+
+    def in_use(self):
+        """ Artefacts used by the guests running (in this controller or
+            in any other one using the same session journal) and by the
+            builds in progress """
+        r = []
+        for i in self.images:
+            if self.running(i.name) or i.name in self.replicas:
+                r.append(i.imagename)
+                runners = [i.runner]
+                if i.name in self.replicas:
+                    runners = [rn for n, rn in self.replicas[i.name].replicas]
+                for runner in runners:
+                    if runner != None:
+                        r.append(runner.kernelpath)
+        for name, entry in self.journal.guests().items():
+            image = self[entry['image']]
+            if image != None and self.journal.guest_alive(entry):
+                r.append(image.imagename)
+                r.extend(self.store.kernels)
+        for mountdir, entry in self.journal.mounts().items():
+            if self.journal.mount_alive(entry):
+                r.append(os.path.basename(entry['image']))
+        return [os.path.basename(p) for p in r]
+
+    def gc(self, budget=None, dry_run=False):
+        """ Remove the least recently used images, layers and kernels
+            until they fit in budget bytes (or the disk_budget of the
+            profile), keeping the ones in use, and reclaim the mount
+            points, staged trees and temporary directories dead
+            processes left.
+            Return the artefacts removed, the bytes left and the
+            directories reclaimed (what would be with dry_run) """
+        if budget == None:
+            budget = self.disk_budget
+        if budget != None:
+            budget = parse_size(budget)
+        removed, left = self.store.gc(budget, self.in_use(), dry_run)
+        orphans = self.store.orphans()
+        if self.staging_dir != None and os.path.isdir(self.staging_dir) and \
+                os.path.realpath(self.staging_dir) != \
+                os.path.realpath(tempfile.gettempdir()):
+            orphans += self.store.orphans(self.staging_dir)
+        if not dry_run:
+            for path in orphans:
+                self.store.reclaim(path)
+        return removed, left, orphans
+
+    def guests(self):
+        """ (pid, tap devices) of the guests running, in this
+            controller or in any other one using the same session
+            journal, by name """
+        r = {}
+        for name, entry in self.journal.guests().items():
+            if self.journal.guest_alive(entry):
+                r[name] = (entry['pid'], entry['taps'])
+        for i in self.images:
+            runners = []
+            if i.name in self.replicas:
+                runners = self.replicas[i.name].replicas
+            elif self.running(i.name):
+                runners = [(i.name, i.runner)]
+            for name, runner in runners:
+                if runner.pid != None:
+                    r[name] = (runner.pid, [h.tapdevice for h in runner.hosts])
+        return r
+
+    def start_telemetry(self, interval=None, callback=None, path=None):
+        """ Sample the guests every interval seconds (the
+            telemetry_interval of the profile by default), giving the
+            samples to callback and appending them to the file in path
+            (see telemetry.py). Return the Sampler """
+        self.stop_telemetry()
+        if interval == None:
+            interval = self.telemetry_interval
+        self.telemetry = Sampler(self.guests, interval, callback, path)
+        return self.telemetry.start()
+
+    def stop_telemetry(self):
+        if self.telemetry != None:
+            self.telemetry.stop()
+            self.telemetry = None
+
+    def status(self):
+        """ Last telemetry sample of every guest, by name; sampled now
+            (without rates) if the telemetry was not started """
+        if self.telemetry != None:
+            return self.telemetry.status()
+        return Sampler(self.guests).sample()
 
     def finish_all(self):
         """ Run all images in the .cas """
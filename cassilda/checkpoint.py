@@ -0,0 +1,75 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Build checkpoints
+
+An install is split in named phases (debootstrap, packages, system...).
+After each one the image is saved as a layer next to it (a reflink, so a
+copy-on-write snapshot, where the filesystem supports it) and the inputs
+of the phase are recorded in a <image>.checkpoints sidecar. When an
+install fails, the next attempt restores the last good layer and resumes
+from the following phase.
+"""
+import os
+
+from . import sidecar
+
+class Checkpoints:
+    """ The checkpoints saved while installing an image """
+    def __init__(self, imagepath, builder):
+        self.imagepath = imagepath
+        self.builder = builder
+        self.path = imagepath + '.checkpoints'
+        # List of [phase name, phase key] pairs, in order
+        self.saved = sidecar.load(self.path, [])
+
+    def layer(self, name):
+        ''' Path of the layer file saved for a phase '''
+        return self.imagepath + '.' + name + '.ckpt'
+
+    def resumable(self, phases):
+        ''' Return how many of the (name, key, function) phases are
+        already covered by valid checkpoints '''
+        done = 0
+        for name, key, function in phases:
+            if done >= len(self.saved):
+                break
+            if self.saved[done] != sidecar.normalize([name, key]):
+                break
+            if not os.path.exists(self.layer(name)):
+                break
+            done += 1
+        return done
+
+    def restore(self, phases):
+        ''' Restore the image from the last valid checkpoint, dropping
+        the stale ones after it. Return the index of the first phase
+        that still has to be run '''
+        done = self.resumable(phases)
+        for name, key in self.saved[done:]:
+            if os.path.exists(self.layer(name)):
+                os.remove(self.layer(name))
+        self.saved = self.saved[:done]
+        sidecar.save(self.path, self.saved)
+        if done > 0:
+            name = phases[done - 1][0]
+            self.builder.log("Resuming install of " + self.imagepath +
+                                            " after checkpoint " + name)
+            self.builder.copy_image(self.layer(name), self.imagepath)
+        return done
+
+    def save(self, name, key):
+        ''' Snapshot the image after phase name has finished '''
+        self.builder.log("Saving checkpoint " + name + " of " +
+                                                        self.imagepath)
+        self.builder.copy_image(self.imagepath, self.layer(name))
+        self.saved.append(sidecar.normalize([name, key]))
+        sidecar.save(self.path, self.saved)
+
+    def clear(self):
+        ''' Remove every checkpoint of the image '''
+        for name, key in self.saved:
+            if os.path.exists(self.layer(name)):
+                os.remove(self.layer(name))
+        self.saved = []
+        sidecar.remove(self.path)
@@ -0,0 +1,221 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Console capture
+
+Everything a guest prints on its console goes to a ConsoleLog, a file
+like object used as the pexpect logfile of the Runner. It writes to a
+log file that is rotated once it reaches a given size (the rotated
+files optionally gzipped in the background) and keeps the most recent
+output in a bounded buffer so tail() and grep() are cheap and never
+touch the disk.
+
+A ConsoleRecorder keeps a whole console session, what was read and what
+was sent with the time of each, so it can be played back without the
+guest (see backends.ReplayBackend). Recordings are gzipped JSON lines::
+
+    [seconds since the start, "o" (read) or "i" (sent), data]
+
+the data (bytes) decoded as latin-1 so it goes back unchanged.
+"""
+import collections
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+# Defaults for the console log of every guest
+LOG_SIZE = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+RECENT_SIZE = 256 * 1024
+# Recordings of a guest console, after its hostname
+RECORDING_SUFFIX = '.console.rec.gz'
+
+class ConsoleLog:
+    """ Rotating, optionally compressed, log of a guest console """
+    def __init__(self, path, max_bytes=LOG_SIZE, backups=LOG_BACKUPS,
+                    compress=True, recent_bytes=RECENT_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.recent_bytes = recent_bytes
+        self.recent = collections.deque()
+        self.recent_size = 0
+        self.lock = threading.Lock()
+        self.compressor = None
+        self.f = open(self.path, 'ab')
+        self.size = self.f.tell()
+
+    def backup(self, n):
+        ''' Path of the n-th rotated log '''
+        p = self.path + '.' + str(n)
+        if self.compress:
+            p += '.gz'
+        return p
+
+    def write(self, data):
+        ''' Called by pexpect with every chunk read from the console '''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        self.lock.acquire()
+        try:
+            self.recent.append(data)
+            self.recent_size += len(data)
+            while self.recent_size - len(self.recent[0]) >= self.recent_bytes:
+                self.recent_size -= len(self.recent.popleft())
+            if self.f == None:
+                return
+            self.f.write(data)
+            self.size += len(data)
+            if self.max_bytes and self.size >= self.max_bytes:
+                self.rotate()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.f != None:
+                self.f.flush()
+        finally:
+            self.lock.release()
+
+    def rotate(self):
+        ''' Shift the backups and start a new log file '''
+        self.f.close()
+        if self.compressor != None:
+            self.compressor.join()
+            self.compressor = None
+        if self.backups > 0:
+            if os.path.exists(self.backup(self.backups)):
+                os.remove(self.backup(self.backups))
+            for n in range(self.backups - 1, 0, -1):
+                if os.path.exists(self.backup(n)):
+                    os.rename(self.backup(n), self.backup(n + 1))
+            rotated = self.path + '.1'
+            os.rename(self.path, rotated)
+            if self.compress:
+                self.compressor = threading.Thread(target=self.gzip,
+                                        args=(rotated, self.backup(1)))
+                self.compressor.daemon = True
+                self.compressor.start()
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, 'ab')
+        self.size = 0
+
+    def gzip(self, source, destination):
+        s = open(source, 'rb')
+        try:
+            d = gzip.open(destination, 'wb')
+            try:
+                shutil.copyfileobj(s, d)
+            finally:
+                d.close()
+        finally:
+            s.close()
+        os.remove(source)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f != None:
+                self.f.close()
+                self.f = None
+        finally:
+            self.lock.release()
+        if self.compressor != None:
+            self.compressor.join()
+            self.compressor = None
+
+    def text(self):
+        ''' Return the recent output as a string '''
+        self.lock.acquire()
+        try:
+            data = b''.join(self.recent)
+        finally:
+            self.lock.release()
+        return data.decode('utf-8', 'replace')
+
+    def tail(self, lines=20):
+        ''' Return the last lines printed in the console '''
+        return self.text().splitlines()[-lines:]
+
+    def grep(self, pattern, flags=0):
+        ''' Return the recent console lines matching the regular
+        expression pattern '''
+        r = re.compile(pattern, flags)
+        return [l for l in self.text().splitlines() if r.search(l)]
+
+class Tee:
+    """ File like object writing to several ones """
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+class RecorderChannel:
+    """ One direction of a ConsoleRecorder, as a file like object """
+    def __init__(self, recorder, direction):
+        self.recorder = recorder
+        self.direction = direction
+
+    def write(self, data):
+        self.recorder.record(self.direction, data)
+
+    def flush(self):
+        pass
+
+class ConsoleRecorder:
+    """ Records a console session. output and input are the pexpect
+    logfile_read and logfile_send """
+    def __init__(self, path):
+        self.path = path
+        self.f = gzip.open(path, 'wb')
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.output = RecorderChannel(self, 'o')
+        self.input = RecorderChannel(self, 'i')
+
+    def record(self, direction, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        line = json.dumps([round(time.time() - self.start, 3), direction,
+                                                data.decode('latin-1')])
+        self.lock.acquire()
+        try:
+            if self.f != None:
+                self.f.write((line + '\n').encode('utf-8'))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f != None:
+                self.f.close()
+                self.f = None
+        finally:
+            self.lock.release()
+
+def read_recording(path):
+    ''' The (seconds, 'o' or 'i', bytes) events of a recording '''
+    f = gzip.open(path, 'rb')
+    try:
+        r = []
+        for line in f:
+            t, direction, data = json.loads(line.decode('utf-8'))
+            r.append((t, direction, data.encode('latin-1')))
+        return r
+    finally:
+        f.close()
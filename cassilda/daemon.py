@@ -0,0 +1,305 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Cassilda daemon
+
+A long running process keeping the profiles it was asked about loaded
+(parsed profile, networks, firewall state, journal...) and the guests
+it started supervised, so they outlive the clients that asked for them.
+It listens on a Unix socket, serving every connection in its own
+thread. Requests and responses are JSON documents, one per line::
+
+    {"op": "run", "profile": "/srv/web.cas", "image": "apache_server"}
+    {"result": null}
+
+    {"op": "exec", "profile": "/srv/web.cas", "image": "apache_server",
+     "command": "uptime"}
+    {"result": [0, " 10:02:11 up 2 min, ..."]}
+
+Failed requests get {"error": message} instead. The operations are
+ping, load (parse the profile again), status, telemetry, build, run,
+stop, test and exec; see the op_* methods of Daemon. Builds, starts, stops and
+tests of the same profile are serialized, everything else runs
+concurrently.
+
+Profiles are named by absolute path, the images and session files are
+kept in the directory the daemon was started from. Client talks to it::
+
+    Client().request('status')
+"""
+import json
+import os
+import socket
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+SOCKET_PATH = '/var/run/cassilda.sock'
+
+class DaemonError(Exception):
+    pass
+
+def text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+class Handler(socketserver.StreamRequestHandler):
+    """ Serves the requests of a connection, in order """
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(text(line))
+                response = { 'result': self.server.daemon.dispatch(request) }
+            except Exception as e:
+                response = { 'error': str(e) }
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Daemon:
+    """ Loaded profiles and the Unix socket server taking requests for
+    them. The profiles are loaded by loader(path), Cassilda by default
+
+    >>> import tempfile, time
+    >>> active = [0, 0]
+    >>> class Profile:
+    ...     def __init__(self, path):
+    ...         self.images = []
+    ...         self.replicas = {}
+    ...     def running(self, name):
+    ...         return False
+    ...     def run(self, name, count=None):
+    ...         active[0] += 1
+    ...         active[1] = max(active)
+    ...         time.sleep(0.05)
+    ...         active[0] -= 1
+    >>> d = Daemon(os.path.join(tempfile.mkdtemp(), 'cassilda.sock'),
+    ...             loader=Profile)
+    >>> t = threading.Thread(target=d.serve)
+    >>> t.start()
+    >>> while d.server == None:
+    ...     time.sleep(0.01)
+    >>> print(Client(d.path).request('ping'))
+    pong
+    >>> try:
+    ...     Client(d.path).request('reboot')
+    ... except DaemonError as e:
+    ...     print(e)
+    Unknown operation reboot
+    >>> def run(image):
+    ...     Client(d.path).request('run', profile='web.cas', image=image)
+    >>> runs = [threading.Thread(target=run, args=('web' + str(n),))
+    ...             for n in range(4)]
+    >>> for r in runs:
+    ...     r.start()
+    >>> for r in runs:
+    ...     r.join()
+    >>> active
+    [0, 1]
+    >>> d.shutdown()
+    >>> t.join()
+    >>> os.path.exists(d.path)
+    False
+    """
+    def __init__(self, path=SOCKET_PATH, loader=None):
+        self.path = path
+        if loader == None:
+            from .cassilda import Cassilda
+            loader = Cassilda
+        self.loader = loader
+        self.lock = threading.Lock()
+        # Cassilda objects and the locks serializing their changes,
+        # by profile path
+        self.profiles = {}
+        self.profile_locks = {}
+        self.server = None
+
+    def profile(self, path, reload=False):
+        ''' The Cassilda object of the profile in path, loaded the first
+        time and kept afterwards '''
+        if path == None:
+            raise ValueError('A profile is needed')
+        self.lock.acquire()
+        try:
+            if path not in self.profile_locks:
+                self.profile_locks[path] = threading.Lock()
+            lock = self.profile_locks[path]
+        finally:
+            self.lock.release()
+        lock.acquire()
+        try:
+            if reload or path not in self.profiles:
+                if path in self.profiles:
+                    running = [i.name for i in self.profiles[path].images
+                                if self.profiles[path].running(i.name)]
+                    if running != []:
+                        raise Exception('Images of ' + path +
+                            ' are running: ' + ', '.join(running))
+                self.profiles[path] = self.loader(path)
+            return self.profiles[path], lock
+        finally:
+            lock.release()
+
+    def dispatch(self, request):
+        ''' The result of a request, raise an exception if it failed '''
+        op = request.get('op')
+        function = getattr(self, 'op_' + str(op), None)
+        if function == None:
+            raise ValueError('Unknown operation ' + str(op))
+        return function(request)
+
+    def serialized(self, request, function):
+        ''' Call function(cas) holding the lock of the profile of the
+        request '''
+        cas, lock = self.profile(request.get('profile'))
+        lock.acquire()
+        try:
+            return function(cas)
+        finally:
+            lock.release()
+
+    def op_ping(self, request):
+        return 'pong'
+
+    def op_load(self, request):
+        self.profile(request.get('profile'), reload=True)
+        return None
+
+    def op_status(self, request):
+        ''' The images of the loaded profiles (or of the one given) and
+        the guests running each one '''
+        if request.get('profile') != None:
+            paths = [request['profile']]
+        else:
+            paths = sorted(self.profiles.keys())
+        r = {}
+        for path in paths:
+            cas, lock = self.profile(path)
+            images = {}
+            for i in cas.images:
+                guests = {}
+                group = cas.replicas.get(i.name)
+                if group != None:
+                    for name, runner in group.replicas:
+                        guests[name] = runner.pid
+                elif cas.running(i.name):
+                    guests[i.name] = i.runner.pid
+                images[i.name] = { 'installed': i.already_installed(),
+                                    'guests': guests }
+            r[path] = images
+        return r
+
+    def op_telemetry(self, request):
+        ''' The last telemetry sample of every guest of a profile (see
+        Cassilda.status()), starting its sampler the first time '''
+        cas, lock = self.profile(request.get('profile'))
+        lock.acquire()
+        try:
+            if cas.telemetry == None:
+                cas.start_telemetry(request.get('interval'))
+        finally:
+            lock.release()
+        return cas.status()
+
+    def op_build(self, request):
+        return self.serialized(request, lambda cas:
+                    cas.build(request['image'], request.get('force', False)))
+
+    def op_run(self, request):
+        def run(cas):
+            if cas.running(request['image']) or \
+                    request['image'] in cas.replicas:
+                raise Exception('Image ' + request['image'] +
+                                                ' is already running')
+            group = cas.run(request['image'], count=request.get('count'))
+            if group != None:
+                return group.names()
+            return [request['image']]
+        return self.serialized(request, run)
+
+    def op_stop(self, request):
+        return self.serialized(request, lambda cas:
+                cas.stop(request['image'], request.get('timeout', 60)))
+
+    def op_test(self, request):
+        ''' Run the tests of an image (see Cassilda.test()) '''
+        return self.serialized(request, lambda cas:
+                cas.test(request['image'], request.get('force', False)))
+
+    def op_exec(self, request):
+        ''' Run a command in a running image, or in one of its replicas
+        (given as guest) '''
+        cas, lock = self.profile(request.get('profile'))
+        image = cas[request['image']]
+        if image == None:
+            raise ValueError('No image with name ' + request['image'])
+        runner = image.runner
+        group = cas.replicas.get(image.name)
+        if group != None:
+            runner = group[request.get('guest', image.name + '-1')]
+        if runner == None or not runner.running():
+            raise Exception('Image ' + request['image'] + ' is not running')
+        status, output = runner.execute(request['command'],
+                                            request.get('timeout', -1))
+        return [status, text(output)]
+
+    def serve(self):
+        ''' Serve requests until shutdown() is called '''
+        if os.path.exists(self.path):
+            # A socket left by a daemon that died, unless one answers
+            try:
+                Client(self.path).request('ping')
+                raise DaemonError('A daemon is already listening in ' +
+                                                                self.path)
+            except socket.error:
+                os.remove(self.path)
+        self.server = Server(self.path, Handler)
+        self.server.daemon = self
+        os.chmod(self.path, 0o600)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.path)
+
+    def shutdown(self):
+        if self.server != None:
+            self.server.shutdown()
+
+class Client:
+    """ Sends requests to a Daemon """
+    def __init__(self, path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile('rb')
+
+    def request(self, op, **arguments):
+        ''' Send a request and return its result, raise DaemonError if
+        it failed '''
+        arguments['op'] = op
+        if arguments.get('profile') != None:
+            arguments['profile'] = os.path.abspath(arguments['profile'])
+        self.sock.sendall((json.dumps(arguments) + '\n').encode('utf-8'))
+        line = self.f.readline()
+        if not line:
+            raise DaemonError('The daemon closed the connection')
+        response = json.loads(text(line))
+        if 'error' in response:
+            raise DaemonError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -5,9 +5,14 @@ Debian Squeeze builder
 """
 
 import time
+import os
 
 from .builder import Builder
 from .networks import Network
+from .transport import ssh_keypair
+from . import agent
+from . import guest_agent
+from . import replicas
 
 class debian_squeeze_Builder(Builder):
     buildertype = 'debian_squeeze'
@@ -21,8 +26,22 @@ class debian_squeeze_Builder(Builder):
 
     def build_image(self, image, repository, size):
         """ Build the image """
-        self.create_image(image.imagename, size)
-        self.make_filesystem(image.imagename)
+        phases = self.phases(image.packages, image.imagename, repository)
+        if self.staged == image.imagename:
+            # The caller populates the image once it is configured
+            for name, key, function in phases:
+                self.log("Running install phase " + name)
+                try:
+                    r = function()
+                finally:
+                    self.cleanup_mounts()
+                if r == False:
+                    return False
+            self.set_hostname(image.name, image.imagename)
+            return True
+        if not self.resumable(image.imagename, phases):
+            self.create_image(image.imagename, size)
+            self.make_filesystem(image.imagename)
         r = self.install(image.packages, image.basename, image.imagename,
                                                         repository)
         if not r:
@@ -37,9 +56,10 @@ class debian_squeeze_Builder(Builder):
         self.append_to_file("/etc/hostname", hostname, overwrite=True)
         self.umount_filesystem()
 
-    def set_repository(self, imagepath, address):
+    def set_repository(self, imagepath, address, previous="127.0.0.1"):
+        """ Point sources.list to address, replacing the previous one """
         self.mount_filesystem(imagepath)
-        self.replace_in_file("/etc/apt/sources.list", "127.0.0.1", address)
+        self.replace_in_file("/etc/apt/sources.list", previous, address)
         self.umount_filesystem()
 
     def set_network(self, imagepath, address, netmask, network, broadcast,
@@ -66,7 +86,30 @@ class debian_squeeze_Builder(Builder):
         self.append_to_file("/etc/network/interfaces", iz, overwrite)
         self.umount_filesystem()
 
-    def set_mac_address(self, imagepath, interface, mac_address):
+    def set_hostfs(self, imagepath, mounts):
+        """ Replace the hostfs entries of /etc/fstab with the (guest path,
+            host path relative to the hostfs= root, readonly) mounts """
+        self.mount_filesystem(imagepath)
+        p = self.mountdir + "/etc/fstab"
+        lines = []
+        if os.path.exists(p):
+            f = open(p, 'r')
+            lines = [l for l in f if l.split()[2:3] != ['hostfs']]
+            f.close()
+        for guest, host, readonly in mounts:
+            self.log("Sharing host directory " + host + " in " + guest)
+            if not os.path.exists(self.mountdir + guest):
+                self.create_dir(guest)
+            if readonly:
+                options = "ro," + host
+            else:
+                options = "rw," + host
+            lines.append("none " + guest + " hostfs " + options + " 0 0\n")
+        self.append_to_file("/etc/fstab", "".join(lines), overwrite=True)
+        self.umount_filesystem()
+
+    def set_mac_address(self, imagepath, interface, mac_address,
+                                                overwrite=False):
         """ Setup the mac address of an interface so it is the same
             between reboots """
         self.mount_filesystem(imagepath)
@@ -76,15 +119,30 @@ class debian_squeeze_Builder(Builder):
         rulestring += 'ATTR{address}=="' + mac_address 
         rulestring += '", ATTR{dev_id}=="0x0", ' 
         rulestring += 'ATTR{type}=="1", KERNEL=="eth*", NAME="'
-        rulestring += interface + '"'
+        rulestring += interface + '"\n'
         self.append_to_file("/etc/udev/rules.d/70-persistent-net.rules",
-                                                            rulestring)
+                                                    rulestring, overwrite)
         self.umount_filesystem()
 
+    def phases(self, packages, imagename, repository):
+        """ Return the (name, key, function) install phases, the key
+        being the inputs that the result of the phase depends on """
+        return [
+            ("debootstrap", [repository],
+                lambda: self.debootstrap(imagename, repository)),
+            ("packages", [repository, packages],
+                lambda: self.install_packages(imagename, packages)),
+            ("system", [repository, packages, imagename],
+                lambda: self.configure_system(imagename)) ]
+
     def install_image(self, packages, imagename, repository):
         """ Actually install the image, debootstrapping it and
-        installing the packages"""
+        installing the packages, checkpointing after each phase """
+        return self.run_phases(imagename,
+                self.phases(packages, imagename, repository))
 
+    def debootstrap(self, imagename, repository):
+        """ Debootstrap the base system into the image """
         self.mount_filesystem(imagename)
         self.create_dir("/root/.ssh")
         self.create_dir("/etc")
@@ -96,24 +154,37 @@ class debian_squeeze_Builder(Builder):
             self.call(["debootstrap", "--arch", "i386",
                 "squeeze", self.mountdir,
                 self.repo])
-            ret = True
         except:
             self.log("Error while trying to debootstrap. No net?")
             self.umount_filesystem()
             return False
+        self.umount_filesystem()
+        return True
 
+    def install_packages(self, imagename, packages):
+        """ Install the packages of the image via chroot """
+        self.mount_filesystem(imagename)
         self.mount_sys_and_dev()
 
         self.append_to_file("/install_things.sh", "#!/bin/bash\n" +
             "export LC_ALL=C\n" +
             "aptitude -y update\n" +
-            "aptitude -y install " + packages + "\n" +
-            "echo StrictHostKeyChecking no >> /etc/ssh/ssh_config\n")
+            # python is needed by the guest agent
+            "aptitude -y install " + packages + " python\n" +
+            "echo StrictHostKeyChecking no >> /etc/ssh/ssh_config\n",
+            overwrite=True)
         
         self.chmod("/install_things.sh", 0o744)
 
         self.log("Installing the packages via chroot...") 
         self.call(["chroot", self.mountdir, "/install_things.sh"])
+        self.umount_sys_and_dev()
+        self.umount_filesystem()
+        return True
+
+    def configure_system(self, imagename):
+        """ Last settings (root password, prompt, fstab, inittab...) """
+        self.mount_filesystem(imagename)
         self.log("Last settings (change root password, set prompt, etc)")
         self.append_to_file("/root/.bashrc", "export PS1='" +
                 imagename + " \w \\$ '")
@@ -124,6 +195,22 @@ class debian_squeeze_Builder(Builder):
             '#!/bin/bash\necho -e "root\\nroot" | passwd root\n')
         self.chmod("/change_root_password.sh", 0o744)
         s = self.call(["chroot", self.mountdir, "/change_root_password.sh"])
+
+        # Let the runners log in through ssh (see transport.SSHTransport)
+        private, public = ssh_keypair()
+        self.append_to_file("/root/.ssh/authorized_keys", public)
+        self.chmod("/root/.ssh/authorized_keys", 0o600)
+
+        # Guest agent, served on the second console (see agent.py)
+        f = open(guest_agent.__file__.replace('.pyc', '.py'), 'r')
+        self.append_to_file(agent.GUEST_PATH, f.read(), overwrite=True)
+        f.close()
+        self.chmod(agent.GUEST_PATH, 0o755)
+
+        # Applies the settings of replicas at boot (see replicas.py)
+        self.append_to_file(replicas.REPLICA_SCRIPT_PATH,
+                                replicas.REPLICA_SCRIPT, overwrite=True)
+        self.chmod(replicas.REPLICA_SCRIPT_PATH, 0o755)
         
         self.append_to_file("/etc/fstab","/dev/udb0 / ext2 defaults 0 0\n" +
             "proc      /proc proc defaults 0 0\n")
@@ -131,6 +218,7 @@ class debian_squeeze_Builder(Builder):
         self.append_to_file("/etc/inittab",
             "#minimal inittab taken from some uml tutorial\n"+
             "id:2:initdefault:\n"+
+            "rs::sysinit:" + replicas.REPLICA_SCRIPT_PATH + "\n"+
             "si::sysinit:/etc/init.d/rcS\n"+
             "~~:S:wait:/sbin/sulogin\n"+
             "l0:0:wait:/etc/init.d/rc 0\n"+
@@ -145,15 +233,21 @@ class debian_squeeze_Builder(Builder):
             "pf::powerwait:/etc/init.d/powerfail start\n"+
             "pn::powerfailnow:/etc/init.d/powerfail now\n"+
             "po::powerokwait:/etc/init.d/powerfail stop\n"+
-            "c0:2345:respawn:/sbin/getty 38400 tty0 linux\n", overwrite=True)
+            "c0:2345:respawn:/sbin/getty 38400 tty0 linux\n"+
+            # Spare login console of the UML runners (see backends.py)
+            "c2:2345:respawn:/sbin/getty 38400 tty2 linux\n"+
+            # Login console of the QEMU runners
+            "s0:2345:respawn:/sbin/getty -L ttyS0 115200 vt100\n"+
+            "s2:2345:respawn:/sbin/getty -L ttyS2 115200 vt100\n"+
+            "ag:2345:respawn:/usr/bin/python " + agent.GUEST_PATH + " " +
+                                    agent.GUEST_TTY + "\n", overwrite=True)
 
         self.append_to_file("/etc/securetty", 
             "console\n" +
             "tty0\n" +
-            "ttyS0\n")
+            "tty2\n" +
+            "ttyS0\n" +
+            "ttyS2\n")
 
-        # MARK
-        self.umount_sys_and_dev()
         self.umount_filesystem()
-        return ret
-
+        return True
@@ -4,20 +4,44 @@ Firewall interface
 
 Highly coupled with the Networks object, sets up rules to
 allow the image to connect with the host network and to internet
+
+The rules and routes are not added and removed blindly: the ones the
+running hosts need are computed from the Networks object and compared
+with the output of iptables-save and ip route, and only the difference
+is applied. Cassilda rules carry a comment match (RULE_COMMENT) and its
+routes a protocol of their own (ROUTE_PROTOCOL), so setting up or
+tearing down twice does nothing.
+
+Several controllers may share the networks (one per image run, for
+example), so a controller only removes the rules and routes of the
+hosts it set up itself, keeping those the hosts of the others still
+need (given by the shared callback, see Cassilda.firewall_pairs()).
+Rules and routes of our networks left behind by a session that crashed
+are only swept by reconcile(sweep=True), from Cassilda.recover().
 """
 
 from . import networks
 import subprocess
 import os
+import netaddr
+
+# Comment matched by the iptables rules added by cassilda
+RULE_COMMENT = 'cassilda'
+# Protocol of the routes added by cassilda (see /etc/iproute2/rt_protos)
+ROUTE_PROTOCOL = '111'
 
 class Firewall:
-    def __init__(self, networks):
+    def __init__(self, networks, shared=None):
         self.networks = networks
+        # Returns the (network, host) pairs set up by every controller
+        self.shared = shared
         self.__set_forwarding(True)
-        # Keep track of an array of pairs [network, refcount]
-        # to know when to set/unset natting rules for a certain
-        # network
-        self.nat_rules = []
+        # (network, host) pairs set up, the rules and routes of the
+        # kernel are reconciled with them
+        self.active = set()
+        # (network, host) pairs this controller set up or tore down at
+        # some point, the only ones whose rules and routes it removes
+        self.mine = set()
 
     # Next function was shamelessly copied from NetCommander code
     def __set_forwarding(self, status):
@@ -46,63 +70,40 @@ class Firewall:
         retcode = process.poll()
         return output
  
-    def __waniface(self):
-        """ quick and dirty way to guess the wan interface of a
-        linux host"""
-        s = self.__check_output(["ip", "route", "list"]).decode("utf-8")
-        i = s.find('default')
-        if i == -1:
-            raise ValueError("No default WAN interface found")
-        eol = s.find('\n', i)
-        if i == -1:
-            raise ValueError("No default WAN interface found")
-        dev = s.find('dev', i, eol)
-        if i == -1:
-            raise ValueError("No default WAN interface found")
-        end = s.find(' ', dev + 4)
-        return s[dev + 4:end]
+    def __tap_exists(self, tapdevice):
+        return os.path.exists('/sys/class/net/' + tapdevice)
 
     def __create_tuntap(self, h):
-        subprocess.call("tunctl -t " + h.tapdevice, shell=True)
+        if not self.__tap_exists(h.tapdevice):
+            subprocess.call("tunctl -t " + h.tapdevice, shell=True)
         subprocess.call("ifconfig " + h.tapdevice + " " + str(h.tapaddress),
                                                     shell=True)
         self.__set_proxyarp(h.tapdevice, True)
 
     def __delete_tuntap(self, h):
-        self.__set_proxyarp(h.tapdevice, False)
-        subprocess.call("tunctl -d " + h.tapdevice, shell=True)
-        subprocess.call("ifconfig " + h.tapdevice + " down", shell=True)
- 
-    def __accept_tap_rule(self, h):
-        """ Return the accept tap rule for a certain host
-        as a string"""
-        return "iptables -t nat -I PREROUTING -i " + \
-            h.tapdevice + " -j ACCEPT" 
-        
-    def __masquerade_tap_rule(self, h, n, delete=False):
-        """ Return the masquerade tap rule as a string"""
-        netdict = n.get_addresses()
-        rule = "iptables -t nat "
-        if delete:
-            rule += "-D "
-        else:
-            rule += "-I "
-        rule += ("POSTROUTING -s " + netdict['network'] + "/" +
-                netdict['prefixlen'] + " -o " + self.__waniface() +
-                " -j MASQUERADE")
-        return rule
-
-    def __routing_rule(self, h, delete=False):
-        """ Return a string with a suitable routing route(8) rule to
-            allow packages to reach the host through the assigned
-            tap iface """
-        rule = "route "
-        if delete:
-            rule += "del "
-        else:
-            rule += "add "
-        rule += h.address + " dev " + h.tapdevice
-        return rule
+        self.delete_tap(h.tapdevice)
+
+    def delete_tap(self, tapdevice):
+        """ Remove a tap device, if it exists """
+        if not self.__tap_exists(tapdevice):
+            return
+        self.__set_proxyarp(tapdevice, False)
+        subprocess.call("ifconfig " + tapdevice + " down", shell=True)
+        subprocess.call("tunctl -d " + tapdevice, shell=True)
+
+    def __in_scope(self, address):
+        """ True if address belongs to one of the networks of the
+            controller, whose rules and routes are ours to manage """
+        if address == None:
+            return False
+        try:
+            address = netaddr.IPNetwork(address)
+        except (netaddr.AddrFormatError, ValueError):
+            return False
+        for n in self.networks.networks:
+            if address in n.net.cidr:
+                return True
+        return False
 
     def __retrieve_network_and_host_objects(self, network, host):
         """ Convenience function to retrieve objects from the
@@ -116,61 +117,138 @@ class Firewall:
                             " found in network " + network)
         return n, h
 
-    def __get_nat_rule(self, network):
-        for n, r in self.nat_rules:
-            if n == network:
-                return r
-        return 0
-
-    def __add_nat_rule(self, network):
-        count = self.__get_nat_rule(network)
-        if count != 0:
-            self.nat_rules.remove([network, count])
-        self.nat_rules.append([network, count + 1])
-        return count
-
-    def __del_nat_rule(self, network):
-        count = self.__get_nat_rule(network)
-        if count == 0:
-            raise Exception('Called __del_nat_rule for a network that ' +
-                'does not exist yet: ' + network)
-        self.nat_rules.remove([network, count])
-        if count > 1:
-            self.nat_rules.append([network, count -1])
-        return count
+    def live_state(self):
+        """ Read the owned masquerade rules, the owned routes and the
+            wan interface from the kernel, one iptables-save and one ip
+            route call. Rules are {(source, out iface): rule spec},
+            routes {(address, tap device)} """
+        rules = {}
+        output = self.__check_output(["iptables-save", "-t", "nat"])
+        for line in output.decode("utf-8").splitlines():
+            fields = line.split()
+            if fields[:2] != ['-A', 'POSTROUTING'] or \
+                    not self.__has_option(fields, '--comment', RULE_COMMENT):
+                continue
+            source = self.__option(fields, '-s')
+            if self.__in_scope(source):
+                rules[(source, self.__option(fields, '-o'))] = fields[1:]
+        routes = set()
+        wan = None
+        output = self.__check_output(["ip", "route", "list"])
+        for line in output.decode("utf-8").splitlines():
+            fields = line.split()
+            if fields[:1] == ['default'] and wan == None:
+                wan = self.__option(fields, 'dev')
+            elif self.__has_option(fields, 'proto', ROUTE_PROTOCOL) and \
+                    self.__in_scope(fields[0]):
+                routes.add((fields[0], self.__option(fields, 'dev')))
+        return rules, routes, wan
+
+    def __option(self, fields, name):
+        """ Value following name in a split command line """
+        if name in fields and fields.index(name) + 1 < len(fields):
+            return fields[fields.index(name) + 1]
+        return None
+
+    def __has_option(self, fields, name, value):
+        for i in range(len(fields) - 1):
+            if fields[i] == name and fields[i + 1] == value:
+                return True
+        return False
+
+    def shared_pairs(self):
+        """ (network, host) pairs set up by the other controllers, the
+            ones of hosts no longer in our networks left out """
+        r = set()
+        if self.shared == None:
+            return r
+        for network, host in self.shared():
+            pair = (network, host)
+            n = self.networks[network]
+            if pair not in self.mine and n != None and \
+                    n.get_host_by_name(host) != None:
+                r.add(pair)
+        return r
+
+    def state(self, pairs, wan, strict=True):
+        """ The masquerade rules and routes the (network, host) pairs
+            need, in the format of live_state(). Without a wan
+            interface the rules are left out, unless strict """
+        rules = set()
+        routes = set()
+        for network, host in pairs:
+            n, h = self.__retrieve_network_and_host_objects(network, host)
+            routes.add((str(h.address), h.tapdevice))
+            if n.nat:
+                if wan == None:
+                    if not strict:
+                        continue
+                    raise ValueError("No default WAN interface found")
+                netdict = n.get_addresses()
+                rules.add((netdict['network'] + "/" + netdict['prefixlen'],
+                                                                    wan))
+        return rules, routes
+
+    def desired_state(self, wan):
+        """ The masquerade rules and routes the running hosts of every
+            controller need, in the format of live_state() """
+        return self.state(self.active | self.shared_pairs(), wan)
+
+    def __call(self, arguments):
+        print("Firewall: " + " ".join(arguments))
+        subprocess.call(arguments)
+
+    def reconcile(self, sweep=False):
+        """ Bring the kernel to the rules and routes the running hosts
+            need, applying only the difference. Only the rules and
+            routes of the hosts this controller set up are removed, or,
+            with sweep, every stale one of our networks (left by a
+            crashed session) """
+        live_rules, live_routes, wan = self.live_state()
+        rules, routes = self.desired_state(wan)
+        stale_rules = set(live_rules) - rules
+        stale_routes = live_routes - routes
+        if not sweep:
+            own_rules, own_routes = self.state(self.mine, wan, strict=False)
+            stale_rules &= own_rules
+            stale_routes &= own_routes
+        for key in sorted(stale_rules):
+            self.__call(["iptables", "-t", "nat", "-D"] + live_rules[key])
+        for address, tapdevice in sorted(stale_routes):
+            self.__call(["ip", "route", "del", address, "dev", tapdevice,
+                                            "proto", ROUTE_PROTOCOL])
+        for source, out in sorted(rules - set(live_rules)):
+            self.__call(["iptables", "-t", "nat", "-I", "POSTROUTING",
+                "-s", source, "-o", out, "-m", "comment", "--comment",
+                RULE_COMMENT, "-j", "MASQUERADE"])
+        for address, tapdevice in sorted(routes - live_routes):
+            self.__call(["ip", "route", "replace", address, "dev", tapdevice,
+                                            "proto", ROUTE_PROTOCOL])
 
     def set_iface(self, network, host):
         """ Setup the interface retrieving the associated Network 
         object """
         n, h = self.__retrieve_network_and_host_objects(network, host)
         self.__create_tuntap(h)
-    #   l1 = eval(self.__accept_tap_rule(h))
-    #   l2 = eval(self.__masquerade_tap_rule(h, n))
-    #   Do not call the accept tap rule "a ver que pasa"
-    #   subprocess.call(self.__accept_tap_rule(h), shell=True)
-        if n.nat: 
-            if self.__add_nat_rule(network) == 0:
-                r = self.__masquerade_tap_rule(h, n)
-                print('set_iface(): Setting rule ' + r)
-                subprocess.call(r, shell=True)
-        n, h = self.__retrieve_network_and_host_objects(network, host)
-        routing_rule = self.__routing_rule(h)
-        print("set_iface_postrun: about to call: " + routing_rule)
-        subprocess.call(routing_rule, shell=True)
+        self.active.add((network, host))
+        self.mine.add((network, host))
+        self.reconcile()
 
     def unset_iface(self, network, host):
-        """ Delete the rules set up by set_iface() """
+        """ Delete the rules set up by set_iface(), nothing if they
+        were not there """
         n, h = self.__retrieve_network_and_host_objects(network, host)
-        subprocess.call(self.__routing_rule(h, delete=True), shell=True)
-        if n.nat:
-            refcount = self.__del_nat_rule(network)
-            print 'self.__del_nat_rule(' + network + ') = ' + str(refcount)
-            if refcount == 1:
-                derouting_rule = self.__masquerade_tap_rule(h, n, delete=True)
-                print("unset_iface: about to call: " + derouting_rule)
-                subprocess.call(derouting_rule, shell=True)
+        self.active.discard((network, host))
+        self.mine.add((network, host))
+        self.reconcile()
         self.__delete_tuntap(h)
 
+    def clear(self):
+        """ Remove every rule and route of our networks but those the
+        hosts of the other controllers need """
+        self.active = set()
+        self.reconcile(sweep=True)
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Cassilda guest agent
+
+Installed by the builders in /usr/local/sbin/cassilda-agent and started
+from inittab on the second UML console (/dev/tty1, or the tty given as
+cassilda.agent= in the kernel command line), attached by the Runner to
+a pty of the host. It can also run as a local stand-in,
+speaking on its stdin/stdout, to test the host side (see agent.py).
+
+Every message, in both directions, is a frame::
+
+    'CA' + 4 bytes big endian length + JSON document
+
+Requests carry an 'id' and an 'op' (exec, read, write, status...) and
+are served concurrently, each one in its own thread; the response
+carries the same 'id'. Binary data travels base64 encoded.
+
+This file runs inside the guest, so it must not import anything from
+cassilda and must work with the python of the distribution.
+"""
+import base64
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+MAGIC = b'CA'
+HEADER = struct.Struct('>2sI')
+
+def read_exactly(fd, n):
+    ''' Read n bytes from fd, None at end of file '''
+    data = b''
+    while len(data) < n:
+        chunk = os.read(fd, n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def read_frame(fd):
+    ''' Return the next decoded frame, skipping garbage until a magic
+    is found, or None at end of file '''
+    window = b''
+    while window != MAGIC:
+        c = read_exactly(fd, 1)
+        if c == None:
+            return None
+        window = (window + c)[-2:]
+    data = read_exactly(fd, HEADER.size - 2)
+    if data == None:
+        return None
+    magic, length = HEADER.unpack(MAGIC + data)
+    body = read_exactly(fd, length)
+    if body == None:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+def write_frame(fd, message):
+    body = json.dumps(message).encode('utf-8')
+    data = HEADER.pack(MAGIC, len(body)) + body
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+def encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+def decode(data):
+    return base64.b64decode(data.encode('ascii'))
+
+class Agent:
+    """ Serves the requests read from one fd, answering in another """
+    def __init__(self, rfd, wfd):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Processes started with 'spawn', by handle
+        self.processes = {}
+        self.next_handle = 0
+
+    def op_exec(self, request):
+        p = subprocess.Popen(['/bin/sh', '-c', request['command']],
+                stdin=open(os.devnull, 'rb'), stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        return { 'status': p.returncode, 'output': encode(output) }
+
+    def op_spawn(self, request):
+        ''' Start a command whose stdin/stdout are streamed with feed,
+        output and wait requests '''
+        p = subprocess.Popen(['/bin/sh', '-c', request['command']],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        self.lock.acquire()
+        try:
+            self.next_handle += 1
+            self.processes[self.next_handle] = p
+            return { 'handle': self.next_handle }
+        finally:
+            self.lock.release()
+
+    def op_feed(self, request):
+        p = self.processes[request['handle']]
+        p.stdin.write(decode(request['data']))
+        p.stdin.flush()
+        return {}
+
+    def op_output(self, request):
+        p = self.processes[request['handle']]
+        data = os.read(p.stdout.fileno(), request.get('size', 65536))
+        return { 'data': encode(data), 'eof': data == b'' }
+
+    def op_wait(self, request):
+        p = self.processes.pop(request['handle'])
+        output = p.communicate()[0]
+        return { 'status': p.returncode, 'output': encode(output) }
+
+    def op_read(self, request):
+        f = open(request['path'], 'rb')
+        try:
+            return { 'data': encode(f.read()) }
+        finally:
+            f.close()
+
+    def op_write(self, request):
+        mode = 'wb'
+        if request.get('append'):
+            mode = 'ab'
+        f = open(request['path'], mode)
+        try:
+            f.write(decode(request['data']))
+        finally:
+            f.close()
+        if 'mode' in request:
+            os.chmod(request['path'], request['mode'])
+        return {}
+
+    def op_status(self, request):
+        r = { 'pid': os.getpid(), 'agent_uptime': time.time() - self.started,
+              'hostname': os.uname()[1] }
+        try:
+            r['loadavg'] = list(os.getloadavg())
+        except OSError:
+            pass
+        return r
+
+    def handle(self, request):
+        try:
+            method = getattr(self, 'op_' + str(request.get('op')), None)
+            if method == None:
+                response = { 'error': 'unknown op ' + str(request.get('op')) }
+            else:
+                response = method(request)
+        except Exception:
+            response = { 'error': str(sys.exc_info()[1]) }
+        response['id'] = request.get('id')
+        self.lock.acquire()
+        try:
+            write_frame(self.wfd, response)
+        finally:
+            self.lock.release()
+
+    def serve(self):
+        while True:
+            request = read_frame(self.rfd)
+            if request == None:
+                return
+            t = threading.Thread(target=self.handle, args=(request,))
+            t.daemon = True
+            t.start()
+
+def agent_tty(default):
+    ''' The tty given in the kernel command line as cassilda.agent=,
+    which depends on the hypervisor, or default '''
+    try:
+        f = open('/proc/cmdline', 'r')
+        try:
+            for option in f.read().split():
+                if option.startswith('cassilda.agent='):
+                    return option.split('=', 1)[1]
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return default
+
+def main():
+    if len(sys.argv) > 1:
+        # A tty (a console of the guest): make it raw so frames pass
+        # untouched
+        import tty
+        fd = os.open(agent_tty(sys.argv[1]), os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(fd)
+        Agent(fd, fd).serve()
+    else:
+        Agent(sys.stdin.fileno(), sys.stdout.fileno()).serve()
+
+if __name__ == '__main__':
+    main()
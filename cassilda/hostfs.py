@@ -0,0 +1,87 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Host directories shared with the guests
+
+UML hostfs gives the guest every file below the directory passed as
+hostfs=, with the rights of the UML process (root), whatever the fstab
+of the guest says. So the shared directories are never given directly:
+each one is bind mounted (read only unless readonly: false) below a
+directory of its own for the guest, .cassilda/hostfs/<hostname>, itself
+bind mounted read only, and that directory is the hostfs= root. The
+guest sees the shared directories and nothing else, and can not write
+into the read only ones even as root.
+"""
+import os
+import subprocess
+
+# Where the directories given to the guests as hostfs= root are made
+HOSTFS_DIR = os.path.join('.cassilda', 'hostfs')
+
+def bind(source, target, readonly):
+    ''' Bind mount source in target, read only if readonly '''
+    subprocess.check_call(['mount', '--bind', source, target])
+    if readonly:
+        try:
+            subprocess.check_call(['mount', '-o', 'remount,bind,ro', target])
+        except:
+            subprocess.call(['umount', target])
+            raise
+
+def umount(path):
+    ''' Lazily unmount path if something is mounted there '''
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.call(['umount', '-l', path], stderr=devnull)
+    finally:
+        devnull.close()
+
+class HostfsExport:
+    """ The hostfs= root of the guest hostname, holding its shares, a
+    list of (host directory, readonly) """
+    def __init__(self, hostname, shares=None, directory=HOSTFS_DIR):
+        self.hostname = hostname
+        if shares == None:
+            shares = []
+        self.shares = shares
+        self.directory = os.path.abspath(os.path.join(directory, hostname))
+
+    def path(self, n):
+        ''' Where the n-th share is mounted '''
+        return os.path.join(self.directory, str(n))
+
+    def setup(self):
+        ''' Mount the shares below the directory, first removing what a
+        guest of the same name that died may have left '''
+        self.cleanup()
+        os.makedirs(self.directory)
+        try:
+            for n in range(len(self.shares)):
+                os.mkdir(self.path(n))
+            # The guest can not create anything next to the shares
+            bind(self.directory, self.directory, True)
+            for n in range(len(self.shares)):
+                host, readonly = self.shares[n]
+                bind(host, self.path(n), readonly)
+        except:
+            self.cleanup()
+            raise
+
+    def cleanup(self):
+        ''' Unmount the shares and remove the directory, once the guest
+        ended. The shares are found in the directory, so it can be done
+        without knowing them '''
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            umount(os.path.join(self.directory, name))
+        umount(self.directory)
+        for name in os.listdir(self.directory):
+            try:
+                os.rmdir(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
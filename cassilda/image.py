@@ -6,10 +6,15 @@ Image class module for cassilda framework
 import hashlib
 import os
 from .runner import *
+from . import sparse
+from . import sidecar
+from .hostfs import HostfsExport
 
 class Image:
     """Represents an installing or running Image"""
-    def __init__(self, name, size, memory, distribution, packages, install):
+    def __init__(self, name, size, memory, distribution, packages, install,
+            depends=None, hostfs=None, replicas=None, cpus=None,
+            cgroup=None, memory_dir=None, tests=None):
         self.name = name
         self.size = size
         self.memory = memory
@@ -20,7 +25,87 @@ class Image:
         self.runner = None
         self.install = install
         self.installers = []
+        # Names of the images whose installers must be ready before
+        # the installers of this one are run
+        if depends == None:
+            depends = []
+        self.depends = depends
+        # Instances started by Cassilda.run() (see replicas.py)
+        if replicas == None:
+            replicas = 1
+        self.replicas = int(replicas)
+        # Cpus the guest is pinned to and limits of its cgroup (see
+        # isolation.py)
+        self.cpus = cpus
+        self.cgroup = cgroup
+        # Where the memory of the guest is kept, None for the default
+        # of the profile
+        self.memory_dir = memory_dir
+        # (name, script) of the test: entries, in order
+        if tests == None:
+            tests = []
+        elif isinstance(tests, dict):
+            tests = [tests]
+        elif not isinstance(tests, list):
+            tests = [{ 'test': tests }]
+        self.tests = []
+        for t in tests:
+            for test, script in sorted(t.items()):
+                self.tests.append((test, script))
+        # Host directories shared with the guest through UML hostfs,
+        # a list of { 'host', 'guest', 'readonly' } dictionaries (see
+        # hostfs.py)
+        if hostfs == None:
+            hostfs = []
+        elif isinstance(hostfs, dict):
+            hostfs = [hostfs]
+        self.hostfs = []
+        for h in hostfs:
+            if 'host' not in h or 'guest' not in h:
+                raise ValueError('hostfs entries of image ' + name +
+                                    ' need a host and a guest path')
+            host = os.path.abspath(h['host'])
+            if host == '/':
+                raise ValueError('hostfs entries of image ' + name +
+                                    ' can not share the whole host (/)')
+            self.hostfs.append({ 'host': host, 'guest': h['guest'],
+                                 'readonly': h.get('readonly', True) })
 
     def already_installed(self):
         return os.path.exists(self.imagename)
 
+    def digest(self, workers=sparse.DIGEST_WORKERS):
+        """ Digest of the contents of the built image (see
+        sparse.digest()), None if it is not built. It is kept in the
+        <image>.digest sidecar and only computed again once the size or
+        the modification time of the image change """
+        if not self.already_installed():
+            return None
+        path = self.imagename + '.digest'
+        s = os.stat(self.imagename)
+        cached = sidecar.load(path, {})
+        if cached.get('size') == s.st_size and \
+                cached.get('mtime') == s.st_mtime:
+            return cached['digest']
+        digest = sparse.digest(self.imagename, workers)
+        after = os.stat(self.imagename)
+        # Not cached if the image changed while it was hashed
+        if (after.st_size, after.st_mtime) == (s.st_size, s.st_mtime):
+            sidecar.save(path, { 'size': s.st_size, 'mtime': s.st_mtime,
+                                    'digest': digest })
+        return digest
+
+    def hostfs_export(self, hostname):
+        """ The HostfsExport giving the shared directories to the guest
+        hostname (see hostfs.py), None if nothing is shared """
+        if self.hostfs == []:
+            return None
+        return HostfsExport(hostname,
+                    [(h['host'], h['readonly']) for h in self.hostfs])
+
+    def hostfs_mounts(self):
+        """ Return (guest path, path relative to the hostfs= root,
+        readonly) for every shared directory """
+        return [(self.hostfs[n]['guest'], '/' + str(n),
+                    self.hostfs[n]['readonly'])
+                for n in range(len(self.hostfs))]
@@ -0,0 +1,210 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Guest isolation
+
+Where a guest process runs: the cpus it is pinned to (with taskset) and
+an optional cgroup v2 group, below /sys/fs/cgroup/cassilda, with limits
+such as cpu.max, memory.max or io.weight. Both are applied by wrapping
+the command line of the hypervisor in a shell that moves itself into
+the cgroup before exec'ing it, so every thread and helper process of the
+guest is placed from the start.
+
+The cpus of an image are given in the profile as a list ('0-3,6'), as
+a number of cpus to pick automatically or as 'auto' (one cpu). The
+automatic ones are spread by a CpuAllocator over the least used cpus.
+"""
+import os
+import threading
+
+from .resources import parse_size, cpu_count
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_PARENT = 'cassilda'
+# Files of a cgroup that are not settings of a controller
+CGROUP_CORE = 'cgroup'
+# cpu.max period, in microseconds
+CPU_PERIOD = 100000
+
+def parse_cpus(cpus):
+    ''' List of cpu numbers in a list like '0-3,6'
+
+    >>> parse_cpus('0-3,6')
+    [0, 1, 2, 3, 6]
+    >>> parse_cpus([1, 2])
+    [1, 2]
+    '''
+    if isinstance(cpus, list):
+        return [int(c) for c in cpus]
+    r = []
+    for part in str(cpus).split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            r.extend(range(int(first), int(last) + 1))
+        elif part.strip() != '':
+            r.append(int(part))
+    return r
+
+def format_cpus(cpus):
+    ''' Inverse of parse_cpus()
+
+    >>> format_cpus([0, 1, 2, 3, 6])
+    '0-3,6'
+    '''
+    r = []
+    for c in sorted(cpus):
+        if r != [] and r[-1][1] == c - 1:
+            r[-1][1] = c
+        else:
+            r.append([c, c])
+    return ','.join([str(a) if a == b else str(a) + '-' + str(b)
+                        for a, b in r])
+
+def host_cpus():
+    ''' The cpus this process may run on '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(cpu_count()))
+
+class CpuAllocator:
+    """ Spreads the guests over the cpus of the host """
+    def __init__(self, cpus=None):
+        if cpus == None:
+            cpus = host_cpus()
+        self.cpus = cpus
+        self.lock = threading.Lock()
+        # Cpus given to each guest, by name
+        self.assigned = {}
+
+    def usage(self):
+        r = dict([(c, 0) for c in self.cpus])
+        for cpus in self.assigned.values():
+            for c in cpus:
+                if c in r:
+                    r[c] += 1
+        return r
+
+    def allocate(self, name, wanted):
+        ''' Cpus for the guest name given its cpus setting: None (any
+        cpu), a list, a number of cpus or 'auto' (one cpu). The
+        automatic ones are the least used '''
+        if wanted == None:
+            return None
+        self.lock.acquire()
+        try:
+            if wanted == 'auto':
+                wanted = 1
+            if isinstance(wanted, int):
+                usage = self.usage()
+                cpus = sorted(self.cpus, key=lambda c: (usage[c], c))
+                cpus = sorted(cpus[:min(wanted, len(cpus))])
+            else:
+                cpus = parse_cpus(wanted)
+            self.assigned[name] = cpus
+            return cpus
+        finally:
+            self.lock.release()
+
+    def release(self, name):
+        self.lock.acquire()
+        try:
+            self.assigned.pop(name, None)
+        finally:
+            self.lock.release()
+
+class Isolation:
+    """ Cpus and cgroup of one guest """
+    def __init__(self, name, cpus=None, cgroup=None, root=CGROUP_ROOT):
+        self.name = name
+        self.cpus = cpus
+        if cgroup == None:
+            cgroup = {}
+        self.cgroup = cgroup
+        self.root = root
+
+    def path(self, *names):
+        return os.path.join(self.root, CGROUP_PARENT, self.name, *names)
+
+    def write(self, path, value):
+        f = open(path, 'w')
+        try:
+            f.write(str(value))
+        finally:
+            f.close()
+
+    def limits(self):
+        ''' The cgroup files to write, with their values. Keys use '_'
+        for '.', sizes may have units and cpu_max may be a number of
+        cpus '''
+        r = {}
+        for key, value in self.cgroup.items():
+            name = key.replace('_', '.')
+            if name.startswith('memory.') and value != 'max':
+                value = parse_size(value)
+            elif name == 'cpu.max' and isinstance(value, (int, float)):
+                value = str(int(value * CPU_PERIOD)) + ' ' + str(CPU_PERIOD)
+            r[name] = value
+        return r
+
+    def read(self, path):
+        f = open(path, 'r')
+        try:
+            return f.read().split()
+        finally:
+            f.close()
+
+    def controllers(self):
+        ''' The controllers the limits are settings of (cpu for
+        cpu.max...) '''
+        r = set([name.split('.')[0] for name in self.limits()])
+        r.discard(CGROUP_CORE)
+        return sorted(r)
+
+    def enable(self, directory, controllers):
+        ''' Enable controllers for the children of the cgroup in
+        directory, the ones not enabled yet, raise ValueError if it does
+        not have some of them '''
+        available = self.read(os.path.join(directory, 'cgroup.controllers'))
+        missing = [c for c in controllers if c not in available]
+        if missing != []:
+            raise ValueError("The cgroup controllers " + ', '.join(missing) +
+                " needed by the limits of " + self.name + " are not " +
+                "available in " + directory)
+        path = os.path.join(directory, 'cgroup.subtree_control')
+        enabled = self.read(path)
+        controls = ['+' + c for c in controllers if c not in enabled]
+        if controls != []:
+            self.write(path, ' '.join(controls))
+
+    def setup(self):
+        ''' Create the cgroup of the guest with its limits, enabling
+        only the controllers they need '''
+        if self.cgroup == {}:
+            return
+        parent = os.path.join(self.root, CGROUP_PARENT)
+        if not os.path.exists(parent):
+            os.mkdir(parent)
+        controllers = self.controllers()
+        for d in (self.root, parent):
+            self.enable(d, controllers)
+        if not os.path.exists(self.path()):
+            os.mkdir(self.path())
+        for name, value in sorted(self.limits().items()):
+            self.write(self.path(name), value)
+
+    def wrap(self, arguments):
+        ''' The command line arguments running arguments isolated '''
+        if self.cpus != None:
+            arguments = ['taskset', '-c', format_cpus(self.cpus)] + arguments
+        if self.cgroup != {}:
+            arguments = ['sh', '-c', 'echo $$ > "$0" && exec "$@"',
+                            self.path('cgroup.procs')] + arguments
+        return arguments
+
+    def cleanup(self):
+        ''' Remove the cgroup, once the guest ended '''
+        if self.cgroup != {} and os.path.exists(self.path()):
+            try:
+                os.rmdir(self.path())
+            except OSError:
+                pass
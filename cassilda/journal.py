@@ -0,0 +1,91 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Session journal
+
+What the Cassilda controllers of a profile have running outside of
+their own processes, kept in a sidecar next to the profile
+(<profile>.session). Several controllers share it: every change is made
+on the journal read again holding its lock (see sidecar.lock()), and
+the guests and mounts are read again every time they are asked for:
+
+ * the guests: process (pid and start time, to tell it from a later
+   process with the same pid), backend, ptys of the spare login console
+   and of the guest agent, tap devices and (network, host) pairs set up
+   in the firewall, cgroup, cpus and copy on write file
+ * the image mounts of the builders, with the process that made them
+
+A new controller reads it back (Cassilda.recover()) to attach to the
+guests still running and to release what the dead ones and the dead
+builders left behind.
+"""
+import threading
+
+from . import sidecar
+from .resources import process_start, process_alive
+
+class Journal:
+    """ The session journal of a profile """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = self.load()
+
+    def load(self):
+        data = sidecar.load(self.path, {})
+        data.setdefault('guests', {})
+        data.setdefault('mounts', {})
+        return data
+
+    def update(self, function):
+        ''' Call function(data) on the journal as saved now, and save it
+        unless it returns False, holding the lock of the journal '''
+        self.lock.acquire()
+        try:
+            fd = sidecar.lock(self.path)
+            try:
+                self.data = self.load()
+                if function(self.data) != False:
+                    sidecar.save(self.path, self.data)
+            finally:
+                sidecar.unlock(fd)
+        finally:
+            self.lock.release()
+
+    def guests(self):
+        ''' Guest entries by name '''
+        self.data = self.load()
+        return dict(self.data['guests'])
+
+    def record_guest(self, name, entry):
+        ''' Add or replace the entry of the guest name. The process of
+        the guest is given by the 'pid' of the entry '''
+        entry = sidecar.normalize(entry)
+        entry['start'] = process_start(entry['pid'])
+        def record(data):
+            data['guests'][name] = entry
+        self.update(record)
+
+    def forget_guest(self, name):
+        self.update(lambda data: data['guests'].pop(name, None) != None)
+
+    def guest_alive(self, entry):
+        return process_alive(entry['pid'], entry.get('start'))
+
+    def mounts(self):
+        ''' Mount entries by mount point '''
+        self.data = self.load()
+        return dict(self.data['mounts'])
+
+    def record_mount(self, mountdir, imagepath, pid):
+        ''' Record that the process pid mounted imagepath in mountdir,
+        or that it was unmounted if imagepath is None '''
+        def record(data):
+            if imagepath == None:
+                return data['mounts'].pop(mountdir, None) != None
+            data['mounts'][mountdir] = { 'image': imagepath, 'pid': pid,
+                                            'start': process_start(pid) }
+        self.update(record)
+
+    def mount_alive(self, entry):
+        return process_alive(entry['pid'], entry.get('start'))
@@ -0,0 +1,35 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Build manifests
+
+Every built image carries a <image>.manifest sidecar recording the inputs
+used by each of its build steps (packages, hostname, network addresses,
+mac addresses and repository). A rebuild compares the profile against it
+and only runs the steps whose inputs changed.
+"""
+from . import sidecar
+
+class Manifest:
+    """ Inputs that produced each build step of an image """
+    def __init__(self, imagepath):
+        self.path = imagepath + '.manifest'
+        self.steps = sidecar.load(self.path, {})
+
+    def get(self, step):
+        ''' Return the inputs recorded for step, or None '''
+        return self.steps.get(step)
+
+    def changed(self, step, inputs):
+        ''' True if step was never run or was run with other inputs '''
+        return self.steps.get(step) != sidecar.normalize(inputs)
+
+    def record(self, step, inputs):
+        ''' Store the inputs of a step that just finished '''
+        self.steps[step] = sidecar.normalize(inputs)
+        sidecar.save(self.path, self.steps)
+
+    def clear(self):
+        ''' Forget every step, the image is going to be recreated '''
+        self.steps = {}
+        sidecar.remove(self.path)
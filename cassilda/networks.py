@@ -23,22 +23,23 @@ Typical usage:
 
     # Show assigned parameters for the network, returned
     # as a dictionary
-    >>> net.get_addresses()
-    {'broadcast': '192.168.0.255', 'ip': '192.168.0.1', \
-'netmask': '255.255.255.0', 'prefixlen': '24', \
-'network': '192.168.0.0'}
+    >>> sorted(net.get_addresses().items())
+    [('broadcast', '192.168.0.255'), ('ip', '192.168.0.1'), \
+('netmask', '255.255.255.0'), ('network', '192.168.0.0'), \
+('prefixlen', '24')]
 
     # Now register a new host, into the network,
     # If no address is supplied, the next avaliable
-    # one is used. Address is returned as a string
+    # one is used. Address and mac are returned as strings,
+    # the mac holds the offset of the address in the pools
     >>> net.register_host("hostname", "eth0")
-    ('192.168.0.1', 'de:ad:be:0:0:0')
+    ('192.168.0.1', 'de:ad:be:00:00:01')
 
     # Create a new network and add the host to it
     >>> net2 = nets.register_network("second")
 
     >>> net2.register_host("hostname", "eth1")
-    ('192.168.1.1', 'de:ad:be:1:0:0')
+    ('192.168.1.1', 'de:ad:be:00:01:01')
 
     # How many networks is this host connected to?
     >>> nh = nets.get_networks_by_host("hostname")
@@ -48,19 +49,39 @@ Typical usage:
 
     # Create a new host connected to the 'first' network
     >>> net.register_host("hostname2", "eth0")
-    ('192.168.0.3', 'de:ad:be:0:0:1')
+    ('192.168.0.3', 'de:ad:be:00:00:03')
 
     # Get all the hosts connected to the first network
     >>> net.get_hostnames()
     ['hostname', 'hostname2']
 
     # Print the network addresses and hosts
-    >>> nets
-    Network:  first
-        Host:  hostname 192.168.0.1 tap0 192.168.0.2 eth0 de:ad:be:0:0:0
-        Host:  hostname2 192.168.0.3 tap2 192.168.0.4 eth0 de:ad:be:0:0:1
-    Network:  second
-        Host:  hostname 192.168.1.1 tap1 192.168.1.2 eth1 de:ad:be:1:0:0
+    >>> print(nets)
+    Network: first
+        Host:  hostname 192.168.0.1 tap0 192.168.0.2 eth0 de:ad:be:00:00:01
+        Host:  hostname2 192.168.0.3 tap2 192.168.0.4 eth0 de:ad:be:00:00:03
+    Network: second
+        Host:  hostname 192.168.1.1 tap1 192.168.1.2 eth1 de:ad:be:00:01:01
+    <BLANKLINE>
+
+    # Addresses and tap devices of hosts that went away are reused
+    >>> net.unregister_host("hostname")
+    True
+    >>> net.register_host("hostname3", "eth0")
+    ('192.168.0.1', 'de:ad:be:00:00:01')
+    >>> net.get_host_by_name("hostname3").tapdevice
+    'tap0'
+
+    # Networks can be taken from larger pools, of any size up
+    # to a /8, and the state saved and restored between sessions
+    >>> big = Networks(['10.0.0.0/8'], 16)
+    >>> big.register_network("load").register_host("client", "eth0")
+    ('10.0.0.1', 'de:ad:be:00:00:01')
+    >>> big.register_network("more").register_host("client", "eth0")
+    ('10.1.0.1', 'de:ad:be:01:00:01')
+    >>> again = Networks.from_dict(big.to_dict())
+    >>> again["load"].register_host("client2", "eth0")
+    ('10.0.0.3', 'de:ad:be:00:00:03')
 """
 
 import netaddr
@@ -68,6 +89,67 @@ import netaddr
 import subprocess
 import re
 
+# Address space the networks are taken from by default, and their size
+DEFAULT_POOLS = ['192.168.0.0/16']
+DEFAULT_PREFIXLEN = 24
+# Macs are de:ad:be followed by the 24 bits offset of the guest address
+# in the pools, so the pools may not hold more than a /8
+MAC_PREFIX = 0xdeadbe
+MAC_SPACE = 1 << 24
+# Tap devices that can exist at once
+TAP_LIMIT = 1 << 16
+
+def format_mac(value):
+    """ Mac address, the way the kernel shows it, of a 48 bits number """
+    return ':'.join(['%02x' % ((value >> shift) & 0xff)
+                        for shift in range(40, -8, -8)])
+
+class Allocator:
+    """ Hands out the integers 0..size-1, keeping which are used in a
+    bitmap. Released ones are reused first; allocating, reserving and
+    releasing are O(1) (amortized) whatever the size """
+    def __init__(self, size):
+        self.size = size
+        self.bitmap = bytearray((size + 7) // 8)
+        # Integers below this one have been allocated at some point
+        self.cursor = 0
+        self.released = []
+        self.count = 0
+
+    def used(self, n):
+        return self.bitmap[n >> 3] & (1 << (n & 7)) != 0
+
+    def reserve(self, n):
+        """ Mark n as used, False if it already was """
+        if n < 0 or n >= self.size:
+            raise ValueError(str(n) + " is out of range")
+        if self.used(n):
+            return False
+        self.bitmap[n >> 3] |= 1 << (n & 7)
+        self.count += 1
+        return True
+
+    def allocate(self):
+        """ Return a free integer, None if there are none left """
+        while self.released != []:
+            n = self.released.pop()
+            # Reserved explicitly after being released
+            if self.reserve(n):
+                return n
+        while self.cursor < self.size:
+            n = self.cursor
+            self.cursor += 1
+            if self.reserve(n):
+                return n
+        return None
+
+    def release(self, n):
+        if not self.used(n):
+            return
+        self.bitmap[n >> 3] &= ~(1 << (n & 7)) & 0xff
+        self.count -= 1
+        self.released.append(n)
+
 class Host:
     """ Represents a host _in a network_, this is, one of the
     interfaces configured in a running/configured image"""
@@ -79,23 +161,36 @@ class Host:
         self.tapdevice = tapdevice
         self.tapaddress = tapaddress
         self.macaddress = macaddress
+
+    def to_dict(self):
+        return { 'name': self.name, 'address': self.address,
+                 'tapdevice': self.tapdevice, 'tapaddress': self.tapaddress,
+                 'internaldevice': self.internaldevice,
+                 'macaddress': self.macaddress }
  
 class Network:
     """ Represents a network between two or more configured
     or running images"""
-    def __init__(self, networks, name):
+    def __init__(self, networks, name, net=None):
         """ Constructor is called from Networks.register_network()
         not directly. Receives the networks object in wich it will
         be registered and the simbolic (i.e. 'first', 'second')
         name"""
         self.name = name
         self.networks = networks;
-        self.net =  networks.get_next_network()
-        self.hosts = []
+        if net == None:
+            net = networks.allocate_network()
+        self.net = net
+        # Hosts by name, and the order they were added in
+        self.hosts_by_name = {}
+        self.host_order = {}
+        self.next_order = 0
         # self.nat = False    # Nat is disabled by default
         self.nat = True     # Nat is disabled by default
-        self.next_host_address = netaddr.IPAddress(self.net.ip)
-        self.next_mac_address = self.get_net_macaddress()
+        # Every host takes a slot: two consecutive addresses, the one
+        # of the guest and the one of its tap device in the host,
+        # skipping the network address and the broadcast one
+        self.slots = Allocator((self.net.size - 2) // 2)
 
     def get_addresses(self):
         """ Return addresses of this network as a 
@@ -106,34 +201,63 @@ class Network:
             'netmask': str(self.net.netmask),
             'prefixlen': str(self.net.prefixlen) }
 
+    def slot_addresses(self, slot):
+        """ The guest and tap addresses of a slot """
+        a = netaddr.IPAddress(int(self.net.network) + 1 + 2 * slot)
+        return a, a + 1
+
     def register_host(self, name, internaldevice, address=None):
-        """ Register a hostname with the address got from
-        get_next_host_address()
-        If no address is forced, the host is created with
-        the next address avaliable, that is then returned
+        """ Register a hostname with the next free address of the
+        network, or with address if given (the tap device gets the
+        other one of its slot). The address and mac are returned
         """
         if self.get_address_of_host(name):
             raise ValueError("Trying to register the same host twice")
         if address == None:
-            a = netaddr.IPAddress(self.next_host_address)
-            self.next_host_address += 1
+            slot = self.slots.allocate()
+            if slot == None:
+                raise ValueError("No addresses left in network " +
+                                                            self.name)
+            a, b = self.slot_addresses(slot)
         else:
-            a = address
-        b = netaddr.IPAddress(self.next_host_address)
-        self.next_host_address += 1
-        m = str(self.next_mac_address)
-        self.next_mac_address.value += 1
-        host = Host(name, str(a), "tap" + str(self.networks.tapnumber),
-                                        str(b), internaldevice, str(m))
-        self.networks.tapnumber += 1
-        self.hosts.append(host)
+            a = netaddr.IPAddress(address)
+            if a not in self.net:
+                raise ValueError(str(a) + " is not in network " + self.name)
+            slot = (int(a) - int(self.net.network) - 1) // 2
+            if slot < 0 or slot >= self.slots.size or \
+                                        not self.slots.reserve(slot):
+                raise ValueError(str(a) + " is not available")
+            first, second = self.slot_addresses(slot)
+            if a == first:
+                b = second
+            else:
+                b = first
+        m = self.networks.mac_address(a)
+        self.add_host(Host(name, str(a), self.networks.allocate_tap(),
+                                        str(b), internaldevice, m))
         return str(a), m
 
-    def get_net_macaddress(self):
-        """ Return starting mac address for hosts in this network """
-        return netaddr.EUI('de-ad-be-' + "%2.2x" %
-            int((int(self.net.network)-3232235520)/256) +
-            '-00-00', dialect = netaddr.mac_unix)
+    def add_host(self, host):
+        self.hosts_by_name[host.name] = host
+        self.host_order[host.name] = self.next_order
+        self.next_order += 1
+
+    def get_hosts(self):
+        """ The hosts of the network, in the order they were added """
+        return sorted(self.hosts_by_name.values(),
+                            key=lambda h: self.host_order[h.name])
+
+    def unregister_host(self, name):
+        """ Release the addresses and tap device of a host """
+        host = self.get_host_by_name(name)
+        if host == None:
+            return False
+        a = netaddr.IPAddress(host.address)
+        self.slots.release((int(a) - int(self.net.network) - 1) // 2)
+        self.networks.release_tap(host.tapdevice)
+        del self.hosts_by_name[name]
+        del self.host_order[name]
+        return True
 
     def get_address_of_host(self, name):
         """ Returns address of named host in this network """
@@ -144,35 +268,46 @@ class Network:
 
     def get_host_by_name(self, name):
         """ Returns Host object for the named host in this network"""
-        for host in self.hosts:
-            if host.name == name:
-                return host
-        return None
+        return self.hosts_by_name.get(name)
 
     def get_hostnames(self):
         """ Return all the hostnames registered to a certain network
         mostly for debugging purposes """
         r = []
-        for host in self.hosts:
+        for host in self.get_hosts():
             r.append(host.name)
         return r
 
+    def to_dict(self):
+        return { 'name': self.name, 'net': str(self.net), 'nat': self.nat,
+                 'hosts': [h.to_dict() for h in self.get_hosts()] }
+
 class Networks:
     """ Class that keeps track of all the networks in a
     Cassilda session"""
 
-    def __init__(self):
-        """ Networks constructor. Nothing special here """
+    def __init__(self, pools=None, prefixlen=DEFAULT_PREFIXLEN):
+        """ Networks constructor. The networks are carved, with the
+        given prefix length, from the pools (a list of CIDR blocks) """
+        if pools == None:
+            pools = DEFAULT_POOLS
+        self.pools = [netaddr.IPNetwork(p).cidr for p in pools]
+        self.prefixlen = prefixlen
+        if sum([p.size for p in self.pools]) > MAC_SPACE:
+            raise ValueError("The address pools can not be larger than a /8")
+        for p in self.pools:
+            if p.prefixlen > prefixlen:
+                raise ValueError("Pool " + str(p) + " is smaller than a /" +
+                                                            str(prefixlen))
+        # Networks used in each pool
+        self.subnets = [Allocator(p.size >> (32 - prefixlen))
+                                                    for p in self.pools]
         self.networks = []
-        self.currnet = None
-        self.get_next_network(first_address='192.168.0.1')
-        # Tapnumber is global and, for the moment "predicted"
-        # (this is, we suppose that the only ones creating
-        # tap devices in the system are us and thus devices
-        # will appear in order
-        # TODO: Use the actual tap devices that are created
-        # when the UML kernel is launched
-        self.tapnumber = 0
+        # Tap devices are handed out by us, so the numbers are
+        # "predicted" (this is, we suppose that the only ones creating
+        # tap devices in the system are us)
+        self.taps = Allocator(TAP_LIMIT)
+        self.routes = None
 
     def __check_output(self, *popenargs):
         """ Implementation of the convenient Python3
@@ -180,39 +315,100 @@ class Networks:
         process = subprocess.Popen(*popenargs, stdout=subprocess.PIPE)
         output, unused_err = process.communicate()
         retcode = process.poll()
-        return output
-   
+        return output.decode()
+
+    def host_routes(self):
+        """ The networks of the routes of the host, and the network of
+        its default gateway (as a /24), read once """
+        if self.routes == None:
+            self.routes = []
+            try:
+                output = self.__check_output(['ip', 'route', 'list'])
+            except OSError:
+                output = ''
+            for line in output.splitlines():
+                fields = line.split()
+                if fields[:2] == ['default', 'via']:
+                    self.routes.append(netaddr.IPNetwork(fields[2] + '/24'))
+                elif fields != [] and fields[0] != 'default':
+                    try:
+                        self.routes.append(netaddr.IPNetwork(fields[0]))
+                    except (netaddr.AddrFormatError, ValueError):
+                        pass
+        return self.routes
+
     # But what happens if my network is already 192.168.X.0/24 ?
     def conflicting_network(self, net): 
-        process = subprocess.Popen(['ip', 'route', 'list'], stdout=subprocess.PIPE)
-        output, unused_err = process.communicate()
-        retcode = process.poll()
-        di = output.find('default via ')
-        if di == -1:
-            # No default, so no conflict possible 
-            return False 
-        gwaddr = output[output.find('default via ')+12:-1]
-        gwaddr = gwaddr[0:gwaddr.find('dev')-1]
-        if net.ip in list(netaddr.IPNetwork(gwaddr+'/24')):
-            return  True
+        """ True if net overlaps a network the host already routes """
+        for route in self.host_routes():
+            if route.prefixlen == 0:
+                continue
+            if net.first <= route.last and route.first <= net.last:
+                return True
         return False
 
-    def get_next_network(self, first_address=None):
-        """ Return next address for network. Only called from Network
-        object"""
-        if first_address:
-            self.next_address = netaddr.IPAddress(first_address)
-        oldnet = self.currnet
-        self.currnet = netaddr.IPNetwork(str(self.next_address) + '/24')
-        if self.conflicting_network(self.currnet):
-#            There is a conflict between our current'
-#            default gw and the one asked'
-#            for the guest. never mind,'
-#            we just skip to the next avaliable network :)'
-            self.next_address += 256
-            self.currnet = netaddr.IPNetwork(str(self.next_address) + '/24')
-        self.next_address += 256
-        return oldnet
+    def allocate_network(self):
+        """ Return the next free network of the pools (with the address
+        of its first host as ip), skipping the ones the host uses """
+        for n in range(len(self.pools)):
+            while True:
+                index = self.subnets[n].allocate()
+                if index == None:
+                    break
+                net = netaddr.IPNetwork(str(netaddr.IPAddress(
+                        int(self.pools[n].network) +
+                        (index << (32 - self.prefixlen)) + 1)) +
+                        '/' + str(self.prefixlen))
+                # There is a conflict between our current default gw
+                # and the one asked for the guest. never mind, we just
+                # skip to the next avaliable network :)
+                # (it stays marked as used)
+                if not self.conflicting_network(net):
+                    return net
+        raise ValueError("No networks left in the pools")
+
+    def release_network(self, network_name):
+        """ Forget a network and its hosts, so its addresses can be
+        used again """
+        network = self[network_name]
+        if network == None:
+            return False
+        for name in network.get_hostnames():
+            network.unregister_host(name)
+        n, index = self.locate(network.net)
+        self.subnets[n].release(index)
+        self.networks.remove(network)
+        return True
+
+    def locate(self, address):
+        """ The (pool number, network index in the pool) of an address """
+        a = netaddr.IPNetwork(address).ip
+        for n in range(len(self.pools)):
+            if a in self.pools[n]:
+                return n, (int(a) - int(self.pools[n].network)) >> \
+                                                    (32 - self.prefixlen)
+        raise ValueError(str(address) + " is not in the address pools")
+
+    def mac_address(self, address):
+        """ Mac of the guest with address: its offset in the pools, so
+        no two guests get the same one """
+        a = netaddr.IPAddress(address)
+        offset = 0
+        for p in self.pools:
+            if a in p:
+                return format_mac((MAC_PREFIX << 24) | (offset + int(a) -
+                                                    int(p.network)))
+            offset += p.size
+        raise ValueError(str(address) + " is not in the address pools")
+
+    def allocate_tap(self):
+        n = self.taps.allocate()
+        if n == None:
+            raise ValueError("No tap devices left")
+        return "tap" + str(n)
+
+    def release_tap(self, tapdevice):
+        self.taps.release(int(tapdevice[3:]))
 
     def register_network(self, network_name):
         """ Create new network and register network by address """
@@ -220,6 +416,47 @@ class Networks:
         self.networks.append(network)
         return network
 
+    def unregister_host(self, hostname):
+        """ Release the addresses and taps of a host in every network """
+        for n in self.get_networks_by_host(hostname):
+            n.unregister_host(hostname)
+
+    def to_dict(self):
+        """ The state of the networks, to be restored with from_dict() """
+        return { 'pools': [str(p) for p in self.pools],
+                 'prefixlen': self.prefixlen,
+                 'networks': [n.to_dict() for n in self.networks] }
+
+    @staticmethod
+    def from_dict(state):
+        """ Networks with the state returned by to_dict() """
+        networks = Networks(state['pools'], state['prefixlen'])
+        networks.restore(state)
+        return networks
+
+    def restore(self, state):
+        """ Replace, in place, the networks with the ones of the state
+        returned by to_dict() of Networks with the same pools """
+        self.subnets = [Allocator(p.size >> (32 - self.prefixlen))
+                                                    for p in self.pools]
+        self.taps = Allocator(TAP_LIMIT)
+        networks = []
+        for n in state['networks']:
+            net = netaddr.IPNetwork(n['net'])
+            pool, index = self.locate(net)
+            self.subnets[pool].reserve(index)
+            network = Network(self, n['name'], net)
+            network.nat = n['nat']
+            for h in n['hosts']:
+                a = netaddr.IPAddress(h['address'])
+                network.slots.reserve((int(a) - int(net.network) - 1) // 2)
+                self.taps.reserve(int(h['tapdevice'][3:]))
+                network.add_host(Host(h['name'], h['address'],
+                    h['tapdevice'], h['tapaddress'], h['internaldevice'],
+                    h['macaddress']))
+            networks.append(network)
+        self.networks = networks
+
     def __getitem__(self, key):
         """ Return the network object referenced by name """
         for network in self.networks:
@@ -249,6 +486,16 @@ class Networks:
                 r.append(n)
         return r
 
+    def register_replica(self, hostname, replicaname):
+        """ Register replicaname in every network hostname is in, with
+        the same internal devices, its own tap, addresses and mac.
+        Return its host objects, reusing the ones already registered """
+        for n in self.get_networks_by_host(hostname):
+            if n.get_host_by_name(replicaname) == None:
+                n.register_host(replicaname,
+                        n.get_host_by_name(hostname).internaldevice)
+        return self.get_hosts_by_name(replicaname)
+
     def get_hosts_by_name(self, hostname):
         """ Return all the host objects associated to a name """
         r = []
@@ -263,7 +510,7 @@ class Networks:
         rep = ""
         for n in self.networks:
             rep += "Network: " + n.name + "\n"
-            for h in n.hosts:
+            for h in n.get_hosts():
                 rep += "    Host: " + " " + h.name + " " + h.address + " " 
                 rep += h.tapdevice + " " + h.tapaddress + " " 
                 rep += h.internaldevice + " " + h.macaddress + "\n"
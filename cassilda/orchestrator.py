@@ -0,0 +1,160 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Installer orchestration
+
+Installers and images may declare the ones they depend on::
+
+    --- !installer
+    name: apache
+    depends: [ mysql ]          # mysql must be running first
+    ...
+    --- !image
+    name: webclient_host
+    depends: [ apache_server ]  # every installer of apache_server
+    ...
+
+The Orchestrator turns the installers of the requested images (and of
+the images they depend on) into a plan (see plan.Plan) with one
+operation per (image, installer) pair. Independent guests are started
+and installed at the same time, and each dependent installer starts as
+soon as its prerequisites are ready (install and run scripts done).
+teardown() runs the stop scripts in the reverse order.
+"""
+import threading
+
+from .plan import Operation, Plan
+
+# Seconds to wait for the login prompt of a booting image
+BOOT_TIMEOUT = 300
+
+class InstallerOperation(Operation):
+    """ Install and run one installer in one image """
+    kind = 'installer'
+    resources = []
+    cost = 60
+
+    def __init__(self, image, installer, deps):
+        Operation.__init__(self, image.name, { 'installer': installer.name },
+                                                                    deps)
+        self.image = image
+        self.installer = installer
+
+    def run(self, orchestrator):
+        return orchestrator.run_installer(self.image, self.installer)
+
+    def __repr__(self):
+        return (self.key[:8] + " " + self.kind + " " + self.installer.name +
+                                                " in " + self.image.name)
+
+class Orchestrator:
+    """ Runs the installers of the images of a Cassilda profile in
+    dependency order """
+    def __init__(self, cas, boot_timeout=BOOT_TIMEOUT):
+        self.cas = cas
+        self.boot_timeout = boot_timeout
+        self.lock = threading.Lock()
+        self.image_locks = {}
+        # (image, installer) pairs in the order they became ready
+        self.ready = []
+
+    def prerequisites(self, image, installer):
+        ''' Return the (image, installer) pairs that must be ready
+        before installer is run in image '''
+        r = []
+        for name in installer.depends:
+            pairs = self.cas.get_installer_by_name(name)
+            if pairs == []:
+                raise Exception('Installer ' + installer.name +
+                    ' depends on ' + name + ', not used by any image')
+            r.extend(pairs)
+        for name in image.depends:
+            other = self.cas[name]
+            if other == None:
+                raise Exception('Image ' + image.name + ' depends on ' +
+                    name + ', that is not in the profile')
+            for ins in other.installers:
+                r.append((other, ins))
+        return r
+
+    def plan(self, names=None):
+        ''' Return the plan to install the named images (all if None),
+        including the installers they depend on '''
+        plan = Plan(self)
+        operations = {}
+        visiting = []
+        def add(image, installer):
+            node = (image.name, installer.name)
+            if node in operations:
+                return operations[node]
+            if node in visiting:
+                raise Exception('Circular dependency between installers: ' +
+                    installer.name + ' in ' + image.name)
+            visiting.append(node)
+            deps = [add(i, ins) for i, ins in
+                        self.prerequisites(image, installer)]
+            visiting.remove(node)
+            operations[node] = plan.add(InstallerOperation(image, installer,
+                                                                    deps))
+            return operations[node]
+        if names == None:
+            names = [i.name for i in self.cas.images]
+        for name in names:
+            image = self.cas[name]
+            if image == None:
+                raise Exception('Image ' + name + ' is not in the profile')
+            for installer in image.installers:
+                add(image, installer)
+        return plan
+
+    def start_image(self, image):
+        ''' Run the image (once, even if several installers ask for it
+        at the same time) and wait until it can be logged in '''
+        self.lock.acquire()
+        try:
+            if image.name not in self.image_locks:
+                self.image_locks[image.name] = threading.Lock()
+            lock = self.image_locks[image.name]
+        finally:
+            self.lock.release()
+        lock.acquire()
+        try:
+            if image.runner == None or not image.runner.running():
+                # Firewall and tap setup are not thread safe
+                self.lock.acquire()
+                try:
+                    self.cas.run(image.name)
+                finally:
+                    self.lock.release()
+            image.runner.login(self.boot_timeout)
+            return image.runner
+        finally:
+            lock.release()
+
+    def run_installer(self, image, installer):
+        ''' Install and run installer in image, that is started first
+        if it was not running '''
+        self.start_image(image)
+        print('install: Installing ' + installer.name + ' into ' + image.name)
+        installer.execute(installer.install)
+        installer.execute(installer.run)
+        self.lock.acquire()
+        try:
+            self.ready.append((image, installer))
+        finally:
+            self.lock.release()
+        return True
+
+    def install(self, names=None, limits=None):
+        ''' Plan and execute the installers of the named images '''
+        return self.plan(names).execute(limits)
+
+    def teardown(self):
+        ''' Run the stop scripts in the reverse order of readiness '''
+        while self.ready != []:
+            image, installer = self.ready.pop()
+            if image.runner == None or not image.runner.running():
+                continue
+            print('teardown: Stopping ' + installer.name + ' in ' +
+                                                            image.name)
+            installer.execute(installer.stop)
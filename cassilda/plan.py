@@ -0,0 +1,351 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Build plans
+
+A Planner turns the images of a profile into a DAG of typed operations
+(create, format, bootstrap, install-packages, configure-net,
+configure-mac, set-repo, configure-hostfs). Operations are identified by
+a hash of their contents, so two images sharing the same base only
+debootstrap it once.
+An Executor runs the plan with bounded parallelism per resource class,
+so the filesystem of one image can be formatted while another one is
+installing packages in its chroot.
+
+Typical usage::
+
+    plan = cas.plan()
+    print(plan)                 # Operations and expected critical path
+    plan.execute({'network': 1})
+"""
+import hashlib
+import json
+import os
+import threading
+
+from .manifest import Manifest
+from .resources import cpu_count
+from .debian_squeeze_builder import debian_squeeze_Builder
+
+# Default number of operations that may hold each resource at once
+DEFAULT_LIMITS = { 'disk': 2, 'network': 2, 'loop': 4 }
+
+def print_line(line):
+    '''Default Executor callback to print a line'''
+    print(line)
+
+class Operation:
+    """ A node in a build plan. Inheritors define its kind, the resource
+    classes it holds while running, its estimated cost in seconds and
+    what running it means """
+    kind = None
+    resources = []
+    cost = 1
+
+    def __init__(self, target, params, deps):
+        self.target = target
+        self.params = params
+        self.deps = deps
+        content = json.dumps([self.kind, target, params,
+                                sorted([d.key for d in deps])])
+        self.key = hashlib.sha1(content.encode()).hexdigest()
+
+    def run(self, planner):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return self.key[:8] + " " + self.kind + " " + self.target
+
+class CreateOperation(Operation):
+    kind = 'create'
+    resources = ['disk']
+    cost = 1
+
+    def run(self, planner):
+        return planner.builder().create_image(self.target,
+                                                self.params['size'])
+
+class FormatOperation(Operation):
+    kind = 'format'
+    resources = ['disk', 'cpu']
+    cost = 10
+
+    def run(self, planner):
+        return planner.builder().make_filesystem(self.target)
+
+class BootstrapOperation(Operation):
+    """ Run the first install phase of the builder (debootstrap) on a
+    base image that is then shared by all the images using it """
+    kind = 'bootstrap'
+    resources = ['network', 'loop', 'disk']
+    cost = 600
+
+    def run(self, planner):
+        b = planner.builder()
+        name, key, function = b.phases(None, self.target,
+                                        self.params['repository'])[0]
+        try:
+            r = function()
+        finally:
+            b.cleanup_mounts()
+        if r != False:
+            Manifest(self.target).record('bootstrap', self.params)
+            planner.cas.store.touch(self.target, 'layer')
+        return r
+
+class InstallPackagesOperation(Operation):
+    """ Copy the bootstrapped base into the image and run the rest of
+    the install phases on it """
+    kind = 'install-packages'
+    resources = ['network', 'loop', 'disk', 'cpu']
+    cost = 300
+
+    def run(self, planner):
+        image = planner.cas[self.params['image']]
+        steps = planner.cas.build_steps(image)
+        manifest = Manifest(image.imagename)
+        manifest.clear()
+        b = planner.builder()
+        planner.cas.store.touch(self.params['base'], 'layer')
+        b.copy_image(self.params['base'], image.imagename)
+        for name, key, function in b.phases(image.packages, image.imagename,
+                                        self.params['repository'])[1:]:
+            try:
+                r = function()
+            finally:
+                b.cleanup_mounts()
+            if r == False:
+                return False
+        b.set_hostname(image.name, image.imagename)
+        manifest.record('install', steps['install'])
+        manifest.record('hostname', steps['hostname'])
+        return True
+
+class ConfigureOperation(Operation):
+    """ Run one of the configuration steps of Cassilda on an image """
+    resources = ['loop']
+    cost = 3
+    step = None
+
+    def run(self, planner):
+        image = planner.cas[self.params['image']]
+        planner.cas.configure(planner.builder(), image,
+                Manifest(image.imagename), self.step, self.params['inputs'])
+        return True
+
+class ConfigureNetOperation(ConfigureOperation):
+    kind = 'configure-net'
+    step = 'network'
+
+class ConfigureMacOperation(ConfigureOperation):
+    kind = 'configure-mac'
+    step = 'mac'
+
+class SetRepoOperation(ConfigureOperation):
+    kind = 'set-repo'
+    step = 'repository'
+
+class ConfigureHostfsOperation(ConfigureOperation):
+    kind = 'configure-hostfs'
+    step = 'hostfs'
+
+CONFIGURE_OPERATIONS = [ConfigureNetOperation, ConfigureMacOperation,
+                        SetRepoOperation, ConfigureHostfsOperation]
+
+class Plan:
+    """ A DAG of operations, deduplicated by content hash """
+    def __init__(self, planner):
+        self.planner = planner
+        self.operations = []
+        self.by_key = {}
+
+    def add(self, operation):
+        ''' Add operation to the plan, returning the identical one
+        already there if any '''
+        if operation.key in self.by_key:
+            return self.by_key[operation.key]
+        self.by_key[operation.key] = operation
+        self.operations.append(operation)
+        return operation
+
+    def critical_path(self):
+        ''' Return (estimated seconds, [operations]) of the longest
+        chain of dependent operations '''
+        finish = {}
+        previous = {}
+        # Operations are always added after their dependencies
+        for op in self.operations:
+            start = 0
+            previous[op.key] = None
+            for d in op.deps:
+                if finish[d.key] > start:
+                    start = finish[d.key]
+                    previous[op.key] = d
+            finish[op.key] = start + op.cost
+        if self.operations == []:
+            return 0, []
+        last = self.operations[0]
+        for op in self.operations:
+            if finish[op.key] > finish[last.key]:
+                last = op
+        path = []
+        op = last
+        while op != None:
+            path.insert(0, op)
+            op = previous[op.key]
+        return finish[last.key], path
+
+    def execute(self, limits=None, log_callback=None):
+        ''' Run the plan, see Executor '''
+        return Executor(self, limits, log_callback).run()
+
+    def __repr__(self):
+        rep = ""
+        for op in self.operations:
+            rep += repr(op) + " [" + ",".join(op.resources) + "]\n"
+            for d in op.deps:
+                rep += "    after " + repr(d) + "\n"
+        cost, path = self.critical_path()
+        rep += "Critical path (~%ds):\n" % cost
+        for op in path:
+            rep += "    " + repr(op) + "\n"
+        return rep
+
+class Planner:
+    """ Turns the images of a Cassilda profile into a Plan, leaving out
+    the steps that the manifest of already built images says are
+    up to date """
+    def __init__(self, cas, builder_class=debian_squeeze_Builder):
+        self.cas = cas
+        self.builder_class = builder_class
+
+    def builder(self):
+        ''' A new builder, each operation uses its own mount point '''
+        b = self.builder_class()
+        b.mount_callback = self.cas.journal_mount
+        return b
+
+    def base_image(self, image):
+        ''' Path of the bootstrapped base shared by similar images '''
+        content = json.dumps([image.distribution, image.size,
+                                self.cas.repository])
+        return (image.distribution + "-base-" +
+                    hashlib.sha1(content.encode()).hexdigest()[:8] + ".img")
+
+    def plan(self, names=None, force=False):
+        ''' Return the Plan to build the named images (all if None) '''
+        plan = Plan(self)
+        if names == None or names == []:
+            names = [i.name for i in self.cas.images]
+        for name in names:
+            image = self.cas[name]
+            if image == None:
+                raise Exception('Image ' + name + ' is not in the profile')
+            self.plan_image(plan, image, force)
+        return plan
+
+    def plan_image(self, plan, image, force):
+        steps = self.cas.build_steps(image)
+        manifest = Manifest(image.imagename)
+        fresh = (force or not image.already_installed() or
+                    manifest.changed('install', steps['install']))
+        last = None
+        if fresh:
+            base = self.base_image(image)
+            repo = { 'repository': self.cas.repository }
+            deps = []
+            if (not os.path.exists(base) or
+                    Manifest(base).changed('bootstrap', repo)):
+                create = plan.add(CreateOperation(base,
+                                        { 'size': image.size }, []))
+                fmt = plan.add(FormatOperation(base, {}, [create]))
+                deps = [plan.add(BootstrapOperation(base, repo, [fmt]))]
+            last = plan.add(InstallPackagesOperation(image.imagename,
+                { 'image': image.name, 'base': base,
+                  'repository': self.cas.repository }, deps))
+        for opclass in CONFIGURE_OPERATIONS:
+            inputs = steps[opclass.step]
+            if fresh or manifest.changed(opclass.step, inputs):
+                deps = []
+                if last != None:
+                    deps = [last]
+                last = plan.add(opclass(image.imagename,
+                    { 'image': image.name, 'inputs': inputs }, deps))
+
+class Executor:
+    """ Runs a Plan, each operation in its own thread as soon as its
+    dependencies are done, holding at most limits[resource] operations
+    per resource class at once """
+    def __init__(self, plan, limits=None, log_callback=None):
+        self.plan = plan
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits['cpu'] = cpu_count()
+        if limits != None:
+            self.limits.update(limits)
+        self.semaphores = {}
+        for resource in self.limits:
+            self.semaphores[resource] = \
+                threading.BoundedSemaphore(self.limits[resource])
+        if log_callback == None:
+            self.log_callback = print_line
+        else:
+            self.log_callback = log_callback
+        self.condition = threading.Condition()
+        self.done = {}
+        self.failed = {}
+        self.running = {}
+
+    def log(self, line):
+        self.log_callback(line)
+
+    def run_operation(self, op):
+        resources = sorted(op.resources)
+        for r in resources:
+            self.semaphores[r].acquire()
+        try:
+            self.log("Running " + repr(op))
+            error = None
+            try:
+                if op.run(self.plan.planner) == False:
+                    error = Exception(repr(op) + " failed")
+            except Exception as e:
+                error = e
+        finally:
+            for r in reversed(resources):
+                self.semaphores[r].release()
+        self.condition.acquire()
+        try:
+            del self.running[op.key]
+            if error == None:
+                self.done[op.key] = op
+            else:
+                self.log("Failed " + repr(op) + ": " + str(error))
+                self.failed[op.key] = error
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        ''' Run the plan, raising the first error found once every
+        running operation has finished '''
+        pending = list(self.plan.operations)
+        self.condition.acquire()
+        try:
+            while True:
+                if self.failed == {}:
+                    for op in list(pending):
+                        if all([d.key in self.done for d in op.deps]):
+                            pending.remove(op)
+                            self.running[op.key] = op
+                            t = threading.Thread(target=self.run_operation,
+                                                    args=(op,))
+                            t.daemon = True
+                            t.start()
+                if self.running == {}:
+                    break
+                self.condition.wait()
+        finally:
+            self.condition.release()
+        if self.failed != {}:
+            raise list(self.failed.values())[0]
+        return True
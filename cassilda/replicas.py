@@ -0,0 +1,156 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Image replicas
+
+Many instances of one built image can run at once, each one writing
+into its own copy on write disk so the image is never modified. Every
+replica is a host of its own in the networks of the image (tap device,
+addresses and mac given by Networks.register_replica) and gets a
+hostname with a numeric suffix. The image is not rebuilt for them: the
+runner passes the settings of the replica in the kernel command line
+and REPLICA_SCRIPT, installed in the images by the builders, applies
+them at boot before anything else runs.
+
+The replicas of an image are driven together through a ReplicaGroup::
+
+    group = cas.run('web_client', count=30)
+    group.execute('ab -n 1000 http://apache_server/')
+    group.teardown()
+"""
+import os
+import threading
+
+from . import transfer
+
+# Where the builders install REPLICA_SCRIPT, run from inittab
+REPLICA_SCRIPT_PATH = '/usr/local/sbin/cassilda-replica'
+
+# Rewrites the hostname, the addresses, gateways and macs of the
+# interfaces and the repository address (the old gateway) with the
+# cassilda.hostname= and cassilda.if=device,address,mac,gateway
+# arguments of the kernel command line. Does nothing without them
+REPLICA_SCRIPT = r'''#!/bin/sh
+# Settings of a replica given by the runner in the kernel command line
+[ -r /proc/cmdline ] || mount -n -t proc proc /proc
+name=
+for o in $(cat /proc/cmdline); do
+    case "$o" in
+        cassilda.hostname=*) name="${o#cassilda.hostname=}" ;;
+    esac
+done
+[ -n "$name" ] || exit 0
+mount -n -o remount,rw /
+echo "$name" > /etc/hostname
+for o in $(cat /proc/cmdline); do
+    case "$o" in
+        cassilda.if=*)
+            set -- $(echo "${o#cassilda.if=}" | tr , ' ')
+            old=$(sed -n "/^iface $1 /,/^auto/ s/^\tgateway //p" \
+                /etc/network/interfaces | sed 's/\./\\./g')
+            sed -i "/^iface $1 /,/^auto/ {
+                s/^\taddress .*/\taddress $2/
+                s/^\tgateway .*/\tgateway $4/
+            }" /etc/network/interfaces
+            sed -i "/NAME=\"$1\"/ \
+                s/ATTR{address}==\"[^\"]*\"/ATTR{address}==\"$3\"/" \
+                /etc/udev/rules.d/70-persistent-net.rules
+            [ -z "$old" ] || sed -i "s/$old/$4/" /etc/apt/sources.list
+            ;;
+    esac
+done
+mount -n -o remount,ro /
+'''
+
+def replica_name(name, n):
+    ''' Hostname of the n-th (from 1) replica of an image '''
+    return name + '-' + str(n)
+
+def kernel_args(name, hosts):
+    ''' Kernel command line arguments read by REPLICA_SCRIPT for the
+    replica name with the networks.Host objects hosts '''
+    r = ['cassilda.hostname=' + name]
+    for h in hosts:
+        r.append('cassilda.if=' + ','.join([h.internaldevice, str(h.address),
+                                    h.macaddress, str(h.tapaddress)]))
+    return r
+
+class ReplicaGroup:
+    """ The running replicas of an image, driven as a whole. Every
+    method runs at once in all of them """
+    def __init__(self, cas, image):
+        self.cas = cas
+        self.image = image
+        # (replica name, Runner), in order
+        self.replicas = []
+
+    def add(self, name, runner):
+        self.replicas.append((name, runner))
+
+    def names(self):
+        return [name for name, runner in self.replicas]
+
+    def __getitem__(self, name):
+        for n, runner in self.replicas:
+            if n == name:
+                return runner
+        return None
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def running(self):
+        ''' Names of the replicas still running '''
+        return [name for name, runner in self.replicas if runner.running()]
+
+    def map(self, function):
+        ''' Call function(runner) for every replica, each in its own
+        thread. Return a dictionary of results by replica name, raise
+        the first error once all of them ended '''
+        results = {}
+        errors = []
+        def call(name, runner):
+            try:
+                results[name] = function(runner)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call, args=(name, runner))
+                        for name, runner in self.replicas]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors != []:
+            raise errors[0]
+        return results
+
+    def login(self, timeout=-1):
+        return self.map(lambda runner: runner.login(timeout))
+
+    def execute(self, command, timeout=-1):
+        ''' Run command in every replica, return their (exit status,
+        output) by replica name '''
+        return self.map(lambda runner: runner.execute(command, timeout))
+
+    def push(self, source, destination):
+        ''' Stream source into destination of every replica at once '''
+        return transfer.push([runner.transport()
+                    for name, runner in self.replicas], source, destination)
+
+    def shutdown(self, timeout=60):
+        return self.map(lambda runner: runner.shutdown(timeout))
+
+    def teardown(self, timeout=60):
+        ''' Stop the replicas, remove their firewall settings and copy
+        on write disks and give back their addresses '''
+        try:
+            self.shutdown(timeout)
+        finally:
+            for name, runner in self.replicas:
+                self.cas.finish(name)
+                if runner.cow != None and os.path.exists(runner.cow):
+                    os.remove(runner.cow)
+                self.cas.release_replica(name)
+            if self.cas.replicas.get(self.image.name) == self:
+                del self.cas.replicas[self.image.name]
+            self.replicas = []
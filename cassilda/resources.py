@@ -0,0 +1,153 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Host resources
+
+What the host has to offer to the guests: cpus, memory (from
+/proc/meminfo) and load (from /proc/loadavg), and the sizes written in
+the profiles ('128m', '4G'...) in bytes. Also the directories where
+the hypervisors keep the memory of the guests.
+"""
+import os
+
+SIZE_UNITS = { 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4 }
+
+def parse_size(size):
+    ''' Bytes in a size with an optional k, m, g or t suffix
+
+    >>> parse_size('128m')
+    134217728
+    >>> parse_size('1G') == 1024 * parse_size('1M')
+    True
+    >>> parse_size(4000)
+    4000
+    '''
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().lower()
+    if size[-1:] == 'b':
+        size = size[:-1]
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+def cpu_count():
+    ''' Number of cpus of the host '''
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+def meminfo(path='/proc/meminfo'):
+    ''' Dictionary of the fields of /proc/meminfo, in bytes '''
+    r = {}
+    f = open(path, 'r')
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            value = int(fields[1])
+            if len(fields) > 2 and fields[2] == 'kB':
+                value *= 1024
+            r[fields[0].rstrip(':')] = value
+    finally:
+        f.close()
+    return r
+
+def available_memory(path='/proc/meminfo'):
+    ''' Bytes that can be given to new processes without swapping '''
+    info = meminfo(path)
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    # Kernels older than 3.14
+    return info.get('MemFree', 0) + info.get('Buffers', 0) + \
+                                            info.get('Cached', 0)
+
+def loadavg(path='/proc/loadavg'):
+    ''' The 1, 5 and 15 minutes load averages '''
+    f = open(path, 'r')
+    try:
+        return [float(v) for v in f.read().split()[:3]]
+    finally:
+        f.close()
+
+# Filesystems keeping their files in memory
+MEMORY_FILESYSTEMS = ['tmpfs', 'hugetlbfs', 'ramfs']
+
+def filesystem_type(path, mounts='/proc/mounts'):
+    ''' Type of the filesystem path is in, from the longest mount point
+    containing it '''
+    path = os.path.realpath(path)
+    best = ''
+    fstype = None
+    f = open(mounts, 'r')
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            # Spaces in mount points are escaped as \040
+            point = fields[1].replace('\\040', ' ')
+            if (path == point or path.startswith(point.rstrip('/') + '/')) \
+                    and len(point) >= len(best):
+                best = point
+                fstype = fields[2]
+    finally:
+        f.close()
+    return fstype
+
+def free_space(path):
+    ''' Bytes available in the filesystem of path '''
+    s = os.statvfs(path)
+    return s.f_bavail * s.f_frsize
+
+def check_memory_dir(path, size, hugepages=True):
+    ''' Check that the guest memory, size bytes, fits in the directory
+    path. Return the type of its filesystem, raise ValueError if it
+    does not exist, has not enough room or is a hugetlbfs mount and
+    hugepages is False (UML writes its memory file, hugetlbfs files can
+    only be mapped) '''
+    if not os.path.isdir(path):
+        raise ValueError("The memory directory " + path + " does not exist")
+    fstype = filesystem_type(path)
+    if fstype == 'hugetlbfs' and not hugepages:
+        raise ValueError("The memory directory " + path + " is in a " +
+            "hugetlbfs mount, only the QEMU backend can use huge pages")
+    if fstype == 'hugetlbfs':
+        page = os.statvfs(path).f_frsize
+        if size % page != 0:
+            raise ValueError("The memory of the guest is not a multiple " +
+                "of the huge pages of " + path + " (" + str(page) + ")")
+    free = free_space(path)
+    if free < size:
+        raise ValueError("The memory directory " + path + " has " +
+            str(free) + " bytes free, " + str(size) + " are needed")
+    return fstype
+
+def process_start(pid):
+    ''' Start time of the process pid (in clock ticks since boot), None
+    if there is no such process. Tells a process from a later one that
+    got the same pid '''
+    try:
+        f = open('/proc/' + str(pid) + '/stat', 'r')
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    # The command name, in parentheses, may have spaces
+    return int(stat[stat.rfind(')') + 2:].split()[19])
+
+def process_alive(pid, start=None):
+    ''' True if the process pid exists and, if start is given, it is the
+    one that started then '''
+    if pid == None:
+        return False
+    s = process_start(pid)
+    return s != None and (start == None or s == start)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -4,11 +4,27 @@ __version__ = "cassilda 0.0.1"
 Runner class module
 """
 import pexpect
+from pexpect import fdpexpect
 import os
 import tempfile
 import shutil
+import threading
+import re
 from .networks import *
-UML = 1
+from .console import ConsoleLog, ConsoleRecorder, Tee
+from .transport import ConsoleTransport, SSHTransport, SSHError
+from .agent import AgentClient, AgentTransport, AgentError, AgentClosed
+from .backends import UML, QEMU, REPLAY, BACKENDS
+from .resources import parse_size, check_memory_dir, MEMORY_FILESYSTEMS
+from .resources import process_alive
+
+# Root prompt set by the builders (PS1 ends in '\$ ')
+PROMPT = '# '
+# Bytes read from the console at once, and bytes at the end of the
+# unmatched output that expect() searches, so noisy guests do not make
+# every expect() rescan a growing buffer
+READ_SIZE = 8192
+SEARCH_WINDOW = 8192
 
 def print_line(line):
     '''Default Runner callback to print a line'''
@@ -21,34 +37,177 @@ class Runner:
        the builder itself
     '''
     def __init__(self, imagepath, kind, networks, hostname,
-            kernelpath = None, memory = '128M', log_callback = None):
+            kernelpath = None, memory = '128M', log_callback = None,
+            console_log = None, hostfs = None, backend_options = None,
+            cow = None, kernel_args = None, isolation = None,
+            memory_dir = None, journal_callback = None, record = None):
         ''' Builder constructor, receiving a callback to receive
-        lines printed by this module
+        lines printed by this module, and another one called with the
+        runner whenever what the session journal records of it changes
         '''
         self.imagepath = imagepath
+        self.hostname = hostname
+        self.kind = kind
         self.kernelpath = kernelpath
         self.memory = memory
+        # HostfsExport of the host directories shared with the guest
+        # (see hostfs.py)
+        self.hostfs = hostfs
+        # Copy on write file receiving the writes of the guest, leaving
+        # the image untouched (replicas), and extra kernel arguments
+        self.cow = cow
+        if kernel_args == None:
+            kernel_args = []
+        self.kernel_args = kernel_args
+        # Where the hypervisor keeps the memory of the guest (a tmpfs
+        # or, with QEMU, hugetlbfs mount), its default if None
+        self.memory_dir = memory_dir
+        # Cpus and cgroup of the guest process (see isolation.py)
+        self.isolation = isolation
         self.hosts = networks.get_hosts_by_name(hostname)
-        if not os.path.exists(imagepath):
+        if kind != REPLAY and not os.path.exists(imagepath):
             raise ValueError("The image passed to the runner does not exist")
         self.process = None
+        self.sp = None
+        # Process of the guest, and whether it was started by another
+        # controller (see attach())
+        self.pid = None
+        self.adopted = False
+        self.ptys = None
+        self.logged = False
+        # Serializes the use of the console between threads
+        self.lock = threading.RLock()
+        self.callnumber = 0
+        if console_log == None:
+            console_log = hostname + ".console.log"
+        self.console_log = console_log
+        self.console = None
+        # Where the console session is recorded (see console.py), if
+        # anywhere
+        self.record = record
+        self.recorder = None
+        self.console_transport = ConsoleTransport(self)
+        self.ssh = None
+        self.agent = None
+        self.agent_tried = False
+        if kind not in BACKENDS:
+            raise ValueError("Unknown runner kind " + str(kind))
+        if backend_options == None:
+            backend_options = {}
+        self.backend_options = backend_options
+        self.backend = BACKENDS[kind](self, **backend_options)
+        if self.hosts != []:
+            self.ssh = SSHTransport(str(self.hosts[0].address))
+        if log_callback == None:
+            self.log_callback = print_line
+        else:
+            self.log_callback = log_callback
+        self.journal_callback = journal_callback
 
     def log(self, line):
         self.log_callback(line)
 
+    def journal(self):
+        if self.journal_callback != None and self.pid != None:
+            self.journal_callback(self)
+
     def run(self, termnum):
-        commandline = "./" + self.kernelpath + " " + "ubd0="
-        commandline += self.imagepath + " mem=" + self.memory + " "
+        if self.console == None:
+            self.console = ConsoleLog(self.console_log)
+        if self.memory_dir != None:
+            fstype = check_memory_dir(self.memory_dir,
+                            parse_size(self.memory), self.backend.hugepages)
+            if fstype not in MEMORY_FILESYSTEMS:
+                self.log("Warning: the memory of " + self.imagepath +
+                    " goes to " + self.memory_dir + ", in " + str(fstype) +
+                    ", not in a memory filesystem")
+        if self.isolation != None:
+            self.isolation.setup()
+        if self.hostfs != None:
+            self.hostfs.setup()
+        self.sp = self.backend.spawn(maxread=READ_SIZE,
+                                    searchwindowsize=SEARCH_WINDOW)
+        self.sp.logfile_read = self.console
+        if self.record != None:
+            self.recorder = ConsoleRecorder(self.record)
+            self.sp.logfile_read = Tee(self.console, self.recorder.output)
+            self.sp.logfile_send = self.recorder.input
+        self.pid = self.sp.pid
+        self.journal()
+
+    def endpoints(self):
+        ''' The ptys of the spare login console and of the agent console,
+        None while the hypervisor did not print them yet '''
+        if self.adopted:
+            return dict(self.ptys)
+        r = {}
+        for key, pattern in (('console', self.backend.console_pattern),
+                                ('agent', self.backend.agent_pattern)):
+            r[key] = None
+            if pattern == None:
+                continue
+            found = self.grep(pattern)
+            if found != []:
+                r[key] = re.search(pattern, found[-1]).group(1)
+        return r
+
+    def attach(self, pid, console=None, agent=None, timeout=5):
+        ''' Take over a guest started by another controller, running as
+        the process pid, through the ptys of its spare login console
+        and of its agent '''
+        import tty
+        self.adopted = True
+        self.pid = pid
+        self.ptys = { 'console': console, 'agent': agent }
+        if self.console == None:
+            self.console = ConsoleLog(self.console_log)
+        if console != None:
+            fd = os.open(console, os.O_RDWR | os.O_NOCTTY)
+            tty.setraw(fd)
+            self.sp = fdpexpect.fdspawn(fd, maxread=READ_SIZE,
+                                    searchwindowsize=SEARCH_WINDOW)
+            self.sp.logfile_read = self.console
+            # The spare console may have been left logged in
+            self.sp.sendline('')
+            try:
+                if self.sp.expect(['login: ', PROMPT], timeout=timeout) == 1:
+                    self.logged = True
+            except (pexpect.TIMEOUT, pexpect.EOF):
+                pass
+        if agent != None:
+            self.attach_agent(agent)
+        self.log("Attached to " + self.imagepath + " (pid " + str(pid) + ")")
+        self.journal()
 
-        for h in self.hosts:
-            commandline += h.internaldevice + "=tuntap," 
-            commandline += h.tapdevice + "," + str(h.tapaddress) + " "
+    def drain(self):
+        ''' Drop the console output not consumed by any expect() yet
+        (it is still in the console log) '''
+        self.lock.acquire()
+        try:
+            try:
+                while True:
+                    self.sp.read_nonblocking(READ_SIZE, timeout=0)
+            except (pexpect.TIMEOUT, pexpect.EOF):
+                pass
+            self.sp.buffer = self.sp.buffer[:0]
+        finally:
+            self.lock.release()
 
-        commandline += " con0=fd:0,fd:1"
-        print ("About to spawn this: %s" % commandline)
-        self.sp = pexpect.spawn(commandline)
+    def tail(self, lines=20):
+        ''' Last lines printed in the console '''
+        if self.console == None:
+            return []
+        return self.console.tail(lines)
+
+    def grep(self, pattern, flags=0):
+        ''' Recent console lines matching the regular expression '''
+        if self.console == None:
+            return []
+        return self.console.grep(pattern, flags)
 
     def running(self):
+        if self.adopted:
+            return process_alive(self.pid)
         if self.sp == None:
             return False
         return self.sp.isalive()
@@ -56,11 +215,189 @@ class Runner:
     def interact(self):
         self.sp.interact()
 
-    def call(self, commands):
-        pass
+    def login(self, timeout=-1):
+        ''' Log in as root in the console, waiting up to timeout seconds
+        for the login prompt (the image may still be booting) '''
+        self.lock.acquire()
+        try:
+            if self.logged:
+                return True
+            self.sp.sendline('')
+            self.sp.expect('login: ', timeout=timeout)
+            self.sp.sendline('root')
+            self.sp.expect('Password: ')
+            self.sp.sendline('root')
+            self.sp.expect(PROMPT)
+            self.logged = True
+        finally:
+            self.lock.release()
+        # The consoles of the guest are known by now
+        self.journal()
+        return True
+
+    def logout(self):
+        self.lock.acquire()
+        try:
+            if not self.logged:
+                return True
+            self.sp.sendline('')
+            self.sp.expect(PROMPT)
+            self.sp.sendline('logout')
+            self.sp.expect('login: ')
+            self.logged = False
+            return True
+        finally:
+            self.lock.release()
+
+    def expect(self, pattern, timeout=-1):
+        ''' Wait for pattern in the console output '''
+        self.lock.acquire()
+        try:
+            return self.sp.expect(pattern, timeout=timeout)
+        finally:
+            self.lock.release()
+
+    def call(self, commands, timeout=-1):
+        ''' Run a (possibly multi line) shell script as root in the
+        console. Return a (exit status, output) tuple '''
+        self.lock.acquire()
+        try:
+            self.login()
+            self.drain()
+            self.callnumber += 1
+            marker = 'CASSILDA-END-' + str(self.callnumber)
+            # The script goes through a here document so it is run as a
+            # whole. The echoed command lines show '$?', never a number,
+            # so only the final echo matches the expected pattern
+            self.sp.sendline("sh <<'" + marker + "'\n" + commands.rstrip() +
+                    "\n" + marker + "\necho " + marker + "=$?")
+            self.sp.expect(marker + '=([0-9]+)', timeout=timeout)
+            status = int(self.sp.match.group(1))
+            output = self.sp.before
+            self.sp.expect(PROMPT)
+            return status, output
+        finally:
+            self.lock.release()
  
-    def shutdown(self):
-        """ Log as root in the image and perform a shutdown -h now """
-        pass
+    def connect_agent(self, timeout=30):
+        ''' Connect to the guest agent through the pty the hypervisor
+        assigned to its console. Return the AgentClient or None if the
+        agent does not answer (yet) '''
+        self.agent_tried = True
+        pattern = self.backend.agent_pattern
+        if pattern == None:
+            return None
+        found = self.grep(pattern)
+        if found != []:
+            pts = re.search(pattern, found[-1]).group(1)
+        else:
+            self.lock.acquire()
+            try:
+                try:
+                    self.sp.expect(pattern, timeout=timeout)
+                except pexpect.TIMEOUT:
+                    return None
+                pts = self.sp.match.group(1)
+                if not isinstance(pts, str):
+                    pts = pts.decode()
+            finally:
+                self.lock.release()
+        return self.attach_agent(pts)
+
+    def attach_agent(self, pts):
+        ''' Connect to the guest agent in the pty pts, return the
+        AgentClient or None if it does not answer '''
+        self.agent_tried = True
+        try:
+            client = AgentClient.open_tty(pts)
+        except OSError:
+            return None
+        try:
+            client.status(timeout=5)
+        except AgentError:
+            client.close()
+            return None
+        self.log("Connected to the agent of " + self.imagepath + " in " + pts)
+        self.agent = AgentTransport(client)
+        return client
+
+    def transport(self):
+        ''' Return the fastest transport that works right now: the agent
+        channel, the pool of ssh connections once the guest is
+        reachable, or the console '''
+        if self.agent == None and self.logged and not self.agent_tried:
+            self.connect_agent()
+        if self.agent != None:
+            return self.agent
+        if self.ssh != None and self.ssh.reachable():
+            return self.ssh
+        return self.console_transport
+
+    def execute(self, command, timeout=-1):
+        ''' Run a shell command as root in the guest through the best
+        transport available, return (exit status, output) '''
+        transport = self.transport()
+        try:
+            return transport.execute(command, timeout)
+        except AgentClosed:
+            # The command was not sent, running it elsewhere is safe
+            self.log("The agent channel is closed, not using it anymore")
+            self.agent = None
+            return self.execute(command, timeout)
+        except AgentError:
+            # It may have run (or still be running): never run it again
+            if self.agent != None and self.agent.client.closed:
+                self.log("The agent channel is closed, not using it anymore")
+                self.agent = None
+            raise
+        except SSHError:
+            # The command was not started, running it is safe
+            self.log("ssh to " + self.ssh.address + " failed, using console")
+            return self.console_transport.execute(command, timeout)
+
+    def execute_many(self, commands, timeout=-1):
+        ''' Run the commands in parallel (if the transport allows it),
+        returning their (status, output) in the same order. Like
+        execute(), commands that can not be started fall back to the
+        console '''
+        return self.transport().execute_many(commands, timeout, self.execute)
+
+    def put(self, source, destination):
+        ''' Copy a local file into the guest '''
+        if self.transport().put(source, destination):
+            return True
+        return self.console_transport.put(source, destination)
+
+    def get(self, source, destination):
+        ''' Copy a file from the guest to the local destination '''
+        if self.transport().get(source, destination):
+            return True
+        return self.console_transport.get(source, destination)
+
+    def close(self):
+        ''' Close the connections to the guest '''
+        if self.agent != None:
+            self.agent.client.close()
+            self.agent = None
+        if self.ssh != None:
+            self.ssh.close()
+        if self.adopted and self.sp != None:
+            self.sp.close()
+        if self.console != None:
+            self.console.close()
+        if self.recorder != None:
+            self.recorder.close()
+            self.recorder = None
+
+    def shutdown(self, timeout=60):
+        """ Log as root in the image and halt it, killing it if it does
+        not stop in timeout seconds """
+        r = self.backend.shutdown(timeout)
+        self.close()
+        if self.isolation != None:
+            self.isolation.cleanup()
+        if self.hostfs != None:
+            self.hostfs.cleanup()
+        return r
  
 
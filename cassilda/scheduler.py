@@ -0,0 +1,190 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Run scheduling
+
+A RunScheduler starts the images of a profile without overcommitting
+the host. Each image weighs its declared memory (times its replicas)
+plus a per guest overhead, and the images are packed, in profile order,
+into waves that fit in the memory budget (by default what the host has
+available when the scheduler is created, minus a reserve).
+
+Inside a wave guests are admitted one by one: only max_booting of them
+boot at once (a guest is booted once its login prompt shows up), and
+a guest waits to be started while the load of the host, counting the
+guests still booting, is above the cpu budget or there is not enough
+memory available right now. Every wave but the last one is shut down
+once the wave callback returns, so profiles bigger than the host run
+in turns.
+"""
+import threading
+import time
+
+from .resources import parse_size, cpu_count, available_memory, loadavg
+
+# Memory used by a guest process besides its own (page tables, UML
+# kernel, buffers of the hypervisor)
+GUEST_OVERHEAD = 32 * 1024 * 1024
+# Memory left to the host and to the builds
+HOST_RESERVE = 512 * 1024 * 1024
+# Guests booting at once
+MAX_BOOTING = 2
+# Seconds a guest may take to boot, and to wait for resources
+BOOT_TIMEOUT = 300
+ADMIT_TIMEOUT = 600
+POLL_INTERVAL = 1
+
+def print_line(line):
+    print(line)
+
+class RunScheduler:
+    """ Admits guest starts within a memory and cpu budget """
+    def __init__(self, cas, memory_budget=None, cpu_budget=None,
+                    max_booting=MAX_BOOTING, boot_timeout=BOOT_TIMEOUT,
+                    admit_timeout=ADMIT_TIMEOUT, log_callback=None):
+        self.cas = cas
+        if memory_budget == None:
+            memory_budget = available_memory() - HOST_RESERVE
+        self.memory_budget = parse_size(memory_budget)
+        if cpu_budget == None:
+            cpu_budget = cpu_count()
+        self.cpu_budget = cpu_budget
+        self.max_booting = max_booting
+        self.boot_timeout = boot_timeout
+        self.admit_timeout = admit_timeout
+        if log_callback == None:
+            log_callback = print_line
+        self.log = log_callback
+        self.booting = 0
+        self.condition = threading.Condition()
+        # Firewall and tap setup are not thread safe
+        self.run_lock = threading.Lock()
+
+    def weight(self, image):
+        ''' Bytes of host memory needed to run an image '''
+        return (parse_size(image.memory) + GUEST_OVERHEAD) * image.replicas
+
+    def waves(self, names=None):
+        ''' Split the named images (all if None) in consecutive groups,
+        in profile order, each one fitting in the memory budget '''
+        if names == None:
+            names = [i.name for i in self.cas.images]
+        waves = []
+        wave = []
+        used = 0
+        for name in names:
+            image = self.cas[name]
+            if image == None:
+                raise Exception('Image ' + name + ' is not in the profile')
+            w = self.weight(image)
+            if w > self.memory_budget:
+                raise Exception('Image ' + name + ' needs ' + str(w) +
+                    ' bytes, more than the budget of ' +
+                    str(self.memory_budget))
+            if used + w > self.memory_budget:
+                waves.append(wave)
+                wave = []
+                used = 0
+            wave.append(name)
+            used += w
+        if wave != []:
+            waves.append(wave)
+        return waves
+
+    def admissible(self, image):
+        ''' True if the host can take one more booting guest now '''
+        if self.booting >= self.max_booting:
+            return False
+        if loadavg()[0] + self.booting >= self.cpu_budget:
+            return False
+        return available_memory() >= self.weight(image)
+
+    def admit(self, image):
+        ''' Wait until the image can be started, and count it as
+        booting. After admit_timeout it is admitted anyway if no other
+        guest is booting '''
+        deadline = time.time() + self.admit_timeout
+        self.condition.acquire()
+        try:
+            while not self.admissible(image):
+                if time.time() > deadline and self.booting == 0:
+                    self.log("Starting " + image.name +
+                            " over the budget after waiting " +
+                            str(self.admit_timeout) + " seconds")
+                    break
+                self.condition.wait(POLL_INTERVAL)
+            self.booting += 1
+        finally:
+            self.condition.release()
+
+    def booted(self):
+        self.condition.acquire()
+        try:
+            self.booting -= 1
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def start(self, name):
+        ''' Start an image once admitted and wait until it booted '''
+        image = self.cas[name]
+        self.admit(image)
+        try:
+            self.log("Starting " + name)
+            self.run_lock.acquire()
+            try:
+                group = self.cas.run(name)
+            finally:
+                self.run_lock.release()
+            if group != None:
+                group.login(self.boot_timeout)
+            else:
+                image.runner.login(self.boot_timeout)
+            self.log(name + " booted")
+        finally:
+            self.booted()
+
+    def start_wave(self, names):
+        ''' Start the images of a wave, raise the first error once every
+        start ended '''
+        errors = []
+        def start(name):
+            try:
+                self.start(name)
+            except Exception as e:
+                self.log("Failed to start " + name + ": " + str(e))
+                errors.append(e)
+        threads = [threading.Thread(target=start, args=(name,))
+                        for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors != []:
+            raise errors[0]
+
+    def stop_wave(self, names):
+        for name in names:
+            self.cas.stop(name)
+
+    def run(self, names=None, wave_callback=None):
+        ''' Start the named images (all if None). If they do not fit in
+        the budget at once, they run in waves: wave_callback(names) is
+        called once each wave booted, and every wave but the last one
+        is stopped when it returns. Return the waves '''
+        waves = self.waves(names)
+        if len(waves) > 1 and wave_callback == None:
+            raise Exception('The images need ' + str(len(waves)) +
+                ' waves to fit in the memory budget, a wave callback ' +
+                'is needed to use them')
+        for n in range(len(waves)):
+            self.log("Wave " + str(n + 1) + " of " + str(len(waves)) + ": " +
+                                                    ", ".join(waves[n]))
+            try:
+                self.start_wave(waves[n])
+                if wave_callback != None:
+                    wave_callback(waves[n])
+            finally:
+                if n < len(waves) - 1:
+                    self.stop_wave(waves[n])
+        return waves
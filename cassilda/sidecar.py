@@ -0,0 +1,72 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Sidecar files
+
+Small JSON documents kept next to images and in the session directory
+(manifests, checkpoints, digests...). They are always replaced atomically
+so a crash never leaves a half written one behind. Sidecars changed by
+several processes are read, changed and saved holding lock() (an flock
+on <sidecar>.lock, as the sidecar itself is replaced).
+"""
+import fcntl
+import json
+import os
+import tempfile
+
+def load(path, default=None):
+    ''' Return the data stored in the sidecar at path, or default if
+    there is none (or it is not readable) '''
+    if not os.path.exists(path):
+        return default
+    try:
+        f = open(path, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except ValueError:
+        return default
+
+def save(path, data):
+    ''' Atomically replace the sidecar at path with data '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                               dir=directory)
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def lock(path):
+    ''' Wait for an exclusive lock on the sidecar at path, return the
+    descriptor to give to unlock() '''
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+def remove(path):
+    ''' Remove the sidecar at path, if any '''
+    if os.path.exists(path):
+        os.remove(path)
+
+def normalize(data):
+    ''' Return data as it would be read back from a sidecar (tuples
+    become lists, etc.) so it can be compared with stored values '''
+    return json.loads(json.dumps(data))
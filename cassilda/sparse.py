@@ -0,0 +1,224 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Sparse file helpers
+
+Images are mostly holes, so reading them byte by byte wastes most of the
+time on zeros. These helpers walk the data extents of a file with
+SEEK_DATA/SEEK_HOLE and implement the in-process copy engine used by the
+builders: a reflink (FICLONE) when the filesystem supports it, then
+copy_file_range(2) over the data extents, then a plain read/write copy
+that keeps the holes. digest() hashes the contents of an image reading
+only its data extents.
+"""
+import os
+import errno
+import hashlib
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+CHUNK_SIZE = 4 * 1024 * 1024
+# Threads hashing the blocks of a file in digest()
+DIGEST_WORKERS = 4
+
+# errno values meaning 'this method is not supported here, try the next'
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+               errno.ENOSYS, errno.EBADF, errno.ETXTBSY)
+
+def data_extents(fd, size):
+    ''' Yield (offset, length) for every data region of the open file fd.
+    When the filesystem can not report holes the whole file is returned
+    as one extent '''
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left until the end of the file
+                return
+            if e.errno in UNSUPPORTED:
+                yield (offset, size - offset)
+                return
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        if end > start:
+            yield (start, end - start)
+        offset = end
+
+def data_size(path):
+    ''' Return the number of bytes actually stored in a (sparse) file '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        return sum([l for o, l in data_extents(fd, size)])
+    finally:
+        os.close(fd)
+
+def reflink(src_fd, dst_fd):
+    ''' Try to share the extents of src_fd with dst_fd. Return True
+    on success, False if the filesystem does not support it '''
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError) as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+    return True
+
+def _copy_range(src_fd, dst_fd, offset, length, progress):
+    ''' copy_file_range(2) a single extent. Raise NotImplementedError
+    when the kernel or the python interpreter do not provide it '''
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        raise NotImplementedError()
+    end = offset + length
+    while offset < end:
+        try:
+            n = copy_file_range(src_fd, dst_fd, min(end - offset, CHUNK_SIZE),
+                                offset, offset)
+        except OSError as e:
+            if e.errno in UNSUPPORTED:
+                raise NotImplementedError()
+            raise
+        if n == 0:
+            break
+        offset += n
+        progress(n)
+
+def _read_write(src_fd, dst_fd, offset, length, progress):
+    ''' Plain copy of one extent, not writing blocks made only of zeros
+    so they stay as holes in the destination '''
+    end = offset + length
+    while offset < end:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        buf = os.read(src_fd, min(end - offset, CHUNK_SIZE))
+        if not buf:
+            break
+        if buf.count(b'\x00') != len(buf):
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            written = 0
+            while written < len(buf):
+                written += os.write(dst_fd, buf[written:])
+        offset += len(buf)
+        progress(len(buf))
+
+def copy_file(src, dst, progress_callback=None):
+    ''' Copy src into dst keeping it sparse, trying reflink first, then
+    copy_file_range over the data extents and finally a plain copy.
+    progress_callback(copied, total) is called while copying data.
+    Return a (method, bytes, seconds) tuple '''
+    start = time.time()
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if reflink(src_fd, dst_fd):
+                return ('reflink', size, time.time() - start)
+            extents = list(data_extents(src_fd, size))
+            total = sum([l for o, l in extents])
+            copied = [0]
+            def progress(n):
+                copied[0] += n
+                if progress_callback != None:
+                    progress_callback(copied[0], total)
+            method = 'copy_file_range'
+            for offset, length in extents:
+                if method == 'copy_file_range':
+                    done = copied[0]
+                    try:
+                        _copy_range(src_fd, dst_fd, offset, length, progress)
+                        continue
+                    except NotImplementedError:
+                        # Retry the whole extent the plain way
+                        copied[0] = done
+                        method = 'read/write'
+                _read_write(src_fd, dst_fd, offset, length, progress)
+            os.ftruncate(dst_fd, size)
+            return (method, copied[0], time.time() - start)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+def _read_block(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    data = b''
+    while len(data) < length:
+        buf = os.read(fd, length - len(data))
+        if not buf:
+            break
+        data += buf
+    return data
+
+def digest(path, workers=DIGEST_WORKERS, block_size=CHUNK_SIZE):
+    ''' Tree hash (sha256) of the contents of a file: the hash of its
+    size and of the digests of its consecutive block_size blocks. The
+    blocks with data are read and hashed by workers threads; the ones
+    made only of holes are not read, their digest is the one of a block
+    of zeros, so the digest does not depend on how sparse the file is '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        pending = set()
+        for offset, length in data_extents(fd, size):
+            pending.update(range(offset // block_size,
+                                (offset + length - 1) // block_size + 1))
+    finally:
+        os.close(fd)
+    count = (size + block_size - 1) // block_size
+    leaves = [None] * count
+    zeros = {}
+    for n in range(count):
+        if n not in pending:
+            length = min(block_size, size - n * block_size)
+            if length not in zeros:
+                zeros[length] = hashlib.sha256(b'\x00' * length).digest()
+            leaves[n] = zeros[length]
+    pending = sorted(pending, reverse=True)
+    lock = threading.Lock()
+    errors = []
+    def work():
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                while True:
+                    lock.acquire()
+                    try:
+                        if pending == [] or errors != []:
+                            return
+                        n = pending.pop()
+                    finally:
+                        lock.release()
+                    offset = n * block_size
+                    data = _read_block(fd, offset,
+                                        min(block_size, size - offset))
+                    leaves[n] = hashlib.sha256(data).digest()
+            finally:
+                os.close(fd)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work)
+                    for i in range(max(1, min(workers, len(pending))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors != []:
+        raise errors[0]
+    root = hashlib.sha256(str(size).encode())
+    for leaf in leaves:
+        root.update(leaf)
+    return root.hexdigest()
@@ -0,0 +1,192 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Artefact store
+
+What Cassilda leaves in the directory it runs from: images
+(<distribution>-<name>.img), layers (the bootstrapped bases shared by
+the images and the install checkpoints) and kernels, each one with the
+files that go with it (sidecars, qcow2 overlays). Only the artefacts
+Cassilda made are considered: the ones used through the store and the
+ones the profile defines, never other files of the directory. The store
+records when every artefact was last used (in the cassilda.artefacts
+sidecar, the modification time stands for it until then) and gc()
+removes the least recently used ones until the rest fits in a disk
+budget, never the ones it is told are in use (by running guests or
+builds).
+
+It also reclaims what dead processes left in the temporary directory:
+builder mount points, staged image trees and ssh control directories,
+whose names carry the pid of the process that made them.
+"""
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import sidecar
+from .resources import process_alive
+
+STORE_STATE = 'cassilda.artefacts'
+# Prefixes of the temporary directories, followed by pid and '-'
+MOUNT_PREFIX = 'cassilda-mnt-'
+SSH_PREFIX = 'cassilda-ssh-'
+STAGE_PREFIX = 'cassilda-stage-'
+# Files removed along with the artefact they are named after
+COMPANIONS = ['.manifest', '.digest', '.checkpoints', '.qcow2']
+
+def temp_prefix(prefix):
+    ''' Prefix of a temporary directory made by this process '''
+    return prefix + str(os.getpid()) + '-'
+
+def disk_usage(path):
+    ''' Bytes path takes in the disk (not its size, images are sparse) '''
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+class ArtefactStore:
+    """ The images, layers and kernels in a directory """
+    def __init__(self, directory='.', kernels=None, images=None,
+                                                        layers=None):
+        self.directory = directory
+        self.path = os.path.join(directory, STORE_STATE)
+        if kernels == None:
+            kernels = []
+        self.kernels = kernels
+        # Images and base images the profile defines
+        if images == None:
+            images = []
+        self.images = images
+        if layers == None:
+            layers = []
+        self.layers = layers
+        self.lock = threading.Lock()
+        self.used = sidecar.load(self.path, {})
+
+    def touch(self, path, kind):
+        ''' Record that the artefact in path (an image, layer or kernel)
+        was used now '''
+        self.lock.acquire()
+        try:
+            self.used[os.path.basename(path)] = { 'kind': kind,
+                                                    'time': time.time() }
+            sidecar.save(self.path, self.used)
+        finally:
+            self.lock.release()
+
+    def kind(self, name):
+        ''' Kind of the artefact name, None if Cassilda did not make it
+        '''
+        if name in self.used:
+            return self.used[name]['kind']
+        if name in self.kernels:
+            return 'kernel'
+        if name in self.images:
+            return 'image'
+        if name in self.layers or self.checkpoint_of(name) != None:
+            return 'layer'
+        return None
+
+    def checkpoint_of(self, name):
+        ''' The image (of the profile) the install checkpoint name
+        belongs to, None if it is not one '''
+        match = re.match(r'(.*\.img)\.[^.]+\.ckpt$', name)
+        if match == None or match.group(1) not in self.images:
+            return None
+        return match.group(1)
+
+    def companions(self, name):
+        return [name + c for c in COMPANIONS
+                    if os.path.exists(os.path.join(self.directory, name + c))]
+
+    def artefacts(self):
+        ''' (name, kind, bytes on disk, last use) of every artefact,
+        least recently used first '''
+        r = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            kind = self.kind(name)
+            if kind == None or not os.path.isfile(path):
+                continue
+            size = disk_usage(path)
+            for c in self.companions(name):
+                size += disk_usage(os.path.join(self.directory, c))
+            if name in self.used:
+                last = self.used[name]['time']
+            else:
+                last = os.path.getmtime(path)
+            r.append((name, kind, size, last))
+        return sorted(r, key=lambda a: (a[3], a[0]))
+
+    def remove(self, name):
+        for n in [name] + self.companions(name):
+            os.remove(os.path.join(self.directory, n))
+        self.lock.acquire()
+        try:
+            if self.used.pop(name, None) != None:
+                sidecar.save(self.path, self.used)
+        finally:
+            self.lock.release()
+
+    def gc(self, budget, in_use, dry_run=False):
+        ''' Remove the least recently used artefacts until the rest
+        takes at most budget bytes, skipping the ones named in in_use
+        and the checkpoints of those. Return the artefacts removed (or
+        that would be with dry_run) and the bytes left '''
+        artefacts = self.artefacts()
+        total = sum([a[2] for a in artefacts])
+        removed = []
+        for a in artefacts:
+            if budget == None or total <= budget:
+                break
+            if a[0] in in_use or self.checkpoint_of(a[0]) in in_use:
+                continue
+            if not dry_run:
+                self.remove(a[0])
+            removed.append(a)
+            total -= a[2]
+        return removed, total
+
+    def orphans(self, directory=None):
+        ''' Temporary directories left by processes that are gone '''
+        if directory == None:
+            directory = tempfile.gettempdir()
+        r = []
+        for name in os.listdir(directory):
+            for prefix in (MOUNT_PREFIX, STAGE_PREFIX, SSH_PREFIX):
+                if not name.startswith(prefix):
+                    continue
+                pid = name[len(prefix):].split('-')[0]
+                if pid.isdigit() and not process_alive(int(pid)):
+                    r.append(os.path.join(directory, name))
+        return sorted(r)
+
+    def reclaim(self, path):
+        ''' Remove an orphan temporary directory: unmount the image
+        mounted there (and what is mounted below it), remove the staged
+        tree or stop the ssh masters listening in it '''
+        if os.path.basename(path).startswith(STAGE_PREFIX):
+            for d in ('sys', 'proc'):
+                if os.path.ismount(os.path.join(path, d)):
+                    subprocess.call(['umount', '-l', os.path.join(path, d)])
+                if os.path.ismount(os.path.join(path, d)):
+                    raise Exception('Can not remove ' + path + ', ' + d +
+                                                    ' is still mounted')
+            shutil.rmtree(path)
+            return
+        if os.path.basename(path).startswith(MOUNT_PREFIX):
+            if os.path.ismount(path):
+                subprocess.call(['umount', '-l', path])
+            os.rmdir(path)
+            return
+        for name in os.listdir(path):
+            subprocess.call(['ssh', '-o', 'ControlPath=' +
+                    os.path.join(path, name), '-O', 'exit', 'cassilda'])
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
@@ -0,0 +1,259 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Guest telemetry
+
+A Sampler looks at the running guests every interval seconds, reading
+only small /proc and /sys files: the cpu time, threads and memory
+(/proc/<pid>/stat and status) and the disk I/O (/proc/<pid>/io) of the
+whole process tree of every guest (UML runs one host process per guest
+process), and the counters of its tap devices
+(/sys/class/net/<tap>/statistics). Rates are computed against the
+previous sample.
+
+Every process of a UML tree maps the guest memory file, so their
+resident sizes are not added up: rss, rss_shmem and swap are those of
+the main process, and pss (/proc/<pid>/smaps_rollup, where the kernel
+has it) is the proportional set size of the whole tree, each shared
+page counted once.
+
+status() returns the last sample of every guest; each round of samples
+is also given to a callback and appended, as a JSON line, to a file::
+
+    sampler = cas.start_telemetry(5, path='telemetry.jsonl')
+    sampler.status()['apache_server']['cpu_percent']
+"""
+import json
+import os
+import threading
+import time
+
+# Seconds between samples
+INTERVAL = 5
+# Counters of the tap devices
+TAP_COUNTERS = ['rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets',
+                'rx_dropped', 'tx_dropped']
+# Fields of /proc/<pid>/status, in kB
+STATUS_FIELDS = { 'VmRSS': 'rss', 'RssShmem': 'rss_shmem', 'VmSwap': 'swap' }
+# Counted once per guest (the main process), not per process of the tree
+MEMORY_FIELDS = list(STATUS_FIELDS.values())
+
+def sysconf(name, default):
+    try:
+        return os.sysconf(name)
+    except (AttributeError, ValueError, OSError):
+        return default
+
+CLOCK_TICKS = sysconf('SC_CLK_TCK', 100)
+
+def read_file(path):
+    ''' Contents of a small file, None if it can not be read (the
+    process ended, no permission...) '''
+    try:
+        f = open(path, 'r')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+def children(pid):
+    ''' Pids of the children of a process '''
+    r = []
+    tasks = '/proc/' + str(pid) + '/task'
+    try:
+        tids = os.listdir(tasks)
+    except OSError:
+        return r
+    for tid in tids:
+        s = read_file(os.path.join(tasks, tid, 'children'))
+        if s == None:
+            # Kernel without CONFIG_PROC_CHILDREN: scan every process
+            return scan_children(pid)
+        r.extend([int(c) for c in s.split()])
+    return r
+
+def scan_children(pid):
+    r = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        stat = read_file('/proc/' + name + '/stat')
+        if stat != None and \
+                int(stat[stat.rfind(')') + 2:].split()[1]) == pid:
+            r.append(int(name))
+    return r
+
+def process_tree(pid):
+    ''' pid and all its descendants '''
+    r = []
+    pending = [pid]
+    while pending != []:
+        p = pending.pop()
+        r.append(p)
+        pending.extend(children(p))
+    return r
+
+def process_sample(pid):
+    ''' Cpu seconds, threads, memory and I/O bytes of one process, None
+    if it is gone '''
+    stat = read_file('/proc/' + str(pid) + '/stat')
+    if stat == None:
+        return None
+    fields = stat[stat.rfind(')') + 2:].split()
+    # Its own time and that of the children it waited for, which are
+    # not in the tree anymore
+    r = { 'cpu_seconds': sum([int(f) for f in fields[11:15]]) /
+                                                float(CLOCK_TICKS),
+          'threads': int(fields[17]),
+          'rss': 0, 'rss_shmem': 0, 'swap': 0, 'pss': 0,
+          'read_bytes': 0, 'write_bytes': 0 }
+    rollup = read_file('/proc/' + str(pid) + '/smaps_rollup')
+    if rollup != None:
+        for line in rollup.splitlines():
+            key, sep, value = line.partition(':')
+            if key == 'Pss':
+                r['pss'] = int(value.split()[0]) * 1024
+    status = read_file('/proc/' + str(pid) + '/status')
+    if status != None:
+        for line in status.splitlines():
+            key, sep, value = line.partition(':')
+            if key in STATUS_FIELDS:
+                r[STATUS_FIELDS[key]] = int(value.split()[0]) * 1024
+    io = read_file('/proc/' + str(pid) + '/io')
+    if io != None:
+        for line in io.splitlines():
+            key, sep, value = line.partition(':')
+            if key in ('read_bytes', 'write_bytes'):
+                r[key] = int(value)
+    return r
+
+def tap_sample(tapdevice):
+    ''' Counters of a tap device, None if it does not exist '''
+    r = {}
+    for counter in TAP_COUNTERS:
+        s = read_file('/sys/class/net/' + tapdevice + '/statistics/' +
+                                                                counter)
+        if s == None:
+            return None
+        r[counter] = int(s)
+    return r
+
+def guest_sample(pid, taps):
+    ''' Totals of the process tree of a guest (the memory of its main
+    process) and counters of its tap devices '''
+    r = { 'pid': pid, 'processes': 0, 'cpu_seconds': 0.0, 'threads': 0,
+          'rss': 0, 'rss_shmem': 0, 'swap': 0, 'pss': 0,
+          'read_bytes': 0, 'write_bytes': 0, 'taps': {} }
+    for p in process_tree(pid):
+        s = process_sample(p)
+        if s == None:
+            continue
+        r['processes'] += 1
+        for key, value in s.items():
+            if key not in MEMORY_FIELDS:
+                r[key] += value
+            elif p == pid:
+                r[key] = value
+    for tap in taps:
+        s = tap_sample(tap)
+        if s != None:
+            r['taps'][tap] = s
+    return r
+
+def add_rates(sample, previous, seconds):
+    ''' Add the cpu percentage and the byte rates since previous '''
+    if previous == None or seconds <= 0:
+        sample['cpu_percent'] = None
+        return sample
+    sample['cpu_percent'] = 100 * (sample['cpu_seconds'] -
+                                    previous['cpu_seconds']) / seconds
+    for key in ('read_bytes', 'write_bytes'):
+        sample[key[:-6] + '_rate'] = (sample[key] - previous[key]) / seconds
+    for tap, counters in sample['taps'].items():
+        before = previous['taps'].get(tap)
+        if before == None:
+            continue
+        for key in ('rx_bytes', 'tx_bytes'):
+            counters[key[:-6] + '_rate'] = (counters[key] - before[key]) / \
+                                                                    seconds
+    return sample
+
+class Sampler:
+    """ Samples the guests returned by guests(), a dictionary of
+    (pid, tap devices) by name, every interval seconds """
+    def __init__(self, guests, interval=INTERVAL, callback=None, path=None):
+        self.guests = guests
+        self.interval = interval
+        self.callback = callback
+        self.path = path
+        self.lock = threading.Lock()
+        self.last = {}
+        self.last_time = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        ''' Sample every guest now, return the samples by name '''
+        now = time.time()
+        samples = {}
+        for name, (pid, taps) in self.guests().items():
+            if pid == None:
+                continue
+            s = guest_sample(pid, taps)
+            if s['processes'] == 0:
+                continue
+            s['time'] = now
+            previous = self.last.get(name)
+            if previous != None and previous['pid'] != pid:
+                previous = None
+            seconds = 0
+            if previous != None:
+                seconds = now - previous['time']
+            samples[name] = add_rates(s, previous, seconds)
+        self.lock.acquire()
+        try:
+            self.last = samples
+            self.last_time = now
+        finally:
+            self.lock.release()
+        if self.callback != None:
+            self.callback(samples)
+        if self.path != None:
+            f = open(self.path, 'a')
+            try:
+                f.write(json.dumps({ 'time': now, 'guests': samples },
+                                    sort_keys=True) + '\n')
+            finally:
+                f.close()
+        return samples
+
+    def status(self):
+        ''' The last samples, by guest name '''
+        self.lock.acquire()
+        try:
+            return dict(self.last)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print("Telemetry sample failed: " + str(e))
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
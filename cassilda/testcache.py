@@ -0,0 +1,69 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Test result cache
+
+The result of every test of an image (the test: scripts of the !image
+documents) is kept in a sidecar next to the profile (<profile>.tests)
+under a key made of everything the test depends on: the digest of the
+built image (see Image.digest()), the test script, the kernel that
+runs it, the installers of the image and the digests of the images it
+depends on. A test that passed is not run again while its key stays
+the same, its result is replayed; failures are always run again.
+The images are tested on a throwaway copy on write file
+(<image>.test.cow), so testing does not change their digest.
+"""
+import hashlib
+import json
+import threading
+
+from . import sidecar
+
+# Copy on write file the images boot on while tested
+TEST_COW_SUFFIX = '.test.cow'
+
+def test_key(image_digest, script, kernel_digest, installers, depends):
+    ''' Key of the result of a test given what it depends on '''
+    content = json.dumps([image_digest, script, kernel_digest,
+                    sidecar.normalize(installers), depends], sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+class TestCache:
+    """ Last result of every test of every image, with its key
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'profile.tests')
+    >>> key = test_key('d1', 'true', 'k1', [], [])
+    >>> TestCache(path).record('web', 'smoke', key, 0, 'ok', 1.5)
+    >>> cache = TestCache(path)
+    >>> cache.get('web', 'smoke', key) == (0, 'ok')
+    True
+    >>> cache.get('web', 'smoke', test_key('d2', 'true', 'k1', [], []))
+    >>> cache.record('web', 'smoke', key, 1, 'failed', 1.5)
+    >>> cache.get('web', 'smoke', key)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = sidecar.load(path, {})
+
+    def get(self, image, test, key):
+        ''' The (status, output) of the test if it passed with the same
+        key, None if it has to be run '''
+        r = self.results.get(image, {}).get(test)
+        if r == None or r['key'] != key or r['status'] != 0:
+            return None
+        return r['status'], r['output']
+
+    def record(self, image, test, key, status, output, seconds):
+        self.lock.acquire()
+        try:
+            self.results.setdefault(image, {})[test] = { 'key': key,
+                'status': status, 'output': output, 'seconds': seconds }
+            sidecar.save(self.path, self.results)
+        finally:
+            self.lock.release()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,202 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Bulk file transfer
+
+push() streams a local file or directory, as a gzipped tar, into one or
+many running guests through their transports (see transport.py). The
+archive is produced once, in chunks, and fanned out to every guest, each
+one fed by its own thread through a bounded queue, so nothing is staged
+in memory and a slow guest only slows down itself until its queue
+fills up. The sha256 of the stream is compared with the one computed by
+the guest while extracting it. pull() does the opposite for one guest,
+taking from the archive only regular files and directories that stay
+inside the destination, as the guest is not trusted.
+"""
+import hashlib
+import os
+import tarfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .transport import CHUNK_SIZE
+
+# Chunks waiting to be sent to each guest
+QUEUE_SIZE = 8
+
+# Run in the guest to extract the stream in %(destination)s, printing
+# the sha256 of what was received. The exit status is the one of tar
+PUSH_COMMAND = ("mkdir -p %(destination)s && f=/tmp/cassilda-push.$$ && "
+    "mkfifo $f && { sha256sum < $f > $f.sum & } && "
+    "tee $f | tar -xzf - -C %(destination)s; r=$?; wait; "
+    "cat $f.sum; rm -f $f $f.sum; exit $r")
+
+# Run in the guest to send %(base)s (in %(parent)s) as a gzipped tar,
+# keeping the sha256 of what was sent and the status of tar in
+# %(spool)s.sum and %(spool)s.rc for PULL_RESULT
+PULL_COMMAND = ("f=%(spool)s && mkfifo $f && "
+    "{ sha256sum < $f > $f.sum & } && "
+    "{ tar -czf - -C %(parent)s %(base)s; echo $? > $f.rc; } | tee $f; "
+    "wait")
+PULL_RESULT = ("f=%(spool)s; cat $f.sum; r=$(cat $f.rc); "
+    "rm -f $f $f.sum $f.rc; exit $r")
+
+class TransferError(Exception):
+    pass
+
+class FanOut:
+    """ File like object writing every chunk into several streams, each
+    one from its own thread, while computing the sha256 of the data """
+    def __init__(self, streams):
+        self.digest = hashlib.sha256()
+        self.queues = []
+        self.errors = [None] * len(streams)
+        self.threads = []
+        for n in range(len(streams)):
+            q = queue.Queue(QUEUE_SIZE)
+            t = threading.Thread(target=self.feed, args=(n, streams[n], q))
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+            self.threads.append(t)
+
+    def feed(self, n, stream, q):
+        while True:
+            data = q.get()
+            if data == None:
+                return
+            if self.errors[n] == None:
+                try:
+                    stream.write(data)
+                except Exception as e:
+                    # Keep consuming so the producer never blocks
+                    self.errors[n] = e
+
+    def write(self, data):
+        self.digest.update(data)
+        for q in self.queues:
+            q.put(data)
+
+    def finish(self):
+        ''' Wait until every stream got all the data, return the digest '''
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        return self.digest.hexdigest()
+
+class HashingReader:
+    """ File like object computing the sha256 of what is read """
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def read(self, size=CHUNK_SIZE):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        return data
+
+def arcname(path):
+    return os.path.basename(os.path.normpath(path))
+
+def push(transports, source, destination):
+    ''' Copy the local file or directory source into the directory
+    destination of the guests behind transports. Return the sha256 of
+    the transferred stream, raise TransferError if any guest failed '''
+    command = PUSH_COMMAND % { 'destination': quote(destination) }
+    streams = [t.open_stream(command, 'w') for t in transports]
+    fanout = FanOut(streams)
+    try:
+        tar = tarfile.open(fileobj=fanout, mode='w|gz', bufsize=CHUNK_SIZE)
+        tar.add(source, arcname(source))
+        tar.close()
+    except:
+        fanout.finish()
+        for stream in streams:
+            stream.close()
+        raise
+    digest = fanout.finish()
+    results = [None] * len(streams)
+    def close(n):
+        results[n] = streams[n].close()
+    threads = [threading.Thread(target=close, args=(n,))
+                    for n in range(len(streams))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    failed = []
+    for n in range(len(streams)):
+        if fanout.errors[n] != None:
+            failed.append(str(n) + ': ' + str(fanout.errors[n]))
+            continue
+        if results[n] == None:
+            failed.append(str(n) + ': no result')
+            continue
+        status, output = results[n]
+        if status != 0:
+            failed.append(str(n) + ': status ' + str(status))
+        elif digest.encode() not in output:
+            failed.append(str(n) + ': checksum mismatch')
+    if failed != []:
+        raise TransferError('push of ' + source + ' failed in ' +
+                                                    ', '.join(failed))
+    return digest
+
+def safe_members(tar, destination):
+    ''' The members of tar that can be extracted in destination: regular
+    files and directories (never links or devices), without setuid bits.
+    Raise TransferError for any that would end outside destination '''
+    root = os.path.realpath(destination)
+    for member in tar:
+        if not member.isfile() and not member.isdir():
+            continue
+        path = os.path.realpath(os.path.join(root, member.name))
+        if path != root and not path.startswith(root + os.sep):
+            raise TransferError('pull: ' + member.name + ' is outside ' +
+                                                                destination)
+        member.mode &= 0o777
+        yield member
+
+def pull(transport, source, destination):
+    ''' Copy the file or directory source of a guest into the local
+    directory destination. Return the sha256 of the transferred stream '''
+    spool = '/tmp/cassilda-pull.' + hashlib.sha1(os.urandom(16)).hexdigest()
+    parent = os.path.dirname(os.path.normpath(source))
+    if parent == '':
+        parent = '.'
+    names = { 'spool': spool, 'parent': quote(parent),
+              'base': quote(arcname(source)) }
+    stream = transport.open_stream(PULL_COMMAND % names, 'r')
+    reader = HashingReader(stream)
+    try:
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+        tar = tarfile.open(fileobj=reader, mode='r|gz', bufsize=CHUNK_SIZE)
+        members = safe_members(tar, destination)
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(destination, members, filter='data')
+        else:
+            tar.extractall(destination, members)
+        tar.close()
+        # Consume the end of the stream so the digest covers all of it
+        while reader.read(CHUNK_SIZE):
+            pass
+    finally:
+        stream.close()
+    digest = reader.digest.hexdigest()
+    status, output = transport.execute(PULL_RESULT % names)
+    if status != 0:
+        raise TransferError('pull of ' + source + ' failed with status ' +
+                                                                str(status))
+    if digest.encode() not in output:
+        raise TransferError('pull of ' + source + ': checksum mismatch')
+    return digest
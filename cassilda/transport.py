@@ -0,0 +1,406 @@
+__version__ = "cassilda 0.0.1"
+
+"""
+Command transports
+
+A transport runs commands and copies files into a running guest. The
+ConsoleTransport goes through the serial console of the Runner (slow,
+one command at a time, but always there). The SSHTransport keeps a pool
+of persistent multiplexed (ControlMaster) ssh connections to the guest
+once its address is reachable, so many commands can run in parallel
+without paying a handshake each. It raises SSHError when a command
+could not be started (no connection to the guest); once started, an
+exit status of 255 is the one of the command.
+
+Every image gets the public key returned by ssh_keypair() in the
+authorized_keys of root when it is built.
+"""
+import base64
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from .store import temp_prefix, SSH_PREFIX
+
+# Where the key pair used to log in the guests is kept
+KEY_DIR = os.path.join('.cassilda', 'ssh')
+# Persistent connections per guest, and sessions opened at once on
+# each of them (MaxSessions of sshd defaults to 10)
+POOL_SIZE = 4
+SESSIONS = 8
+SSH_OPTIONS = ['-o', 'StrictHostKeyChecking=no',
+               '-o', 'UserKnownHostsFile=/dev/null',
+               '-o', 'BatchMode=yes',
+               '-o', 'LogLevel=ERROR',
+               '-o', 'ConnectTimeout=5']
+# Bytes moved at once by streams
+CHUNK_SIZE = 256 * 1024
+# Seconds before the ssh port of a guest that did not answer is tried
+# again
+PROBE_INTERVAL = 5
+
+class SSHError(IOError):
+    pass
+
+def ssh_keypair(directory=KEY_DIR):
+    ''' Return (private key path, public key) of the key pair used to
+    log in the guests, generating it the first time '''
+    private = os.path.join(directory, 'id_rsa')
+    if not os.path.exists(private):
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-N', '',
+                                '-C', 'cassilda', '-f', private])
+    f = open(private + '.pub', 'r')
+    try:
+        return private, f.read()
+    finally:
+        f.close()
+
+class Transport:
+    """ Runs commands in a guest. Inheritors implement execute(), put()
+    and get() """
+    def execute(self, command, timeout=-1):
+        ''' Run a shell command as root, return (exit status, output) '''
+        raise NotImplementedError()
+
+    def put(self, source, destination):
+        ''' Copy the local file source into the guest '''
+        raise NotImplementedError()
+
+    def get(self, source, destination):
+        ''' Copy the file source of the guest into a local file '''
+        raise NotImplementedError()
+
+    def open_stream(self, command, mode='w'):
+        ''' Start a shell command in the guest and return a stream to
+        write its stdin (mode 'w') or read its output (mode 'r'). Closing
+        the stream returns the (exit status, output) of the command '''
+        raise NotImplementedError()
+
+    def parallelism(self):
+        ''' How many commands it makes sense to run at once '''
+        return 1
+
+    def execute_many(self, commands, timeout=-1, execute=None):
+        ''' Run all the commands, as many at once as the transport
+        allows, returning their (status, output) in the same order. Each
+        one is run by execute(command, timeout), self.execute by default
+        '''
+        if execute == None:
+            execute = self.execute
+        results = [None] * len(commands)
+        semaphore = threading.BoundedSemaphore(self.parallelism())
+        def run(n):
+            try:
+                results[n] = execute(commands[n], timeout)
+            finally:
+                semaphore.release()
+        threads = []
+        for n in range(len(commands)):
+            semaphore.acquire()
+            t = threading.Thread(target=run, args=(n,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+class ConsoleTransport(Transport):
+    """ Commands typed in the serial console of a Runner """
+    def __init__(self, runner):
+        self.runner = runner
+
+    def execute(self, command, timeout=-1):
+        return self.runner.call(command, timeout)
+
+    def put(self, source, destination):
+        ''' Type the file base64 encoded, only sensible for small ones '''
+        f = open(source, 'rb')
+        try:
+            data = base64.b64encode(f.read()).decode()
+        finally:
+            f.close()
+        lines = [data[i:i + 76] for i in range(0, len(data), 76)]
+        status, output = self.execute("base64 -d > '" + destination +
+                            "' <<'EOF'\n" + "\n".join(lines) + "\nEOF")
+        return status == 0
+
+    def read_base64(self, command):
+        ''' Run command and return what it printed, passed through
+        base64 so it survives the console. None if it failed '''
+        status, output = self.execute("echo BEGIN-BASE64; " + command +
+                                    " | base64; echo END-BASE64")
+        if status != 0:
+            return None
+        output = output.decode('ascii', 'replace')
+        # Skip the echoed command line, take what the command printed
+        data = output.split('BEGIN-BASE64\r\n')[-1]
+        data = data.split('END-BASE64')[0]
+        return base64.b64decode(''.join(data.split()))
+
+    def get(self, source, destination):
+        data = self.read_base64("cat '" + source + "'")
+        if data == None:
+            return False
+        f = open(destination, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return True
+
+    def open_stream(self, command, mode='w'):
+        return ConsoleStream(self, command, mode)
+
+class ConsoleStream:
+    """ Stream through the console: the data is spooled to a file of
+    the guest, a chunk per call, typed base64 encoded """
+    def __init__(self, transport, command, mode):
+        self.transport = transport
+        self.command = command
+        self.mode = mode
+        self.spool = '/tmp/cassilda-stream.' + \
+                        base64.b16encode(os.urandom(6)).decode().lower()
+        self.offset = 0
+        self.result = None
+        if mode == 'r':
+            self.result = transport.execute("(" + command + ") > " +
+                                                            self.spool)
+
+    def write(self, data):
+        encoded = base64.b64encode(data).decode()
+        lines = [encoded[i:i + 76] for i in range(0, len(encoded), 76)]
+        status, output = self.transport.execute("base64 -d >> " +
+                    self.spool + " <<'EOF'\n" + "\n".join(lines) + "\nEOF")
+        if status != 0:
+            raise IOError("Error writing into " + self.spool)
+
+    def read(self, size=CHUNK_SIZE):
+        blocks = max(size // 512, 1)
+        data = self.transport.read_base64("dd if=" + self.spool +
+            " bs=512 skip=" + str(self.offset) + " count=" + str(blocks) +
+            " 2>/dev/null")
+        if data == None:
+            raise IOError("Error reading from " + self.spool)
+        self.offset += blocks
+        return data
+
+    def close(self):
+        if self.mode == 'w':
+            self.transport.execute("touch " + self.spool)
+            self.result = self.transport.execute("(" + self.command +
+                                                    ") < " + self.spool)
+        self.transport.execute("rm -f " + self.spool)
+        return self.result
+
+class ProcessStream:
+    """ Stream to the stdin or from the stdout of a local process (ssh) """
+    def __init__(self, process, mode):
+        self.process = process
+        self.mode = mode
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def read(self, size=CHUNK_SIZE):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        if self.mode == 'w':
+            self.process.stdin.close()
+            output = self.process.stdout.read()
+        else:
+            output = b''
+            self.process.stdout.read()
+        self.process.wait()
+        self.process.stdout.close()
+        return self.process.returncode, output
+
+class SSHTransport(Transport):
+    """ Pool of persistent multiplexed ssh connections to a guest """
+    def __init__(self, address, user='root', key=None, pool_size=POOL_SIZE,
+                    sessions=SESSIONS):
+        self.address = address
+        self.user = user
+        self.key = key
+        self.pool_size = pool_size
+        self.sessions = sessions
+        self.controldir = None
+        self.masters = []
+        self.next_master = 0
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(pool_size * sessions)
+        # Whether the ssh port answered (until a connection fails), and
+        # when it was last tried without answer
+        self.up = False
+        self.probed = None
+
+    def options(self, controlpath):
+        if self.key == None:
+            self.key, public = ssh_keypair()
+        return SSH_OPTIONS + ['-i', self.key, '-o',
+                                'ControlPath=' + controlpath]
+
+    def reachable(self, timeout=1):
+        ''' True if the ssh port of the guest accepts connections. It is
+        only tried until it answers (again after an SSHError), and not
+        more often than every PROBE_INTERVAL seconds '''
+        if self.up:
+            return True
+        if self.probed != None and time.time() - self.probed < PROBE_INTERVAL:
+            return False
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            try:
+                s.connect((self.address, 22))
+                self.up = True
+            except (socket.error, socket.timeout):
+                self.probed = time.time()
+        finally:
+            s.close()
+        return self.up
+
+    def unreachable(self, message):
+        ''' Forget that the guest was reachable, return the SSHError to
+        raise '''
+        self.up = False
+        self.probed = None
+        return SSHError(message)
+
+    def connect(self):
+        ''' Open the pool of master connections. Return False if the
+        guest can not be logged in '''
+        self.lock.acquire()
+        try:
+            if self.masters != []:
+                return True
+            if self.controldir == None:
+                self.controldir = tempfile.mkdtemp(
+                                        prefix=temp_prefix(SSH_PREFIX))
+            for n in range(self.pool_size):
+                controlpath = os.path.join(self.controldir, str(n))
+                r = subprocess.call(['ssh'] + self.options(controlpath) +
+                    ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes',
+                     '-f', '-N', self.user + '@' + self.address])
+                if r != 0:
+                    break
+                self.masters.append(controlpath)
+            return self.masters != []
+        finally:
+            self.lock.release()
+
+    def alive(self, controlpath):
+        ''' True if the master connection listening in controlpath
+        still answers '''
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(controlpath)
+                return True
+            except socket.error:
+                return False
+        finally:
+            s.close()
+
+    def master(self):
+        ''' Control path of the next live connection of the pool, the
+        dead ones dropped and the pool opened again if none is left.
+        None if the guest can not be logged in '''
+        for attempt in range(self.pool_size + 1):
+            if not self.connect():
+                return None
+            self.lock.acquire()
+            try:
+                m = None
+                if self.masters != []:
+                    m = self.masters[self.next_master % len(self.masters)]
+                    self.next_master += 1
+            finally:
+                self.lock.release()
+            if m != None and self.alive(m):
+                return m
+            self.lock.acquire()
+            try:
+                if m in self.masters:
+                    self.masters.remove(m)
+            finally:
+                self.lock.release()
+        return None
+
+    def parallelism(self):
+        return self.pool_size * self.sessions
+
+    def execute(self, command, timeout=-1):
+        controlpath = self.master()
+        if controlpath == None:
+            raise self.unreachable("Can not connect to " + self.address)
+        self.semaphore.acquire()
+        try:
+            p = subprocess.Popen(['ssh'] + self.options(controlpath) +
+                        [self.user + '@' + self.address, command],
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            timer = None
+            if timeout != None and timeout > 0:
+                timer = threading.Timer(timeout, p.kill)
+                timer.start()
+            try:
+                output, unused_err = p.communicate()
+            finally:
+                if timer != None:
+                    timer.cancel()
+            return p.returncode, output
+        finally:
+            self.semaphore.release()
+
+    def open_stream(self, command, mode='w'):
+        controlpath = self.master()
+        if controlpath == None:
+            raise self.unreachable("Can not connect to " + self.address)
+        stdin = None
+        if mode == 'w':
+            stdin = subprocess.PIPE
+        p = subprocess.Popen(['ssh'] + self.options(controlpath) +
+                        [self.user + '@' + self.address, command],
+                        stdin=stdin, stdout=subprocess.PIPE)
+        return ProcessStream(p, mode)
+
+    def scp(self, source, destination):
+        controlpath = self.master()
+        if controlpath == None:
+            return False
+        self.semaphore.acquire()
+        try:
+            return subprocess.call(['scp', '-q', '-r'] +
+                self.options(controlpath) + [source, destination]) == 0
+        finally:
+            self.semaphore.release()
+
+    def put(self, source, destination):
+        return self.scp(source, self.user + '@' + self.address + ':' +
+                                                            destination)
+
+    def get(self, source, destination):
+        return self.scp(self.user + '@' + self.address + ':' + source,
+                                                            destination)
+
+    def close(self):
+        ''' Close the pool of connections '''
+        self.lock.acquire()
+        try:
+            for controlpath in self.masters:
+                subprocess.call(['ssh'] + self.options(controlpath) +
+                    ['-O', 'exit', self.user + '@' + self.address],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.masters = []
+            if self.controldir != None:
+                shutil.rmtree(self.controldir, True)
+                self.controldir = None
+        finally:
+            self.lock.release()